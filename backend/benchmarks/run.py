@@ -0,0 +1,387 @@
+"""Load and benchmark suite for the SecSky API.
+
+Boots the FastAPI app in-process against a local database stand-in and drives
+concurrent scenarios through httpx. Run from `backend/`:
+
+    python -m benchmarks.run --db mongod                 # spawn a throwaway local mongod
+    python -m benchmarks.run --db uri --mongo-uri URI    # use an existing server
+    python -m benchmarks.run --db mongomock              # in-memory, no server needed
+    python -m benchmarks.run --db mongomock --repositories memory   # ...with the in-memory repository backend
+    python -m benchmarks.run compare OLD.json NEW.json   # diff two saved runs
+
+Results are written as JSON (one entry per scenario with p50/p95/p99 latency,
+throughput and peak RSS) so runs from different commits can be compared.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+RESULTS_DIR = Path(__file__).parent / "results"
+MB = 1024 * 1024
+
+ALL_SCENARIOS = [
+    "register_storm", "login_storm", "upload", "download",
+    "large_listing", "bulk_move", "key_rotation",
+]
+
+
+def current_rss() -> int:
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Not Linux: fall back to the lifetime peak (bytes on macOS, KiB elsewhere)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Recorder:
+    """Collects per-request latencies and samples RSS while a scenario runs."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.peak_rss = current_rss()
+        self._sampler = None
+
+    async def _sample(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, current_rss())
+            await asyncio.sleep(0.01)
+
+    async def __aenter__(self):
+        self.started = time.perf_counter()
+        self._sampler = asyncio.create_task(self._sample())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        self._sampler.cancel()
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+    async def timed(self, coro, ok_statuses=(200, 206)):
+        start = time.perf_counter()
+        response = await coro
+        self.latencies.append(time.perf_counter() - start)
+        if response.status_code not in ok_statuses:
+            self.errors += 1
+        self.bytes += len(response.content)
+        return response
+
+    def summary(self) -> dict:
+        lat = sorted(self.latencies)
+
+        def pct(p):
+            if not lat:
+                return None
+            return round(lat[min(len(lat) - 1, int(round(p / 100 * (len(lat) - 1))))] * 1000, 3)
+
+        return {
+            "requests": len(lat),
+            "errors": self.errors,
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "p99_ms": pct(99),
+            "mean_ms": round(statistics.fmean(lat) * 1000, 3) if lat else None,
+            "throughput_rps": round(len(lat) / self.elapsed, 2) if self.elapsed else None,
+            "response_mb_per_s": round(self.bytes / MB / self.elapsed, 2) if self.elapsed else None,
+            "peak_rss_mb": round(self.peak_rss / MB, 1),
+            "elapsed_s": round(self.elapsed, 3),
+        }
+
+
+async def gather_limited(concurrency: int, coros):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
+def upload_form(size: int, folder_id=None) -> tuple[dict, dict]:
+    data = {
+        "encrypted_file_key": "bench-key",
+        "file_iv": "bench-iv",
+        "key_wrap_iv": "bench-wrap-iv",
+        "encrypted_filename": f"bench-{uuid.uuid4().hex}",
+        "filename_iv": "bench-name-iv",
+        "requires_file_password": "false",
+        "original_size": str(size),
+    }
+    if folder_id:
+        data["folder_id"] = folder_id
+    return data, {"file": ("blob.bin", os.urandom(size), "application/octet-stream")}
+
+
+class Bench:
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.users = []  # (email, password, client)
+        self.files = {}  # email -> [file ids]
+
+    def client(self):
+        import httpx
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=self.app, raise_app_exceptions=False), base_url="https://bench.local", timeout=120)
+
+    async def close(self):
+        for _, _, client in self.users:
+            await client.aclose()
+
+    async def register(self, rec: Recorder, email: str, password: str):
+        client = self.client()
+        response = await rec.timed(client.post("/api/auth/register", json={
+            "email": email, "password": password, "salt": "bench-salt", "vault_metadata": "bench-meta"
+        }))
+        if response.status_code == 200:
+            self.users.append((email, password, client))
+        else:
+            await client.aclose()
+
+    async def scenario_register_storm(self, rec: Recorder):
+        run_id = uuid.uuid4().hex[:8]
+        await gather_limited(self.args.concurrency, [
+            self.register(rec, f"bench-{run_id}-{i}@example.com", "bench-password")
+            for i in range(self.args.users)
+        ])
+
+    async def scenario_login_storm(self, rec: Recorder):
+        async def login(email, password):
+            async with self.client() as client:
+                await rec.timed(client.post("/api/auth/login", json={"email": email, "password": password}))
+        await gather_limited(self.args.concurrency, [
+            login(email, password) for email, password, _ in self.users for _ in range(self.args.logins_per_user)
+        ])
+
+    async def scenario_upload(self, rec: Recorder):
+        sizes = [int(s * MB) for s in self.args.upload_sizes_mb]
+
+        async def upload(email, client, size):
+            data, files = upload_form(size)
+            response = await rec.timed(client.post("/api/files/upload", data=data, files=files))
+            if response.status_code == 200:
+                self.files.setdefault(email, []).append(response.json()["id"])
+
+        await gather_limited(self.args.concurrency, [
+            upload(email, client, size)
+            for email, _, client in self.users[: self.args.upload_users]
+            for size in sizes
+        ])
+
+    async def scenario_download(self, rec: Recorder):
+        clients = {email: client for email, _, client in self.users}
+        await gather_limited(self.args.concurrency, [
+            rec.timed(clients[email].get(f"/api/files/{file_id}/download"))
+            for _ in range(self.args.download_rounds)
+            for email, ids in self.files.items()
+            for file_id in ids
+        ])
+
+    async def seed_files(self, user_id: str, count: int, folder_id=None) -> list[str]:
+        # Metadata-only documents written straight to the database; listing and
+        # bulk scenarios never touch the blobs
+        from core import db as core_db
+        now = datetime.datetime.utcnow()
+        docs = []
+        for i in range(count):
+            file_id = str(uuid.uuid4())
+            docs.append({
+                "_id": file_id, "file_id": file_id, "user_id": user_id,
+                "filename": f"seed-{i}", "filename_iv": "iv", "file_size": 1024,
+                "encrypted_file_key": "key", "file_iv": "iv", "key_wrap_iv": "wrap",
+                "password_protected": False, "password_salt": None, "password_iv": None,
+                "folder_id": folder_id, "storage_backend": "local", "storage_key": file_id,
+                "blob_size": 1024, "created_at": now + datetime.timedelta(microseconds=i * 1000),
+            })
+        for start in range(0, len(docs), 1000):
+            await core_db.db.files.insert_many(docs[start:start + 1000])
+        return [d["_id"] for d in docs]
+
+    async def dedicated_user(self, rec_name: str):
+        email = f"bench-{rec_name}-{uuid.uuid4().hex[:8]}@example.com"
+        throwaway = Recorder("setup")
+        await self.register(throwaway, email, "bench-password")
+        _, _, client = self.users[-1]
+        me = await client.get("/api/auth/me")
+        return client, me.json()["id"]
+
+    async def scenario_large_listing(self, rec: Recorder):
+        client, user_id = await self.dedicated_user("listing")
+        await self.seed_files(user_id, self.args.listing_files)
+        await gather_limited(self.args.concurrency, [
+            rec.timed(client.get("/api/files/")) for _ in range(self.args.listing_rounds)
+        ])
+        for _ in range(self.args.listing_rounds):
+            await rec.timed(client.get("/api/files/page", params={"limit": 100}))
+
+    async def scenario_bulk_move(self, rec: Recorder):
+        client, user_id = await self.dedicated_user("bulk")
+        folder = (await client.post("/api/folders/", json={"name_encrypted": "f", "name_iv": "iv"})).json()["id"]
+        ids = await self.seed_files(user_id, self.args.bulk_files)
+        for round_no in range(self.args.bulk_rounds):
+            target = folder if round_no % 2 == 0 else None
+            operations = [{"op": "move", "file_id": file_id, "folder_id": target} for file_id in ids]
+            await rec.timed(client.post("/api/files/bulk", json={"operations": operations}))
+
+    async def scenario_key_rotation(self, rec: Recorder):
+        client, user_id = await self.dedicated_user("rotation")
+        ids = await self.seed_files(user_id, self.args.rotation_files)
+
+        def update(file_id):
+            return {
+                "file_id": file_id, "encrypted_file_key": "k2", "key_wrap_iv": "w2",
+                "encrypted_filename": "f2", "filename_iv": "i2",
+            }
+
+        # Single-request rotation
+        await rec.timed(client.put("/api/auth/master-password", json={
+            "salt": "s2", "vault_metadata": "m2", "file_updates": [update(i) for i in ids]
+        }))
+
+        # Batched rotation job
+        job = (await rec.timed(client.post("/api/auth/master-password/rotations", json={
+            "salt": "s3", "vault_metadata": "m3"
+        }))).json()
+        batch_size = job.get("batch_size", 500)
+        for seq, start in enumerate(range(0, len(ids), batch_size)):
+            await rec.timed(client.put(
+                f"/api/auth/master-password/rotations/{job['job_id']}/batches/{seq}",
+                json={"file_updates": [update(i) for i in ids[start:start + batch_size]]}
+            ))
+        await rec.timed(client.post(f"/api/auth/master-password/rotations/{job['job_id']}/commit"))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run_benchmarks(args) -> dict:
+    import main
+
+    bench = Bench(main.app, args)
+    results = {}
+    async with main.app.router.lifespan_context(main.app):
+        try:
+            for name in args.scenarios:
+                # Every scenario after register_storm needs users to act as
+                if name != "register_storm" and not bench.users:
+                    await bench.scenario_register_storm(Recorder("setup"))
+                async with Recorder(name) as rec:
+                    await getattr(bench, f"scenario_{name}")(rec)
+                results[name] = rec.summary()
+                print(f"{name:16} {json.dumps(results[name])}", flush=True)
+        finally:
+            await bench.close()
+    return results
+
+
+def cmd_run(args):
+    from benchmarks.stand_in import prepare_environment
+
+    cleanup = prepare_environment(args.db, mongod_binary=args.mongod, mongo_uri=args.mongo_uri, repositories=args.repositories)
+    try:
+        results = asyncio.run(run_benchmarks(args))
+    finally:
+        cleanup()
+
+    revision = git_revision()
+    report = {
+        "revision": revision,
+        "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "database": args.db,
+        "repositories": args.repositories,
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("func", "output")},
+        "scenarios": results,
+    }
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{revision}-{int(time.time())}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Results written to {output}")
+
+
+def cmd_compare(args):
+    old = json.loads(Path(args.old).read_text())
+    new = json.loads(Path(args.new).read_text())
+    print(f"{'scenario':16} {'metric':16} {old['revision']:>12} {new['revision']:>12} {'change':>9}")
+    regressions = 0
+    for name, new_stats in new["scenarios"].items():
+        old_stats = old["scenarios"].get(name)
+        if not old_stats:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "peak_rss_mb"):
+            before, after = old_stats.get(metric), new_stats.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            # Throughput regresses when it drops; everything else when it grows
+            worse = -change if metric == "throughput_rps" else change
+            flag = " !" if worse > args.threshold else ""
+            regressions += bool(flag)
+            print(f"{name:16} {metric:16} {before:>12} {after:>12} {change:>+8.1f}%{flag}")
+    if regressions:
+        print(f"{regressions} metric(s) regressed by more than {args.threshold}%")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SecSky API benchmarks")
+    subparsers = parser.add_subparsers(dest="command")
+
+    compare = subparsers.add_parser("compare", help="Compare two saved result files")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=10.0, help="Percent change flagged as a regression")
+    compare.set_defaults(func=cmd_compare)
+
+    parser.add_argument("--db", choices=["mongod", "uri", "mongomock"], default="mongod")
+    parser.add_argument("--mongod", help="Path to a mongod binary (defaults to the one on PATH)")
+    parser.add_argument("--mongo-uri", help="Existing MongoDB to use with --db uri")
+    parser.add_argument("--repositories", choices=["mongo", "memory"], default="mongo",
+                        help="REPOSITORY_BACKEND for the run; seeded listing data still goes to the database")
+    parser.add_argument("--scenarios", nargs="+", choices=ALL_SCENARIOS, default=ALL_SCENARIOS)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--logins-per-user", type=int, default=2)
+    parser.add_argument("--upload-users", type=int, default=4)
+    parser.add_argument("--upload-sizes-mb", type=float, nargs="+", default=[1, 5, 15])
+    parser.add_argument("--download-rounds", type=int, default=3)
+    parser.add_argument("--listing-files", type=int, default=5000)
+    parser.add_argument("--listing-rounds", type=int, default=10)
+    parser.add_argument("--bulk-files", type=int, default=200)
+    parser.add_argument("--bulk-rounds", type=int, default=10)
+    parser.add_argument("--rotation-files", type=int, default=2000)
+    parser.add_argument("--output", help="Where to write the JSON results")
+    parser.set_defaults(func=cmd_run)
+
+    args = parser.parse_args()
+    if args.db == "uri" and not args.mongo_uri:
+        parser.error("--db uri requires --mongo-uri")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+
+class MongodProcess:
+    """Throwaway `mongod` on a free port with a temporary dbpath."""
+
+    def __init__(self, binary: str):
+        self.binary = binary
+        self.dbpath = tempfile.mkdtemp(prefix="secsky-bench-db-")
+        self.port = _free_port()
+        self.process = None
+
+    @property
+    def uri(self) -> str:
+        return f"mongodb://127.0.0.1:{self.port}"
+
+    def start(self, timeout: float = 30.0):
+        self.process = subprocess.Popen(
+            [self.binary, "--dbpath", self.dbpath, "--port", str(self.port), "--bind_ip", "127.0.0.1", "--quiet"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"mongod exited with code {self.process.returncode}")
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.5):
+                    return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("mongod did not start in time")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        shutil.rmtree(self.dbpath, ignore_errors=True)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+_mongomock_patched = False
+
+
+def patch_mongomock():
+    """Fills the gaps in mongomock that the app's queries run into (shared with
+    the test suite); none of them change anything on a real server. Safe to call more than once."""
+    global _mongomock_patched
+    if _mongomock_patched:
+        return
+    import mongomock.aggregate
+    import mongomock.collection
+
+    # pymongo 4.11+ passes write models a `sort` option that BulkOperationBuilder doesn't take
+    for name in ("add_update", "add_replace", "add_delete"):
+        original = getattr(mongomock.collection.BulkOperationBuilder, name)
+
+        def without_sort(self, *args, _original=original, sort=None, **kwargs):
+            return _original(self, *args, **kwargs)
+
+        setattr(mongomock.collection.BulkOperationBuilder, name, without_sort)
+
+    # The `$unset` stage (used by pipeline updates) is an alias for an exclusion `$project`
+    def unset_stage(collection, database, fields):
+        fields = [fields] if isinstance(fields, str) else fields
+        return mongomock.aggregate._handle_project_stage(collection, database, {field: 0 for field in fields})
+
+    mongomock.aggregate._PIPELINE_HANDLERS["$unset"] = unset_stage
+
+    # Folder moves compute `$slice` positions from the path with `$indexOfArray`; mongomock
+    # only takes literal positions and lacks `$indexOfArray` (two-argument form here)
+    handle_array_operator = mongomock.aggregate._Parser._handle_array_operator
+
+    def array_operator(self, operator, value):
+        if operator == "$indexOfArray":
+            array, item = (self.parse(v) for v in value[:2])
+            return array.index(item) if item in array else -1
+        if operator == "$slice" and isinstance(value, list):
+            value = value[:1] + [self.parse(v) for v in value[1:]]
+        return handle_array_operator(self, operator, value)
+
+    mongomock.aggregate._Parser._handle_array_operator = array_operator
+    _mongomock_patched = True
+
+
+def install_mongomock():
+    """Binds `core.db` to mongomock-motor's in-memory client; the app lifespan
+    keeps a client that is already connected instead of creating its own."""
+    from mongomock_motor import AsyncMongoMockClient
+    import core.db
+
+    patch_mongomock()
+    core.db.connect(AsyncMongoMockClient())
+
+
+def prepare_environment(db_mode: str, mongod_binary: str = None, mongo_uri: str = None, repositories: str = "mongo"):
+    """Configures settings for the chosen database and returns a cleanup callable."""
+    # Read when the settings are first imported, which happens below
+    os.environ["REPOSITORY_BACKEND"] = repositories
+    os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+    os.environ.setdefault("UPLOAD_DIR", tempfile.mkdtemp(prefix="secsky-bench-blobs-"))
+    os.environ.setdefault("STORAGE_BACKEND", "local")
+    cleanups = [lambda: shutil.rmtree(os.environ["UPLOAD_DIR"], ignore_errors=True)]
+
+    if db_mode == "uri":
+        os.environ["MONGODB_URI"] = mongo_uri
+    elif db_mode == "mongod":
+        binary = mongod_binary or shutil.which("mongod")
+        if not binary:
+            raise SystemExit("No mongod binary found; pass --mongod PATH or use --db mongomock")
+        mongod = MongodProcess(binary)
+        mongod.start()
+        os.environ["MONGODB_URI"] = mongod.uri
+        cleanups.append(mongod.stop)
+    elif db_mode == "mongomock":
+        install_mongomock()
+    else:
+        raise SystemExit(f"Unknown database mode: {db_mode}")
+
+    def cleanup():
+        for fn in reversed(cleanups):
+            fn()
+    return cleanup
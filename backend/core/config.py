@@ -5,9 +5,122 @@ import logging
 
 class Settings(BaseSettings):
     MONGODB_URI: str = "mongodb://localhost:27017" # default for local dev
+    MONGO_DB_NAME: str = "secure_vault"
+    # Connection pool; MONGO_MIN_POOL_SIZE connections are opened at startup and kept.
+    # MONGO_COMPRESSORS is a comma-separated list (zlib built in; zstd/snappy need
+    # their packages). Read-only routes (listings, metadata, activity) use
+    # MONGO_READ_PREFERENCE, e.g. "secondaryPreferred" to spread them over a replica set
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 5
+    MONGO_MAX_IDLE_TIME_MS: int = 5 * 60 * 1000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 5000
+    MONGO_COMPRESSORS: str = ""
+    MONGO_READ_PREFERENCE: str = "primary"
+    READINESS_TIMEOUT_SECONDS: float = 2
+    # Store behind the repository layer: "mongo", or "memory" to keep users, files, folders
+    # and activity in process memory (benchmarks and local runs; lost on restart)
+    REPOSITORY_BACKEND: str = "mongo"
     JWT_SECRET_KEY: str
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60
+
+    # bcrypt runs on a worker pool ("thread" or "process"); requests beyond
+    # PASSWORD_HASH_MAX_PENDING in-flight hashes are rejected with 503
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_EXECUTOR: str = "thread"
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_PENDING: int = 16
+
+    # In-process cache of decoded tokens and user documents used by get_current_user
+    USER_CACHE_TTL_SECONDS: int = 30
+    USER_CACHE_MAX_ENTRIES: int = 10000
+    # Broadcast invalidations to other workers through a capped MongoDB collection
+    USER_CACHE_PUBSUB: bool = False
+
+    # Per-user storage quota in ciphertext bytes; 0 means unlimited
+    USER_QUOTA_BYTES: int = 0
+
+    # Blob storage: "local" writes ciphertext under UPLOAD_DIR, "gridfs" keeps it in MongoDB GridFS
+    STORAGE_BACKEND: str = "local"
+    UPLOAD_DIR: str = "uploads"
+    GRIDFS_BUCKET: str = "blobs"
+    MAX_UPLOAD_SIZE: int = 15 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+
+    # POST /api/files/batch-download: at most BATCH_DOWNLOAD_MAX_FILES per request; blobs up
+    # to BATCH_DOWNLOAD_PREFETCH_BYTES are read BATCH_DOWNLOAD_WINDOW files ahead of the one
+    # being sent, larger ones are streamed in turn
+    BATCH_DOWNLOAD_MAX_FILES: int = 1000
+    BATCH_DOWNLOAD_WINDOW: int = 8
+    BATCH_DOWNLOAD_PREFETCH_BYTES: int = 8 * 1024 * 1024
+
+    # Read cache for ciphertext fetched from GridFS: an LRU in memory plus an optional
+    # disk tier under BLOB_CACHE_DIR; a budget of 0 disables that tier
+    BLOB_CACHE_MEMORY_BYTES: int = 128 * 1024 * 1024
+    BLOB_CACHE_MAX_ENTRY_BYTES: int = 16 * 1024 * 1024
+    BLOB_CACHE_DIR: Optional[str] = None
+    BLOB_CACHE_DISK_BYTES: int = 2 * 1024 * 1024 * 1024
+
+    # Activity log writes are batched in the background; entries older than
+    # ACTIVITY_RETENTION_DAYS are expired by a TTL index (0 keeps them forever)
+    ACTIVITY_FLUSH_BATCH_SIZE: int = 100
+    ACTIVITY_FLUSH_INTERVAL_SECONDS: float = 0.5
+    ACTIVITY_QUEUE_SIZE: int = 10000
+    ACTIVITY_RETENTION_DAYS: int = 90
+
+    # Max re-wrapped keys per batch of a master-password rotation job
+    KEY_ROTATION_BATCH_SIZE: int = 500
+
+    # How long /api/sync can bridge; older clients get a reset and reload everything
+    SYNC_JOURNAL_RETENTION_SECONDS: int = 30 * 24 * 60 * 60
+
+    # /metrics is disabled unless METRICS_TOKEN is set, and then needs "Authorization: Bearer <token>";
+    # the same token in an X-Profile-Token request header turns on the sampling profiler
+    METRICS_TOKEN: Optional[str] = None
+    PROFILER_INTERVAL_SECONDS: float = 0.005
+    PROFILER_HISTORY: int = 20
+    EVENT_LOOP_LAG_INTERVAL_SECONDS: float = 0.5
+
+    # Per-user scheduling (0 disables each limit): every authenticated request takes a
+    # token from a RATE_LIMIT_REQUESTS_PER_SECOND bucket; uploads/downloads also need
+    # RATE_LIMIT_TRANSFER_RESERVE tokens left over (so metadata calls win when a user is
+    # near the limit) and a free transfer slot, and are paced to the byte rates. A
+    # transfer is refused while the user's byte debt exceeds MAX_TRANSFER_WAIT_SECONDS
+    RATE_LIMIT_REQUESTS_PER_SECOND: float = 0
+    RATE_LIMIT_BURST: int = 50
+    RATE_LIMIT_TRANSFER_RESERVE: int = 10
+    MAX_TRANSFERS_PER_USER: int = 0
+    MAX_TRANSFERS: int = 0
+    UPLOAD_BYTES_PER_SECOND: int = 0
+    DOWNLOAD_BYTES_PER_SECOND: int = 0
+    TRANSFER_BURST_BYTES: int = 8 * 1024 * 1024
+    MAX_TRANSFER_WAIT_SECONDS: float = 30
+
+    # Idempotency-Key replay: completed responses are kept for IDEMPOTENCY_TTL_SECONDS;
+    # a key whose request is still running blocks duplicates for up to
+    # IDEMPOTENCY_WAIT_SECONDS, and is taken over if its owner held it past the lock
+    IDEMPOTENCY_TTL_SECONDS: int = 24 * 60 * 60
+    IDEMPOTENCY_WAIT_SECONDS: float = 30
+    IDEMPOTENCY_LOCK_SECONDS: int = 5 * 60
+
+    # Maintenance sweeps for orphaned folders, files, activity logs and blobs. They run from
+    # `manage.py gc`, or every GC_INTERVAL_SECONDS in one worker (0 disables the loop), in
+    # batches of GC_BATCH_SIZE with GC_BATCH_PAUSE_SECONDS between them; nothing younger
+    # than GC_GRACE_SECONDS counts as orphaned
+    GC_INTERVAL_SECONDS: int = 0
+    GC_BATCH_SIZE: int = 200
+    GC_BATCH_PAUSE_SECONDS: float = 0.5
+    GC_GRACE_SECONDS: int = 60 * 60
+
+    # Resumable upload sessions (/api/files/uploads). A commit holds its session for
+    # UPLOAD_COMMIT_LOCK_SECONDS; past that a retried commit or an abort takes it over
+    MAX_RESUMABLE_UPLOAD_SIZE: int = 2 * 1024 * 1024 * 1024
+    UPLOAD_SESSION_CHUNK_SIZE: int = 8 * 1024 * 1024
+    UPLOAD_SESSION_MAX_CHUNK_SIZE: int = 32 * 1024 * 1024
+    UPLOAD_SESSION_TTL_SECONDS: int = 24 * 60 * 60
+    UPLOAD_SESSION_GC_INTERVAL_SECONDS: int = 10 * 60
+    MAX_UPLOAD_SESSIONS_PER_USER: int = 20
+    UPLOAD_COMMIT_LOCK_SECONDS: int = 10 * 60
     
     class Config:
         env_file = ".env"
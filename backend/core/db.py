@@ -1,8 +1,109 @@
+import asyncio
+import logging
+from typing import Optional
+
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReadPreference
+from pymongo.errors import OperationFailure
 from core.config import settings
+from services.metrics import mongo_listener
+
+logger = logging.getLogger(__name__)
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+INDEX_OPTIONS_CONFLICT = 85
+
+# Bound by connect(), which the app lifespan (or a CLI entry point) calls before use.
+# `db` is for anything that writes or must read its own writes; `read_db` routes
+# reads per MONGO_READ_PREFERENCE for read-only endpoints.
+client: Optional[AsyncIOMotorClient] = None
+db = None
+read_db = None
+
+
+def client_options() -> dict:
+    options = {
+        "serverSelectionTimeoutMS": settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "maxPoolSize": settings.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": settings.MONGO_MAX_IDLE_TIME_MS or None,
+        "event_listeners": [mongo_listener],
+    }
+    if settings.MONGO_COMPRESSORS:
+        options["compressors"] = settings.MONGO_COMPRESSORS
+    return options
+
+
+def connect(mongo_client: Optional[AsyncIOMotorClient] = None):
+    """Creates the client unless one exists (or is passed in, like the benchmark's
+    in-memory stand-in) and binds `db` / `read_db`. Creating a client does no I/O."""
+    global client, db, read_db
+    if mongo_client is not None:
+        client = mongo_client
+    elif client is None:
+        client = AsyncIOMotorClient(settings.MONGODB_URI, **client_options())
+    if settings.MONGO_READ_PREFERENCE not in READ_PREFERENCES:
+        raise ValueError(f"Unknown MONGO_READ_PREFERENCE: {settings.MONGO_READ_PREFERENCE!r}")
+    db = client[settings.MONGO_DB_NAME]
+    reset_storage()
+    read_db = client.get_database(
+        settings.MONGO_DB_NAME, read_preference=READ_PREFERENCES[settings.MONGO_READ_PREFERENCE]
+    )
+
+
+async def warm_up():
+    # Concurrent pings each check out their own connection, so the first
+    # MONGO_MIN_POOL_SIZE requests don't pay for TCP/TLS handshakes
+    await asyncio.gather(*(db.command("ping") for _ in range(max(settings.MONGO_MIN_POOL_SIZE, 1))))
+
+
+async def ping(timeout: float) -> bool:
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout)
+        return True
+    except Exception:
+        return False
+
+
+def close():
+    # pymongo reopens a closed client on next use, so a later lifespan can reuse it
+    if client is not None:
+        client.close()
+    reset_storage()
+
+
+def reset_storage():
+    # The GridFS backend holds on to the `db` it was built with
+    from services.storage import reset_backends
+    reset_backends()
+
+
+async def ensure_index(collection, keys, **kwargs):
+    """create_index, except that a TTL changed in the settings is applied in place
+    with collMod instead of failing startup on the existing index."""
+    try:
+        await collection.create_index(keys, **kwargs)
+    except OperationFailure as exc:
+        if exc.code != INDEX_OPTIONS_CONFLICT or "expireAfterSeconds" not in kwargs:
+            raise
+        key_pattern = {keys: 1} if isinstance(keys, str) else dict(keys)
+        await collection.database.command(
+            "collMod", collection.name,
+            index={"keyPattern": key_pattern, "expireAfterSeconds": kwargs["expireAfterSeconds"]}
+        )
+        logger.info("Updated the TTL of %s.%s to %ss", collection.name, key_pattern, kwargs["expireAfterSeconds"])
 
-client = AsyncIOMotorClient(settings.MONGODB_URI, serverSelectionTimeoutMS=5000)
-db = client.secure_vault
 
 async def get_db():
     return db
+
+
+async def get_read_db():
+    return read_db
@@ -0,0 +1,185 @@
+import hmac
+import re
+import time
+
+from fastapi import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from security.auth import token_user_id
+from services import metrics, profiler
+from services.scheduler import scheduler, UPLOAD
+
+# Room for the small encrypted-metadata form fields that travel alongside the file part
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class BodySizeLimitMiddleware:
+    """Rejects request bodies larger than the configured limit for a path.
+
+    A declared Content-Length is checked before anything is read; otherwise the
+    bytes are counted as they arrive and the request is aborted with 413 as soon
+    as the limit is crossed, instead of after the whole body has been spooled.
+    """
+
+    def __init__(self, app, limits: dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                response = JSONResponse({"detail": "Request body too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI re-raises HTTPExceptions coming out of body parsing untouched
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class UploadAdmissionMiddleware:
+    """Admits upload requests and opens their transfer slot before any of the body
+    is read, then paces the body as it arrives.
+
+    FastAPI parses (and spools) a multipart body before the route's dependencies
+    run, so a 429 from there would only come after the whole upload was received.
+    Requests without a valid token go through untouched; get_current_user rejects them.
+    """
+
+    def __init__(self, app, routes: list[tuple[str, str]]):
+        self.app = app
+        self.routes = [(method, re.compile(pattern)) for method, pattern in routes]
+
+    def _matches(self, scope) -> bool:
+        return any(scope["method"] == method and pattern.fullmatch(scope["path"]) for method, pattern in self.routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._matches(scope):
+            await self.app(scope, receive, send)
+            return
+
+        token = Request(scope).cookies.get("access_token")
+        try:
+            user_id = token_user_id(token) if token else None
+        except HTTPException:
+            user_id = None
+        if user_id is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            scheduler.admit(user_id)
+            transfer = scheduler.open_transfer(user_id, UPLOAD)
+        except HTTPException as exc:
+            response = JSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+            await response(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        state["admitted_user"] = user_id
+        state["transfer"] = transfer
+
+        async def paced_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                await transfer.pace(len(message.get("body", b"")))
+            return message
+
+        try:
+            await self.app(scope, paced_receive, send)
+        finally:
+            transfer.release()
+
+
+class SecurityHeadersMiddleware:
+    def __init__(self, app, headers: dict[str, str]):
+        self.app = app
+        self.headers = [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                names = {name for name, _ in self.headers}
+                headers = [(n, v) for n, v in message.get("headers", []) if n.lower() not in names]
+                message = {**message, "headers": headers + self.headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+class MetricsMiddleware:
+    """Records latency and body sizes per route template (not raw path, to keep
+    label cardinality bounded) and runs the sampling profiler on requests that
+    carry a valid `X-Profile-Token` header."""
+
+    def __init__(self, app, profile_token: str = None):
+        self.app = app
+        self.profile_token = profile_token.encode() if profile_token else None
+
+    def _wants_profile(self, scope) -> bool:
+        if not self.profile_token:
+            return False
+        for name, value in scope["headers"]:
+            if name == b"x-profile-token":
+                return hmac.compare_digest(value, self.profile_token)
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        request_bytes = 0
+        response_bytes = 0
+        status = 500
+        profile = profiler.start_profile(scope["method"], scope["path"]) if self._wants_profile(scope) else None
+
+        async def counting_receive():
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal response_bytes, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile:
+                    message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]}
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            if profile:
+                profiler.finish_profile(profile)
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            metrics.http_request_duration.observe(time.perf_counter() - start, method=method, route=route, status=status)
+            metrics.http_request_size.observe(request_bytes, method=method, route=route)
+            metrics.http_response_size.observe(response_bytes, method=method, route=route)
@@ -1,12 +1,83 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from routers import auth, files, activity, folders
-from core.db import db
+from routers import auth, files, activity, folders, uploads, sync, metrics, usage
+from core import db as database
+from core.db import ensure_index
+from core.config import settings
+from core.middleware import (
+    BodySizeLimitMiddleware, MetricsMiddleware, SecurityHeadersMiddleware, UploadAdmissionMiddleware, MULTIPART_OVERHEAD
+)
+from services.upload_sessions import session_gc_loop
+from services.maintenance import maintenance_loop
+from security.user_cache import user_cache, invalidation_listener
+from security.auth import password_hasher
+from services.activity import activity_sink, ensure_activity_indexes
+from services.metrics import event_loop_monitor
+from services.blob_cache import blob_cache
+import asyncio
 import warnings
+from contextlib import asynccontextmanager
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 
-app = FastAPI(title="SecSky API", version="1.0.0")
+async def ensure_indexes(db):
+    # create_index is a no-op for an index that already exists, so this runs on every start
+    await db.folders.create_index([("user_id", 1), ("parent_id", 1)])
+    await db.folders.create_index([("user_id", 1), ("ancestors", 1)])
+    await db.files.create_index([("user_id", 1), ("folder_id", 1)])
+    # Keyset pagination on (created_at, _id), with and without a folder filter
+    await db.folders.create_index([("user_id", 1), ("parent_id", 1), ("created_at", 1), ("_id", 1)])
+    await db.folders.create_index([("user_id", 1), ("created_at", 1), ("_id", 1)])
+    await db.files.create_index([("user_id", 1), ("folder_id", 1), ("created_at", 1), ("_id", 1)])
+    await db.files.create_index([("user_id", 1), ("created_at", 1), ("_id", 1)])
+    await db.files.create_index([("user_id", 1), ("pending_key.job_id", 1)])
+    await db.files.create_index([("user_id", 1), ("search_tokens", 1)])
+    await db.files.create_index("storage_key")
+    await db.key_rotations.create_index([("user_id", 1), ("status", 1)])
+    await db.vault_changes.create_index([("user_id", 1), ("version", 1)], unique=True)
+    await ensure_index(db.vault_changes, "created_at", expireAfterSeconds=settings.SYNC_JOURNAL_RETENTION_SECONDS)
+    await db.upload_sessions.create_index([("user_id", 1), ("expires_at", 1)])
+    await db.upload_sessions.create_index("expires_at")
+    await ensure_index(db.idempotency_keys, "expires_at", expireAfterSeconds=0)
+    await ensure_activity_indexes(db)
+
+background_tasks = set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    database.connect()
+    await database.warm_up()
+    await ensure_indexes(database.db)
+
+    db = database.db
+    activity_sink.start(db)
+    background_tasks.add(asyncio.create_task(session_gc_loop(db)))
+    background_tasks.add(asyncio.create_task(event_loop_monitor()))
+    if settings.GC_INTERVAL_SECONDS > 0:
+        background_tasks.add(asyncio.create_task(maintenance_loop(db)))
+    if settings.USER_CACHE_PUBSUB:
+        background_tasks.add(asyncio.create_task(invalidation_listener(db)))
+    try:
+        yield
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        background_tasks.clear()
+        await activity_sink.stop()
+        password_hasher.shutdown()
+        database.close()
+
+app = FastAPI(title="SecSky API", version="1.0.0", lifespan=lifespan)
+
+# Added first so it sits inside CORS and its 429s still carry the CORS headers
+app.add_middleware(
+    UploadAdmissionMiddleware,
+    routes=[
+        ("POST", r"/api/files/upload"),
+        ("PUT", r"/api/files/uploads/[^/]+/chunks/\d+"),
+    ],
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,27 +89,55 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Content-Range", "Accept-Ranges", "Idempotent-Replayed", "X-Batch-Format", "X-Batch-Count"],
 )
 
-@app.middleware("http")
-async def add_security_headers(request, call_next):
-    response = await call_next(request)
-    response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["X-Frame-Options"] = "DENY"
-    response.headers["Content-Security-Policy"] = "default-src 'self'; connect-src 'self' https://sec-sky.vercel.app http://localhost:5173 http://localhost:3000;"
-    return response
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    limits={"/api/files/upload": settings.MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD},
+)
+
+# Pure ASGI rather than @app.middleware("http"), which runs the rest of the stack
+# in a separate task and gets in the way of the per-request profiler
+app.add_middleware(
+    SecurityHeadersMiddleware,
+    headers={
+        "Strict-Transport-Security": "max-age=31536000; includeSubDomains",
+        "X-Content-Type-Options": "nosniff",
+        "X-Frame-Options": "DENY",
+        "Content-Security-Policy": "default-src 'self'; connect-src 'self' https://sec-sky.vercel.app http://localhost:5173 http://localhost:3000;",
+    },
+)
+
+# Added last so it is outermost and times everything, including CORS and size checks
+app.add_middleware(MetricsMiddleware, profile_token=settings.METRICS_TOKEN)
 
 app.include_router(auth.router)
+# Registered before `files` so /api/files/uploads/... is never mistaken for a file id
+app.include_router(uploads.router)
 app.include_router(files.router)
 app.include_router(activity.router)
 app.include_router(folders.router)
+app.include_router(sync.router)
+app.include_router(usage.router)
+app.include_router(metrics.router)
 
-@app.on_event("startup")
-async def startup_db_indexes():
-    await db.folders.create_index([("user_id", 1), ("parent_id", 1)])
-    await db.files.create_index([("user_id", 1), ("folder_id", 1)])
+@app.get("/health/live")
+async def liveness_check():
+    # The process is up and serving; says nothing about its dependencies
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness_check():
+    if not await database.ping(settings.READINESS_TIMEOUT_SECONDS):
+        return JSONResponse({"status": "unavailable", "mongo": False}, status_code=503)
+    return {"status": "ok", "mongo": True}
 
 @app.get("/health")
 async def health_check():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "user_cache": user_cache.stats(),
+        "activity": activity_sink.stats(),
+        "blob_cache": blob_cache.stats()
+    }
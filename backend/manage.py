@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import logging
+
+from core import db as database
+from services.storage import get_backend
+
+
+async def cmd_migrate_blobs(args):
+    from services.migrations import migrate_blobs
+    storage = get_backend(args.backend)
+    migrated = await migrate_blobs(database.db, storage, batch_size=args.batch_size)
+    print(f"Moved {migrated} blobs out of the 'files' collection into '{storage.name}' storage.")
+
+
+async def cmd_backfill_ancestors(args):
+    from services.folder_tree import backfill_ancestors
+    updated = await backfill_ancestors(database.db)
+    print(f"Updated the ancestors of {updated} folders.")
+
+
+async def cmd_reconcile_usage(args):
+    from services.usage import reconcile_usage
+    processed = await reconcile_usage(database.db)
+    print(f"Rebuilt the usage counters of {processed} users.")
+
+
+async def cmd_gc(args):
+    from services.maintenance import Maintenance
+    maintenance = Maintenance(database.db, batch_size=args.batch_size, pause=args.pause, dry_run=args.dry_run, backend=args.backend)
+    results = await maintenance.run(args.sweep, max_batches=args.max_batches)
+    verb = "Would reclaim" if args.dry_run else "Reclaimed"
+    for name, stats in results.items():
+        progress = "pass complete" if stats["completed"] else "will resume from here"
+        rehomed = f", {'would move' if args.dry_run else 'moved'} {stats['rehomed']} to the top level" if stats["rehomed"] else ""
+        print(f"{name}: scanned {stats['scanned']}, {verb.lower()} {stats['reclaimed']} ({stats['bytes']} bytes){rehomed}, {progress}")
+    print(f"{verb} {sum(s['bytes'] for s in results.values())} bytes in total.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SecSky maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate = subparsers.add_parser("migrate-blobs", help="Move encrypted_blob fields out of MongoDB documents")
+    migrate.add_argument("--backend", default=None, help="Target storage backend (defaults to STORAGE_BACKEND)")
+    migrate.add_argument("--batch-size", type=int, default=50)
+    migrate.set_defaults(func=cmd_migrate_blobs)
+
+    backfill = subparsers.add_parser("backfill-ancestors", help="Compute folder ancestor paths from parent_id")
+    backfill.set_defaults(func=cmd_backfill_ancestors)
+
+    reconcile = subparsers.add_parser("reconcile-usage", help="Rebuild per-user and per-folder usage counters")
+    reconcile.set_defaults(func=cmd_reconcile_usage)
+
+    gc = subparsers.add_parser("gc", help="Remove orphaned folders, files, activity logs and blobs")
+    gc.add_argument("--sweep", action="append", choices=["orphan_folders", "orphan_files", "orphan_activity", "orphan_blobs"],
+                    help="Sweep to run (repeatable; defaults to all)")
+    gc.add_argument("--backend", default=None, help="Blob storage backend to sweep (defaults to STORAGE_BACKEND)")
+    gc.add_argument("--batch-size", type=int, default=None)
+    gc.add_argument("--pause", type=float, default=None, help="Seconds between batches (defaults to GC_BATCH_PAUSE_SECONDS)")
+    gc.add_argument("--max-batches", type=int, default=None, help="Stop each sweep after this many batches; the next run resumes")
+    gc.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+    gc.set_defaults(func=cmd_gc)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    database.connect()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
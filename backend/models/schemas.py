@@ -32,8 +32,17 @@ class FileKeyUpdate(BaseModel):
     key_wrap_iv: str
     encrypted_filename: str
     filename_iv: str
+    # Blind-index tokens re-derived under the new key; omitted keeps the current ones
+    search_tokens: Optional[list[str]] = None
 
 class ChangeMasterPassword(BaseModel):
     salt: str
     vault_metadata: str
     file_updates: list[FileKeyUpdate]
+
+class KeyRotationStart(BaseModel):
+    salt: str
+    vault_metadata: str
+
+class KeyRotationBatch(BaseModel):
+    file_updates: list[FileKeyUpdate]
@@ -1,11 +1,12 @@
 import asyncio
-from core.db import client
+from core import db as database
 from core.config import settings
 
 async def reset_db():
     print(f"Connecting to MongoDB at {settings.MONGODB_URI}...")
-    await client.drop_database('secure_vault')
-    print("Successfully dropped the 'secure_vault' database. All users and files are cleared.")
+    database.connect()
+    await database.client.drop_database(settings.MONGO_DB_NAME)
+    print(f"Successfully dropped the '{settings.MONGO_DB_NAME}' database. All users and files are cleared.")
 
 if __name__ == "__main__":
     asyncio.run(reset_db())
@@ -1,24 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Response, Request
+from fastapi import APIRouter, Depends, HTTPException, status, Response
 from core.db import get_db
-from models.schemas import UserCreate, UserLogin, UserResponse, ChangeLoginPassword, ChangeMasterPassword
-from security.auth import get_password_hash, verify_password, create_access_token
+from models.schemas import UserCreate, UserLogin, UserResponse, ChangeLoginPassword, ChangeMasterPassword, KeyRotationStart, KeyRotationBatch
+from core.config import settings
+from pymongo import ReturnDocument, UpdateOne
+from security.auth import password_hasher, create_access_token
+from security.user_cache import user_cache
+from services import journal, key_rotation
+from services.search import clean_tokens
+from services.repositories import get_repositories
 from bson import ObjectId
+import asyncio
 import uuid
+import datetime
 
 router = APIRouter(prefix="/api/auth", tags=["Auth"])
 
 @router.post("/register", response_model=UserResponse)
-async def register(user: UserCreate, response: Response, db=Depends(get_db)):
+async def register(user: UserCreate, response: Response, repos=Depends(get_repositories)):
     try:
-        existing_user = await db.users.find_one({"email": user.email})
+        existing_user = await repos.users.by_email(user.email)
         if existing_user:
             raise HTTPException(status_code=400, detail="Email already registered")
 
         user_dict = user.model_dump()
-        user_dict["hashed_password"] = get_password_hash(user_dict.pop("password"))
+        user_dict["hashed_password"] = await password_hasher.hash(user_dict.pop("password"))
         user_dict["_id"] = str(uuid.uuid4()) # use uuid strings for easier mapping than objectid
 
-        await db.users.insert_one(user_dict)
+        await repos.users.insert(user_dict)
         
         # Auto-login after registration
         access_token = create_access_token(data={"sub": user_dict["email"], "id": user_dict["_id"]})
@@ -40,14 +48,25 @@ async def register(user: UserCreate, response: Response, db=Depends(get_db)):
         raise HTTPException(status_code=500, detail={"error": "Internal Server Error", "message": "An unexpected error occurred during user registration."})
 
 @router.post("/login")
-async def login(user: UserLogin, response: Response, db=Depends(get_db)):
-    db_user = await db.users.find_one({"email": user.email})
-    if not db_user or not verify_password(user.password, db_user["hashed_password"]):
+async def login(user: UserLogin, response: Response, repos=Depends(get_repositories)):
+    db_user = await repos.users.by_email(user.email)
+    if not db_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    verified, new_hash = await password_hasher.verify_and_update(user.password, db_user["hashed_password"])
+    if not verified:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect email or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if new_hash:
+        # Stored hash used an outdated bcrypt cost; upgrade it while we have the plaintext
+        await repos.users.update(db_user["_id"], {"hashed_password": new_hash})
+        await user_cache.invalidate_user(db_user["_id"])
     
     access_token = create_access_token(data={"sub": db_user["email"], "id": db_user["_id"]})
     response.set_cookie(
@@ -70,28 +89,10 @@ async def logout(response: Response):
     response.delete_cookie("access_token", httponly=True, secure=True, samesite="none")
     return {"message": "Logged out successfully"}
 
+from routers.files import get_current_user
+
 @router.get("/me", response_model=UserResponse)
-async def read_users_me(request: Request, db=Depends(get_db)):
-    from jose import jwt, JWTError
-    from core.config import settings
-    
-    token = request.cookies.get("access_token")
-    if not token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-        
-    try:
-        scheme, _, token_value = token.partition(" ")
-        payload = jwt.decode(token_value, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-        user_id: str = payload.get("id")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid auth credentials")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid auth credentials")
-        
-    user = await db.users.find_one({"_id": user_id})
-    if user is None:
-        raise HTTPException(status_code=404, detail="User not found")
-        
+async def read_users_me(user=Depends(get_current_user)):
     return UserResponse(
         id=user["_id"],
         email=user["email"],
@@ -99,42 +100,184 @@ async def read_users_me(request: Request, db=Depends(get_db)):
         vault_metadata=user.get("vault_metadata")
     )
 
-from routers.files import get_current_user
-
 @router.put("/login-password")
-async def change_login_password(request_data: ChangeLoginPassword, user=Depends(get_current_user), db=Depends(get_db)):
-    if not verify_password(request_data.old_password, user["hashed_password"]):
+async def change_login_password(request_data: ChangeLoginPassword, user=Depends(get_current_user),
+                                repos=Depends(get_repositories)):
+    if not await password_hasher.verify(request_data.old_password, user["hashed_password"]):
         raise HTTPException(status_code=400, detail="Incorrect old password")
     
-    hashed_password = get_password_hash(request_data.new_password)
-    await db.users.update_one({"_id": user["_id"]}, {"$set": {"hashed_password": hashed_password}})
+    hashed_password = await password_hasher.hash(request_data.new_password)
+    await repos.users.update(user["_id"], {"hashed_password": hashed_password})
+    await user_cache.invalidate_user(user["_id"])
     return {"message": "Login password updated successfully"}
 
 @router.put("/master-password")
-async def change_master_password(request_data: ChangeMasterPassword, user=Depends(get_current_user), db=Depends(get_db)):
-    # 1. Update User's salt and vault_metadata
-    await db.users.update_one(
-        {"_id": user["_id"]},
-        {"$set": {"salt": request_data.salt, "vault_metadata": request_data.vault_metadata}}
-    )
-    
-    # 2. Update all file keys
-    # To be efficient, we can do bulk update
-    from pymongo import UpdateOne
-    if request_data.file_updates:
-        bulk_ops = [
-            UpdateOne(
-                {"_id": update.file_id, "user_id": user["_id"]},
-                {"$set": {
-                    "encrypted_file_key": update.encrypted_file_key,
-                    "key_wrap_iv": update.key_wrap_iv,
-                    "filename": update.encrypted_filename,
-                    "filename_iv": update.filename_iv
-                }}
-            )
-            for update in request_data.file_updates
-        ]
-        if bulk_ops:
-            await db.files.bulk_write(bulk_ops)
-            
+async def change_master_password(request_data: ChangeMasterPassword, user=Depends(get_current_user),
+                                 db=Depends(get_db), repos=Depends(get_repositories)):
+    # Single-request rotation, run as a rotation job: the keys are staged first and the
+    # salt only changes at the commit point, so a failure part way leaves the vault as it was
+    job = await create_rotation_job(db, user, request_data.salt, request_data.vault_metadata)
+    try:
+        await stage_rotated_keys(db, user, job["_id"], request_data.file_updates)
+        staged = await db.files.count_documents({"user_id": user["_id"], "pending_key.job_id": job["_id"]})
+        await db.key_rotations.update_one(
+            {"_id": job["_id"]}, {"$set": {"status": "committing", "applied_files": staged}}
+        )
+    except BaseException:
+        await asyncio.shield(key_rotation.discard_key_rotation(db, user["_id"], job["_id"]))
+        raise
+    # From here on it is the same commit as the batched flow's, finished by the next request if interrupted
+    await key_rotation.commit_user_keys(repos, user["_id"], job)
+    await key_rotation.finish_key_rotation(db, repos, user["_id"], job["_id"])
     return {"message": "Master password and keys updated successfully"}
+
+# Resumable master-password rotation. Re-wrapped keys are staged on each file under
+# `pending_key` in bounded batches; nothing the client reads changes until commit,
+# which swaps the salt in one user-document update (see services/key_rotation.py).
+
+async def get_rotation_job(db, job_id: str, user) -> dict:
+    job = await db.key_rotations.find_one({"_id": job_id, "user_id": user["_id"]})
+    if not job:
+        raise HTTPException(status_code=404, detail="Rotation job not found")
+    return job
+
+async def create_rotation_job(db, user, salt: str, vault_metadata: str) -> dict:
+    # One rotation at a time: a second one could commit its salt over the other's
+    active = await db.key_rotations.find_one({"user_id": user["_id"], "status": {"$in": ["open", "committing"]}}, {"_id": 1})
+    if active:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "A key rotation is already in progress", "job_id": active["_id"]}
+        )
+
+    now = datetime.datetime.utcnow()
+    job = {
+        "_id": str(uuid.uuid4()),
+        "user_id": user["_id"],
+        "salt": salt,
+        "vault_metadata": vault_metadata,
+        "status": "open",
+        "applied_batches": [],
+        "applied_files": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+    await db.key_rotations.insert_one(job)
+    return job
+
+async def stage_rotated_keys(db, user, job_id: str, file_updates: list):
+    # Validated before anything is staged so a bad batch changes nothing
+    staged_tokens = [clean_tokens(update.search_tokens) for update in file_updates]
+    if not file_updates:
+        return
+    await db.files.bulk_write([
+        UpdateOne(
+            {"_id": update.file_id, "user_id": user["_id"]},
+            {"$set": {"pending_key": {
+                "job_id": job_id,
+                "encrypted_file_key": update.encrypted_file_key,
+                "key_wrap_iv": update.key_wrap_iv,
+                "filename": update.encrypted_filename,
+                "filename_iv": update.filename_iv,
+                "search_tokens": tokens
+            }}}
+        )
+        for update, tokens in zip(file_updates, staged_tokens)
+    ], ordered=False)
+
+async def rotation_progress(db, job: dict):
+    if job["status"] == "open":
+        # Counted rather than tallied per batch, so files resubmitted in another batch count once
+        applied = await db.files.count_documents({"user_id": job["user_id"], "pending_key.job_id": job["_id"]})
+        pending = await db.files.count_documents({"user_id": job["user_id"], "pending_key.job_id": {"$ne": job["_id"]}})
+    else:
+        # Fixed when the job left "open"; the staged keys are promoted (or dropped) after that
+        applied, pending = job.get("applied_files", 0), 0
+    return {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "applied_batches": sorted(job.get("applied_batches", [])),
+        "applied_files": applied,
+        "pending_files": pending,
+        "batch_size": settings.KEY_ROTATION_BATCH_SIZE
+    }
+
+@router.post("/master-password/rotations")
+async def start_key_rotation(request_data: KeyRotationStart, user=Depends(get_current_user), db=Depends(get_db)):
+    job = await create_rotation_job(db, user, request_data.salt, request_data.vault_metadata)
+    return await rotation_progress(db, job)
+
+@router.get("/master-password/rotations/{job_id}")
+async def get_key_rotation(job_id: str, user=Depends(get_current_user), db=Depends(get_db)):
+    return await rotation_progress(db, await get_rotation_job(db, job_id, user))
+
+@router.get("/master-password/rotations/{job_id}/pending")
+async def list_pending_rotation_files(job_id: str, limit: int = 500, user=Depends(get_current_user), db=Depends(get_db)):
+    # Files still wrapped only with the old key; a resumed client re-wraps these next
+    job = await get_rotation_job(db, job_id, user)
+    limit = max(1, min(limit, settings.KEY_ROTATION_BATCH_SIZE))
+    files = await db.files.find(
+        {"user_id": user["_id"], "pending_key.job_id": {"$ne": job["_id"]}},
+        {"encrypted_file_key": 1, "key_wrap_iv": 1, "filename": 1, "filename_iv": 1}
+    ).sort("_id", 1).limit(limit).to_list(length=limit)
+    for f in files:
+        f["id"] = f.pop("_id")
+    return files
+
+@router.put("/master-password/rotations/{job_id}/batches/{seq}")
+async def apply_key_rotation_batch(job_id: str, seq: int, request_data: KeyRotationBatch, user=Depends(get_current_user), db=Depends(get_db)):
+    job = await get_rotation_job(db, job_id, user)
+    if job["status"] != "open":
+        raise HTTPException(status_code=409, detail=f"Rotation job is {job['status']}")
+    if len(request_data.file_updates) > settings.KEY_ROTATION_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {settings.KEY_ROTATION_BATCH_SIZE} files per batch")
+    if seq in job.get("applied_batches", []):
+        # Retried batch: the staged keys are already in place
+        return await rotation_progress(db, job)
+
+    await stage_rotated_keys(db, user, job_id, request_data.file_updates)
+
+    job = await db.key_rotations.find_one_and_update(
+        {"_id": job_id, "applied_batches": {"$ne": seq}},
+        {
+            "$addToSet": {"applied_batches": seq},
+            "$set": {"updated_at": datetime.datetime.utcnow()}
+        },
+        return_document=ReturnDocument.AFTER
+    ) or await get_rotation_job(db, job_id, user)
+    return await rotation_progress(db, job)
+
+@router.post("/master-password/rotations/{job_id}/commit")
+async def commit_key_rotation(job_id: str, user=Depends(get_current_user), db=Depends(get_db),
+                              repos=Depends(get_repositories)):
+    job = await get_rotation_job(db, job_id, user)
+    if job["status"] == "committed":
+        return await rotation_progress(db, job)
+    if job["status"] not in ("open", "committing"):
+        raise HTTPException(status_code=409, detail=f"Rotation job is {job['status']}")
+
+    if job["status"] == "open":
+        pending = await db.files.count_documents({"user_id": user["_id"], "pending_key.job_id": {"$ne": job_id}})
+        if pending:
+            raise HTTPException(
+                status_code=409,
+                detail={"message": "Some files have not been re-wrapped yet", "pending_files": pending}
+            )
+        staged = await db.files.count_documents({"user_id": user["_id"], "pending_key.job_id": job_id})
+        await db.key_rotations.update_one(
+            {"_id": job_id, "status": "open"}, {"$set": {"status": "committing", "applied_files": staged}}
+        )
+
+    # The user update is the commit point; promoting the staged keys afterwards is
+    # idempotent and is finished by the next request if this one is interrupted
+    await key_rotation.commit_user_keys(repos, user["_id"], job)
+    job = await key_rotation.finish_key_rotation(db, repos, user["_id"], job_id)
+    return await rotation_progress(db, job)
+
+@router.delete("/master-password/rotations/{job_id}")
+async def abort_key_rotation(job_id: str, user=Depends(get_current_user), db=Depends(get_db)):
+    job = await get_rotation_job(db, job_id, user)
+    if job["status"] != "open":
+        raise HTTPException(status_code=409, detail=f"Rotation job is {job['status']}")
+    await key_rotation.discard_key_rotation(db, user["_id"], job_id)
+    return {"message": "Key rotation aborted"}
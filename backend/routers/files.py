@@ -1,47 +1,147 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request, Response
-from pydantic import BaseModel
-from core.db import get_db
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request, Query, Header
+from pydantic import BaseModel, Field
+from pymongo import UpdateOne, DeleteOne
+from core.db import get_db, get_read_db
 import uuid
 import datetime
-from jose import jwt, JWTError
 from core.config import settings
-from pathlib import Path
-
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
+from core.middleware import MULTIPART_OVERHEAD
+from security.auth import token_user_id
+from security.user_cache import user_cache
+from services.blob_cache import blob_cache
+from services.storage import get_storage, get_backend, BlobTooLarge, DigestingStream
+from services.downloads import blob_response, BlobResponse
+from services.batch_download import stream_files, FORMAT as BATCH_FORMAT
+from services.folder_tree import subtree_query, require_folder
+from services.pagination import keyset_page, parse_fields, DEFAULT_PAGE_SIZE, ROOT
+from typing import Optional, Literal
+from services import journal
+from services.activity import activity_sink
+from services.bulk import BulkResults, MAX_BULK_OPERATIONS
+from services.metrics import blob_bytes
+from services import usage
+from services import key_rotation
+from services import idempotency
+from services.search import clean_tokens, token_query, MAX_QUERY_TOKENS
+from services.scheduler import scheduler, UPLOAD, DOWNLOAD
+from services.repositories import get_repositories, get_read_repositories
 
 router = APIRouter(prefix="/api/files", tags=["Files"])
 
-async def get_current_user(request: Request, db=Depends(get_db)):
+async def resolve_token_user(token: str, repos):
+    # Returns the user for a "Bearer <jwt>" cookie value, or None if the user no longer exists
+    user_id = token_user_id(token)
+    user = user_cache.get_user(user_id)
+    if user is None:
+        user = await repos.users.get(user_id)
+        if user:
+            user_cache.put_user(user)
+    return user
+
+async def get_current_user(request: Request, db=Depends(get_db), repos=Depends(get_repositories)):
     token = request.cookies.get("access_token")
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    try:
-        scheme, _, token_value = token.partition(" ")
-        payload = jwt.decode(token_value, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-        user_id: str = payload.get("id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = await db.users.find_one({"_id": user_id})
+    user = await resolve_token_user(token, repos)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
+    if getattr(request.state, "admitted_user", None) != user["_id"]:
+        # Uploads were already admitted by UploadAdmissionMiddleware, before their body was read
+        scheduler.admit(user["_id"])
+    if user.get("key_rotation_id"):
+        # A key rotation committed but was interrupted before its staged keys were promoted
+        await key_rotation.finish_key_rotation(db, repos, user["_id"], user["key_rotation_id"])
+        user = {**user, "key_rotation_id": None}
     return user
 
+def transfer_slot(direction: str):
+    # Holds one of the user's transfer slots until the handler returns, or until the
+    # body is sent when the slot is handed off to a streaming response
+    async def dependency(request: Request, user=Depends(get_current_user)):
+        transfer = getattr(request.state, "transfer", None)
+        if transfer is not None and transfer.user_id == user["_id"] and transfer.direction == direction:
+            # Opened (and released) by UploadAdmissionMiddleware
+            yield transfer
+            return
+        transfer = scheduler.open_transfer(user["_id"], direction)
+        try:
+            yield transfer
+        finally:
+            if not transfer.handed_off:
+                transfer.release()
+    return dependency
+
+upload_slot = transfer_slot(UPLOAD)
+download_slot = transfer_slot(DOWNLOAD)
+
+# Blobs of unmigrated documents, search tokens and staged rotation keys never go out in listings
+LIST_EXCLUDE = {"encrypted_blob": 0, "search_tokens": 0, "pending_key": 0}
+
 @router.get("/")
-async def list_files(user=Depends(get_current_user), db=Depends(get_db)):
+async def list_files(user=Depends(get_current_user), db=Depends(get_read_db)):
     files = await db.files.find(
         {"user_id": user["_id"]},
-        {"encrypted_blob": 0}
+        LIST_EXCLUDE
     ).to_list(length=1000)
     for f in files:
         f["id"] = f.pop("_id")
     return files
 
+FILE_LIST_FIELDS = {
+    "filename", "filename_iv", "file_size", "file_id", "encrypted_file_key", "file_iv",
+    "key_wrap_iv", "password_protected", "password_salt", "password_iv", "folder_id",
+    "created_at", "blob_size", "sha256"
+}
+
+@router.get("/page")
+async def list_files_page(
+    folder_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    fields: Optional[str] = None,
+    user=Depends(get_current_user),
+    db=Depends(get_read_db)
+):
+    # Cursor-paginated variant of list_files; folder_id=root selects top-level files
+    query = {"user_id": user["_id"]}
+    if folder_id is not None:
+        query["folder_id"] = None if folder_id == ROOT else folder_id
+    projection = parse_fields(fields, FILE_LIST_FIELDS) or LIST_EXCLUDE
+    return await keyset_page(db.files, query, projection, limit, cursor)
+
+@router.get("/search")
+async def search_files(
+    tokens: list[str] = Query(...),
+    match: Literal["all", "any"] = "all",
+    folder_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    fields: Optional[str] = None,
+    user=Depends(get_current_user),
+    db=Depends(get_read_db)
+):
+    # Candidates whose blind-index tokens match; the client decrypts the names to
+    # drop false positives. Served from the (user_id, search_tokens) index.
+    tokens = clean_tokens(tokens, MAX_QUERY_TOKENS)
+    if not tokens:
+        raise HTTPException(status_code=400, detail="At least one search token is required")
+    query = {"user_id": user["_id"], **token_query(tokens, match)}
+    if folder_id is not None:
+        query["folder_id"] = None if folder_id == ROOT else folder_id
+    projection = parse_fields(fields, FILE_LIST_FIELDS) or LIST_EXCLUDE
+    return await keyset_page(db.files, query, projection, limit, cursor)
+
+async def iter_upload_file(file: UploadFile, chunk_size: int):
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
 @router.post("/upload")
 async def upload_file(
+    request: Request,
     file: UploadFile = File(...),
     encrypted_file_key: str = Form(...),
     file_iv: str = Form(...),
@@ -53,17 +153,69 @@ async def upload_file(
     password_iv: str = Form(None),
     folder_id: str = Form(None),
     original_size: int = Form(...),
+    search_tokens: list[str] = Form(None),
+    idempotency_key: Optional[str] = Header(None),
     user=Depends(get_current_user),
-    db=Depends(get_db)
+    transfer=Depends(upload_slot),
+    db=Depends(get_db),
+    repos=Depends(get_repositories),
+    storage=Depends(get_storage)
 ):
-    MAX_FILE_SIZE = 15 * 1024 * 1024 # 15 MB to fit in Mongo BSON limit and Render memory limit
-    
-    file_bytes = await file.read()
-    if len(file_bytes) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail="File too large. Maximum size is 15MB.")
-        
-    file_id = str(uuid.uuid4())
-        
+    search_tokens = clean_tokens(search_tokens)
+
+    async def store():
+        await require_folder(repos, user["_id"], folder_id)
+        # Refuse up front when the body alone can't fit; the conditional update in
+        # save_file_record is what actually enforces the quota
+        remaining = await usage.remaining_quota(db, user["_id"])
+        if remaining is not None and int(request.headers.get("content-length") or 0) - MULTIPART_OVERHEAD > remaining:
+            raise HTTPException(status_code=413, detail="Storage quota exceeded")
+
+        # Stream the ciphertext to storage chunk by chunk so memory stays bounded by
+        # UPLOAD_CHUNK_SIZE no matter how large the file is
+        file_id = str(uuid.uuid4())
+        stream = DigestingStream(
+            iter_upload_file(file, settings.UPLOAD_CHUNK_SIZE),
+            max_size=settings.MAX_UPLOAD_SIZE
+        )
+        try:
+            await storage.put_stream(file_id, stream)
+        except BlobTooLarge:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large. Maximum size is {settings.MAX_UPLOAD_SIZE // (1024 * 1024)}MB."
+            )
+        blob_bytes.inc(stream.size, direction="upload")
+
+        return await save_file_record(
+            db, repos, storage, user, file_id, stream,
+            encrypted_filename=encrypted_filename,
+            filename_iv=filename_iv,
+            original_size=original_size,
+            encrypted_file_key=encrypted_file_key,
+            file_iv=file_iv,
+            key_wrap_iv=key_wrap_iv,
+            requires_file_password=requires_file_password,
+            password_salt=password_salt,
+            password_iv=password_iv,
+            folder_id=folder_id,
+            search_tokens=search_tokens
+        )
+
+    # A retried upload carries the same ciphertext IVs, so they identify the request
+    request_hash = idempotency.fingerprint("upload", encrypted_filename, filename_iv, file_iv, key_wrap_iv, folder_id, original_size)
+    return await idempotency.run(db, user["_id"], idempotency_key, request_hash, store)
+
+async def save_file_record(
+    db, repos, storage, user, file_id: str, stream: DigestingStream, *,
+    encrypted_filename: str, filename_iv: str, original_size: int,
+    encrypted_file_key: str, file_iv: str, key_wrap_iv: str,
+    requires_file_password: bool, password_salt=None, password_iv=None, folder_id=None,
+    search_tokens=None, reserved: int = 0
+):
+    # Shared by the single-shot upload and the resumable upload sessions once the
+    # ciphertext is fully in storage under `file_id`; `reserved` is the quota an
+    # upload session set aside for it
     doc = {
         "_id": file_id,
         "user_id": user["_id"],
@@ -78,75 +230,140 @@ async def upload_file(
         "password_salt": password_salt,
         "password_iv": password_iv,
         "folder_id": folder_id,
-        "encrypted_blob": file_bytes,
+        "storage_backend": storage.name,
+        "storage_key": file_id,
+        "blob_size": stream.size,
+        "sha256": stream.sha256,
         "created_at": datetime.datetime.utcnow()
     }
+    if search_tokens:
+        doc["search_tokens"] = search_tokens
     
-    await db.files.insert_one(doc)
+    try:
+        await usage.charge_file(
+            db, user["_id"], stream.size, reserved=reserved, plaintext=original_size, uploaded_at=doc["created_at"]
+        )
+    except usage.QuotaExceeded:
+        await storage.delete(file_id)
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
+    try:
+        await repos.files.insert(doc)
+    except Exception:
+        await storage.delete(file_id)
+        refund = usage.UsageChange(user["_id"])
+        refund.remove_file(None, stream.size, original_size)
+        await refund.apply(db)
+        raise
+    change = usage.UsageChange(user["_id"])
+    change.add_file(folder_id, stream.size, user=False)
+    await change.apply(db)
     
     # Log upload activity
-    activity_doc = {
-        "_id": str(uuid.uuid4()),
-        "user_id": user["_id"],
-        "type": "UPLOAD",
-        "file_id": file_id,
-        "filename": encrypted_filename,
-        "timestamp": datetime.datetime.utcnow(),
-        "password_added": requires_file_password
-    }
-    await db.activity_logs.insert_one(activity_doc)
+    activity_sink.log(
+        user["_id"], "UPLOAD",
+        file_id=file_id,
+        filename=encrypted_filename,
+        password_added=requires_file_password
+    )
+    await journal.record_change(db, user["_id"], journal.FILE, file_id, journal.UPSERT)
     
+    return stored_response(file_id)
+
+def stored_response(file_id: str) -> dict:
     return {
-        "message": "File stored in MongoDB",
+        "message": "File stored",
         "file_id": file_id,
         "id": file_id
     }
 
 @router.get("/{file_id}/download")
-async def download_file(file_id: str, user=Depends(get_current_user), db=Depends(get_db)):
-    doc = await db.files.find_one({"_id": file_id, "user_id": user["_id"]})
+async def download_file(file_id: str, request: Request, user=Depends(get_current_user),
+                        transfer=Depends(download_slot), repos=Depends(get_repositories)):
+    doc = await repos.files.get_with_blob(user["_id"], file_id)
     if not doc:
         raise HTTPException(status_code=404, detail="File not found")
-        
-    if "encrypted_blob" not in doc:
-        # Backward compatibility attempt if it was locally stored but we wiped the server
-        raise HTTPException(status_code=404, detail="File content not found in database")
-        
-    return Response(
-        content=doc["encrypted_blob"],
-        media_type="application/octet-stream",
-        headers={"Content-Disposition": f"attachment; filename=\"{doc.get('filename', 'encrypted_file.bin')}\""}
+
+    # Streams from storage, honouring Range / If-None-Match against the ciphertext hash
+    return await blob_response(request, doc, transfer)
+
+class BatchDownloadRequest(BaseModel):
+    file_ids: Optional[list[str]] = Field(None, max_length=settings.BATCH_DOWNLOAD_MAX_FILES)
+    # Folder to download instead of file_ids; "root" selects top-level files
+    folder_id: Optional[str] = None
+    recursive: bool = False
+
+@router.post("/batch-download")
+async def batch_download(data: BatchDownloadRequest, user=Depends(get_current_user),
+                         transfer=Depends(download_slot), db=Depends(get_read_db),
+                         repos=Depends(get_read_repositories)):
+    # One request and one streamed response for many files; see services/batch_download.py for the framing
+    if (data.file_ids is None) == (data.folder_id is None):
+        raise HTTPException(status_code=400, detail="Provide either file_ids or folder_id")
+    query = {"user_id": user["_id"]}
+    if data.file_ids is not None:
+        requested = list(dict.fromkeys(data.file_ids))
+        query["_id"] = {"$in": requested}
+    elif data.folder_id == ROOT:
+        if not data.recursive:
+            query["folder_id"] = None
+    else:
+        folders = {"_id": data.folder_id, "user_id": user["_id"]}
+        if data.recursive:
+            folders = subtree_query(user["_id"], data.folder_id)
+        folder_ids = [f["_id"] for f in await db.folders.find(folders, {"_id": 1}).to_list(length=None)]
+        if not folder_ids:
+            raise HTTPException(status_code=404, detail="Folder not found")
+        query["folder_id"] = {"$in": folder_ids}
+
+    limit = settings.BATCH_DOWNLOAD_MAX_FILES
+    docs = await db.files.find(query, {"encrypted_blob": 0, "search_tokens": 0, "pending_key": 0}) \
+        .sort([("created_at", 1), ("_id", 1)]).limit(limit + 1).to_list(length=limit + 1)
+    if len(docs) > limit:
+        raise HTTPException(status_code=400, detail=f"Too many files for one batch (maximum {limit})")
+    not_found = []
+    if data.file_ids is not None:
+        by_id = {doc["_id"]: doc for doc in docs}
+        docs = [by_id[file_id] for file_id in requested if file_id in by_id]
+        not_found = [file_id for file_id in requested if file_id not in by_id]
+
+    return BlobResponse(
+        stream_files(repos, user["_id"], docs, settings.BATCH_DOWNLOAD_WINDOW, settings.BATCH_DOWNLOAD_PREFETCH_BYTES, not_found),
+        transfer=transfer,
+        headers={"X-Batch-Format": BATCH_FORMAT, "X-Batch-Count": str(len(docs)), "Cache-Control": "no-store"}
     )
 
 @router.get("/{file_id}")
-async def get_file_metadata(file_id: str, user=Depends(get_current_user), db=Depends(get_db)):
-    doc = await db.files.find_one(
-        {"_id": file_id, "user_id": user["_id"]},
-        {"encrypted_blob": 0}
-    )
+async def get_file_metadata(file_id: str, user=Depends(get_current_user), repos=Depends(get_read_repositories)):
+    doc = await repos.files.get(user["_id"], file_id)
     if not doc:
         raise HTTPException(status_code=404, detail="File not found")
     doc["id"] = doc.pop("_id")
     return doc
 
 @router.delete("/{file_id}")
-async def delete_file(file_id: str, user=Depends(get_current_user), db=Depends(get_db)):
-    doc = await db.files.find_one({"_id": file_id, "user_id": user["_id"]})
+async def delete_file(file_id: str, idempotency_key: Optional[str] = Header(None),
+                      user=Depends(get_current_user), db=Depends(get_db), repos=Depends(get_repositories)):
+    return await idempotency.run(
+        db, user["_id"], idempotency_key, idempotency.fingerprint("delete_file", file_id),
+        lambda: remove_file(file_id, user, db, repos)
+    )
+
+async def remove_file(file_id: str, user, db, repos):
+    # find_one_and_delete hands back what was removed, so there's no read beforehand
+    doc = await repos.files.delete(user["_id"], file_id)
     if not doc:
         raise HTTPException(status_code=404, detail="File not found")
-        
-    await db.files.delete_one({"_id": file_id})
+
+    change = usage.UsageChange(user["_id"])
+    change.remove_file(doc.get("folder_id"), usage.stored_size(doc), usage.plaintext_size(doc))
+    await change.apply(db)
+    if doc.get("storage_key"):
+        await get_backend(doc.get("storage_backend")).delete(doc["storage_key"])
+    blob_cache.invalidate(file_id)
     
     # Log delete activity
-    activity_doc = {
-        "_id": str(uuid.uuid4()),
-        "user_id": user["_id"],
-        "type": "DELETE",
-        "file_id": file_id,
-        "filename": doc.get("filename", "encrypted_file.bin"),
-        "timestamp": datetime.datetime.utcnow()
-    }
-    await db.activity_logs.insert_one(activity_doc)
+    activity_sink.log(user["_id"], "DELETE", file_id=file_id, filename=doc.get("filename", "encrypted_file.bin"))
+    await journal.record_change(db, user["_id"], journal.FILE, file_id, journal.DELETE)
     
     return {"message": "File deleted"}
 
@@ -154,25 +371,142 @@ class FileMove(BaseModel):
     folder_id: str | None = None
 
 @router.put("/{file_id}/move")
-async def move_file(file_id: str, data: FileMove, user=Depends(get_current_user), db=Depends(get_db)):
-    doc = await db.files.find_one({"_id": file_id, "user_id": user["_id"]})
+async def move_file(file_id: str, data: FileMove, idempotency_key: Optional[str] = Header(None),
+                    user=Depends(get_current_user), db=Depends(get_db), repos=Depends(get_repositories)):
+    return await idempotency.run(
+        db, user["_id"], idempotency_key, idempotency.fingerprint("move_file", file_id, data.folder_id),
+        lambda: relocate_file(file_id, data, user, db, repos)
+    )
+
+async def relocate_file(file_id: str, data: FileMove, user, db, repos):
+    await require_folder(repos, user["_id"], data.folder_id)
+    # One round trip: the update returns the document as it was, old folder included.
+    # `moved_at` restarts the grace period of the orphan sweep
+    doc = await repos.files.update(
+        user["_id"], file_id, {"folder_id": data.folder_id, "moved_at": datetime.datetime.utcnow()}
+    )
     if not doc:
         raise HTTPException(status_code=404, detail="File not found")
 
-    await db.files.update_one(
-        {"_id": file_id},
-        {"$set": {"folder_id": data.folder_id}}
-    )
+    change = usage.UsageChange(user["_id"])
+    change.move_file(doc.get("folder_id"), data.folder_id, usage.stored_size(doc))
+    await change.apply(db)
     
     # Log activity
-    activity_doc = {
-        "_id": str(uuid.uuid4()),
-        "user_id": user["_id"],
-        "type": "MOVE",
-        "file_id": file_id,
-        "filename": doc.get("filename", "encrypted_file.bin"),
-        "timestamp": datetime.datetime.utcnow()
-    }
-    await db.activity_logs.insert_one(activity_doc)
+    activity_sink.log(user["_id"], "MOVE", file_id=file_id, filename=doc.get("filename", "encrypted_file.bin"))
+    await journal.record_change(db, user["_id"], journal.FILE, file_id, journal.UPSERT)
     
     return {"message": "File moved"}
+
+class FileRename(BaseModel):
+    encrypted_filename: str
+    filename_iv: str
+    search_tokens: Optional[list[str]] = None
+
+def rename_fields(encrypted_filename: str, filename_iv: str, search_tokens: Optional[list[str]]) -> dict:
+    fields = {"filename": encrypted_filename, "filename_iv": filename_iv}
+    if search_tokens is not None:
+        fields["search_tokens"] = search_tokens
+    return fields
+
+@router.put("/{file_id}/rename")
+async def rename_file(file_id: str, data: FileRename, user=Depends(get_current_user),
+                      db=Depends(get_db), repos=Depends(get_repositories)):
+    fields = rename_fields(data.encrypted_filename, data.filename_iv, clean_tokens(data.search_tokens))
+    if not await repos.files.update(user["_id"], file_id, fields):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    activity_sink.log(user["_id"], "RENAME", file_id=file_id, filename=data.encrypted_filename)
+    await journal.record_change(db, user["_id"], journal.FILE, file_id, journal.UPSERT)
+
+    return {"message": "File renamed"}
+
+class FileBulkOperation(BaseModel):
+    op: Literal["move", "delete", "rename"]
+    file_id: str
+    folder_id: Optional[str] = None
+    encrypted_filename: Optional[str] = None
+    filename_iv: Optional[str] = None
+    search_tokens: Optional[list[str]] = None
+
+class FileBulkRequest(BaseModel):
+    operations: list[FileBulkOperation] = Field(..., max_length=MAX_BULK_OPERATIONS)
+    ordered: bool = False
+
+@router.post("/bulk")
+async def bulk_files(data: FileBulkRequest, user=Depends(get_current_user), db=Depends(get_db),
+                     repos=Depends(get_repositories)):
+    results = BulkResults([op.file_id for op in data.operations], data.ordered)
+
+    # One query validates ownership of every file in the request
+    ids = list({op.file_id for op in data.operations})
+    docs = {
+        doc["_id"]: doc
+        for doc in await db.files.find(
+            {"_id": {"$in": ids}, "user_id": user["_id"]},
+            {"filename": 1, "storage_backend": 1, "storage_key": 1, "folder_id": 1, "blob_size": 1, "file_size": 1}
+        ).to_list(length=len(ids))
+    }
+
+    # ...and one more checks every folder a file is being moved into
+    targets = [op.folder_id for op in data.operations if op.op == "move" and op.folder_id]
+    folders = {folder["_id"] for folder in await repos.folders.get_many(user["_id"], targets)} if targets else set()
+
+    deleted = set()
+    now = datetime.datetime.utcnow()
+    for index, op in enumerate(data.operations):
+        if results.stopped:
+            break
+        doc = docs.get(op.file_id)
+        if not doc or op.file_id in deleted:
+            results.fail(index, "File not found")
+            continue
+        selector = {"_id": op.file_id, "user_id": user["_id"]}
+        if op.op == "move":
+            if op.folder_id and op.folder_id not in folders:
+                results.fail(index, "Folder not found")
+                continue
+            results.add(index, UpdateOne(selector, {"$set": {"folder_id": op.folder_id, "moved_at": now}}))
+        elif op.op == "rename":
+            if not op.encrypted_filename or not op.filename_iv:
+                results.fail(index, "encrypted_filename and filename_iv are required")
+                continue
+            try:
+                tokens = clean_tokens(op.search_tokens)
+            except HTTPException as exc:
+                results.fail(index, exc.detail)
+                continue
+            results.add(index, UpdateOne(selector, {"$set": rename_fields(op.encrypted_filename, op.filename_iv, tokens)}))
+            doc["filename"] = op.encrypted_filename
+        else:
+            results.add(index, DeleteOne(selector))
+            deleted.add(op.file_id)
+
+    succeeded = await results.execute(db.files)
+
+    changes = []
+    change = usage.UsageChange(user["_id"])
+    for index in succeeded:
+        op = data.operations[index]
+        doc = docs[op.file_id]
+        if op.op == "delete":
+            if doc.get("storage_key"):
+                await get_backend(doc.get("storage_backend")).delete(doc["storage_key"])
+            blob_cache.invalidate(op.file_id)
+            change.remove_file(doc.get("folder_id"), usage.stored_size(doc), usage.plaintext_size(doc))
+            changes.append((journal.FILE, op.file_id, journal.DELETE))
+        else:
+            if op.op == "move":
+                # Later operations in the same request see where this one left the file
+                change.move_file(doc.get("folder_id"), op.folder_id, usage.stored_size(doc))
+                doc["folder_id"] = op.folder_id
+            changes.append((journal.FILE, op.file_id, journal.UPSERT))
+        activity_sink.log(
+            user["_id"], {"move": "MOVE", "delete": "DELETE", "rename": "RENAME"}[op.op],
+            file_id=op.file_id,
+            filename=doc.get("filename", "encrypted_file.bin")
+        )
+    await change.apply(db)
+    await journal.record_changes(db, user["_id"], changes)
+
+    return results.response()
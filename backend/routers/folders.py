@@ -1,8 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
-from typing import Optional
-from core.db import get_db
+from fastapi import APIRouter, Depends, HTTPException, Header
+from pydantic import BaseModel, Field
+from pymongo import UpdateOne, DeleteOne
+from typing import Optional, Literal
+from core.db import get_db, get_read_db
 from routers.files import get_current_user
+from services import journal
+from services.activity import activity_sink
+from services.bulk import BulkResults, MAX_BULK_OPERATIONS
+from services import folder_tree
+from services import usage
+from services import idempotency
+from services.blob_cache import blob_cache
+from services.storage import get_backend
+from services.pagination import keyset_page, parse_fields, DEFAULT_PAGE_SIZE, ROOT
+from services.repositories import get_repositories
 import uuid
 import datetime
 
@@ -21,14 +32,39 @@ class FolderRename(BaseModel):
     name_iv: str
 
 @router.get("/")
-async def list_folders(user=Depends(get_current_user), db=Depends(get_db)):
+async def list_folders(user=Depends(get_current_user), db=Depends(get_read_db)):
     folders = await db.folders.find({"user_id": user["_id"]}).to_list(length=1000)
     for f in folders:
         f["id"] = f.pop("_id")
     return folders
 
+FOLDER_LIST_FIELDS = {"name_encrypted", "name_iv", "parent_id", "created_at", "usage"}
+
+@router.get("/page")
+async def list_folders_page(
+    parent_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    fields: Optional[str] = None,
+    user=Depends(get_current_user),
+    db=Depends(get_read_db)
+):
+    # Cursor-paginated variant of list_folders; parent_id=root selects top-level folders
+    query = {"user_id": user["_id"]}
+    if parent_id is not None:
+        query["parent_id"] = None if parent_id == ROOT else parent_id
+    return await keyset_page(db.folders, query, parse_fields(fields, FOLDER_LIST_FIELDS), limit, cursor)
+
 @router.post("/")
-async def create_folder(folder: FolderCreate, user=Depends(get_current_user), db=Depends(get_db)):
+async def create_folder(folder: FolderCreate, idempotency_key: Optional[str] = Header(None),
+                        user=Depends(get_current_user), db=Depends(get_db), repos=Depends(get_repositories)):
+    return await idempotency.run(
+        db, user["_id"], idempotency_key, idempotency.fingerprint("create_folder", folder.model_dump()),
+        lambda: insert_folder(folder, user, db, repos)
+    )
+
+async def insert_folder(folder: FolderCreate, user, db, repos):
+    ancestors = await folder_tree.ancestors_for_parent(repos, user["_id"], folder.parent_id)
     folder_id = str(uuid.uuid4())
     doc = {
         "_id": folder_id,
@@ -36,67 +72,278 @@ async def create_folder(folder: FolderCreate, user=Depends(get_current_user), db
         "name_encrypted": folder.name_encrypted,
         "name_iv": folder.name_iv,
         "parent_id": folder.parent_id,
+        "ancestors": ancestors,
+        "usage": dict(usage.EMPTY_USAGE),
         "created_at": datetime.datetime.utcnow()
     }
-    await db.folders.insert_one(doc)
+    await repos.folders.insert(doc)
+    change = usage.UsageChange(user["_id"])
+    change.add_folder(folder.parent_id)
+    await change.apply(db)
     
     # Log activity
-    await db.activity_logs.insert_one({
-        "_id": str(uuid.uuid4()),
-        "user_id": user["_id"],
-        "type": "CREATE_FOLDER",
-        "folder_id": folder_id,
-        "timestamp": datetime.datetime.utcnow()
-    })
+    activity_sink.log(user["_id"], "CREATE_FOLDER", folder_id=folder_id)
+    await journal.record_change(db, user["_id"], journal.FOLDER, folder_id, journal.UPSERT)
     
     doc["id"] = doc.pop("_id")
     return doc
 
 @router.put("/{folder_id}/move")
-async def move_folder(folder_id: str, data: FolderMove, user=Depends(get_current_user), db=Depends(get_db)):
-    result = await db.folders.update_one(
-        {"_id": folder_id, "user_id": user["_id"]},
-        {"$set": {"parent_id": data.parent_id}}
+async def move_folder(folder_id: str, data: FolderMove, idempotency_key: Optional[str] = Header(None),
+                      user=Depends(get_current_user), db=Depends(get_db), repos=Depends(get_repositories)):
+    return await idempotency.run(
+        db, user["_id"], idempotency_key, idempotency.fingerprint("move_folder", folder_id, data.parent_id),
+        lambda: relocate_folder(folder_id, data, user, db, repos)
     )
-    if result.matched_count == 0:
+
+async def relocate_folder(folder_id: str, data: FolderMove, user, db, repos):
+    # The folder and its new parent come back in one query; the folder and its whole
+    # subtree are then rewritten with one bulk_write, regardless of depth
+    ids = [folder_id] + ([data.parent_id] if data.parent_id else [])
+    docs = {doc["_id"]: doc for doc in await repos.folders.get_many(user["_id"], ids)}
+    if folder_id not in docs:
         raise HTTPException(status_code=404, detail="Folder not found")
+    new_ancestors = []
+    if data.parent_id:
+        if data.parent_id not in docs:
+            raise HTTPException(status_code=404, detail="Parent folder not found")
+        new_ancestors = docs[data.parent_id].get("ancestors", []) + [data.parent_id]
+    folder_tree.check_move(folder_id, data.parent_id, new_ancestors)
+
+    await db.folders.bulk_write(
+        folder_tree.move_models(user["_id"], folder_id, data.parent_id, new_ancestors),
+        ordered=True
+    )
+    change = usage.UsageChange(user["_id"])
+    change.move_folder(docs[folder_id].get("parent_id"), data.parent_id)
+    await change.apply(db)
+    # Every descendant's `ancestors` was rewritten too, so synced clients need them all
+    descendants = await folder_tree.descendant_ids(db, user["_id"], [folder_id])
+    await journal.record_changes(
+        db, user["_id"], [(journal.FOLDER, fid, journal.UPSERT) for fid in [folder_id] + descendants]
+    )
     
     return {"message": "Folder moved"}
 
 @router.put("/{folder_id}/rename")
-async def rename_folder(folder_id: str, data: FolderRename, user=Depends(get_current_user), db=Depends(get_db)):
-    result = await db.folders.update_one(
-        {"_id": folder_id, "user_id": user["_id"]},
-        {"$set": {"name_encrypted": data.name_encrypted, "name_iv": data.name_iv}}
+async def rename_folder(folder_id: str, data: FolderRename, user=Depends(get_current_user),
+                        db=Depends(get_db), repos=Depends(get_repositories)):
+    renamed = await repos.folders.update(
+        user["_id"], folder_id, {"name_encrypted": data.name_encrypted, "name_iv": data.name_iv}
     )
-    if result.matched_count == 0:
+    if not renamed:
         raise HTTPException(status_code=404, detail="Folder not found")
     
     # Log activity
-    await db.activity_logs.insert_one({
-        "_id": str(uuid.uuid4()),
-        "user_id": user["_id"],
-        "type": "RENAME_FOLDER",
-        "folder_id": folder_id,
-        "timestamp": datetime.datetime.utcnow()
-    })
+    activity_sink.log(user["_id"], "RENAME_FOLDER", folder_id=folder_id)
+    await journal.record_change(db, user["_id"], journal.FOLDER, folder_id, journal.UPSERT)
     
     return {"message": "Folder renamed"}
 
+@router.get("/{folder_id}/tree")
+async def get_folder_tree(folder_id: str, user=Depends(get_current_user), db=Depends(get_read_db)):
+    # The folder, every folder below it and all of their files, in two queries
+    folders = await db.folders.find(folder_tree.subtree_query(user["_id"], folder_id)).to_list(length=None)
+    if not any(f["_id"] == folder_id for f in folders):
+        raise HTTPException(status_code=404, detail="Folder not found")
+    files = await db.files.find(
+        {"user_id": user["_id"], "folder_id": {"$in": [f["_id"] for f in folders]}},
+        {"encrypted_blob": 0, "pending_key": 0}
+    ).to_list(length=None)
+    for doc in folders + files:
+        doc["id"] = doc.pop("_id")
+    return {"folders": folders, "files": files}
+
 @router.delete("/{folder_id}")
-async def delete_folder(folder_id: str, user=Depends(get_current_user), db=Depends(get_db)):
-    # To properly delete a folder, one should delete all contents or just throw error if not empty
-    # MVP: just delete the folder record. Frontend can block deleting non-empty folders.
-    
+async def delete_folder(folder_id: str, recursive: bool = False, user=Depends(get_current_user),
+                        db=Depends(get_db), repos=Depends(get_repositories)):
+    if recursive:
+        return await delete_folder_tree(db, user, folder_id)
+
     # Check if folder has children (files or folders)
-    has_files = await db.files.find_one({"folder_id": folder_id, "user_id": user["_id"]})
-    has_subfolders = await db.folders.find_one({"parent_id": folder_id, "user_id": user["_id"]})
+    has_files = await db.files.find_one({"folder_id": folder_id, "user_id": user["_id"]}, {"_id": 1})
+    has_subfolders = await db.folders.find_one({"parent_id": folder_id, "user_id": user["_id"]}, {"_id": 1})
     
     if has_files or has_subfolders:
         raise HTTPException(status_code=400, detail="Folder is not empty")
 
-    result = await db.folders.delete_one({"_id": folder_id, "user_id": user["_id"]})
-    if result.deleted_count == 0:
+    deleted = await repos.folders.delete(user["_id"], folder_id)
+    if not deleted:
         raise HTTPException(status_code=404, detail="Folder not found")
+    change = usage.UsageChange(user["_id"])
+    change.remove_folder(deleted.get("parent_id"))
+    await change.apply(db)
+    await journal.record_change(db, user["_id"], journal.FOLDER, folder_id, journal.DELETE)
 
     return {"message": "Folder deleted"}
+
+async def delete_folder_tree(db, user, folder_id: str):
+    folders = await db.folders.find(
+        folder_tree.subtree_query(user["_id"], folder_id), {"parent_id": 1}
+    ).to_list(length=None)
+    root = next((f for f in folders if f["_id"] == folder_id), None)
+    if not root:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    folder_ids = [f["_id"] for f in folders]
+
+    in_subtree = {"user_id": user["_id"], "folder_id": {"$in": folder_ids}}
+    fields = {"filename": 1, "storage_backend": 1, "storage_key": 1, "blob_size": 1, "file_size": 1}
+    files = await db.files.find(in_subtree, fields).to_list(length=None)
+
+    # Metadata goes first so nothing can reference a blob once it is being removed. Deleting
+    # by id removes exactly the files whose blobs and usage are released below
+    await db.files.delete_many({"user_id": user["_id"], "_id": {"$in": [doc["_id"] for doc in files]}})
+    await db.folders.delete_many({"user_id": user["_id"], "_id": {"$in": folder_ids}})
+    # Files uploaded or moved into the subtree since it was read now point at deleted folders
+    late = await db.files.find(in_subtree, fields).to_list(length=None)
+    if late:
+        await db.files.delete_many({"user_id": user["_id"], "_id": {"$in": [doc["_id"] for doc in late]}})
+        files += late
+
+    # Counters of the deleted folders go with them; only the user totals and the
+    # parent of the subtree need adjusting
+    change = usage.UsageChange(user["_id"])
+    for doc in files:
+        change.remove_file(None, usage.stored_size(doc), usage.plaintext_size(doc))
+    change.remove_folder(root.get("parent_id"))
+    change.add_folder(None, 1 - len(folders))
+    await change.apply(db)
+    for doc in files:
+        if doc.get("storage_key"):
+            await get_backend(doc.get("storage_backend")).delete(doc["storage_key"])
+        blob_cache.invalidate(doc["_id"])
+        activity_sink.log(user["_id"], "DELETE", file_id=doc["_id"], filename=doc.get("filename", "encrypted_file.bin"))
+
+    await journal.record_changes(
+        db, user["_id"],
+        [(journal.FILE, doc["_id"], journal.DELETE) for doc in files]
+        + [(journal.FOLDER, fid, journal.DELETE) for fid in folder_ids]
+    )
+    return {"message": "Folder deleted", "deleted_folders": len(folder_ids), "deleted_files": len(files)}
+
+async def delete_if_empty(db, results: BulkResults, user_id: str, batch: list[tuple[int, str]]):
+    # Checked again right before the write: a child whose delete failed, or a file or
+    # folder moved in since the request was planned, keeps its parent
+    ids = [folder_id for _, folder_id in batch]
+    occupied = set(await db.files.distinct("folder_id", {"user_id": user_id, "folder_id": {"$in": ids}}))
+    occupied |= set(await db.folders.distinct("parent_id", {"user_id": user_id, "parent_id": {"$in": ids}}))
+    for index, folder_id in batch:
+        if folder_id in occupied:
+            results.fail(index, "Folder is not empty")
+        else:
+            results.add(index, DeleteOne({"_id": folder_id, "user_id": user_id}))
+    await results.write(db.folders)
+
+class FolderBulkOperation(BaseModel):
+    op: Literal["move", "delete", "rename"]
+    folder_id: str
+    parent_id: Optional[str] = None
+    name_encrypted: Optional[str] = None
+    name_iv: Optional[str] = None
+
+class FolderBulkRequest(BaseModel):
+    operations: list[FolderBulkOperation] = Field(..., max_length=MAX_BULK_OPERATIONS)
+    ordered: bool = False
+
+@router.post("/bulk")
+async def bulk_folders(data: FolderBulkRequest, user=Depends(get_current_user), db=Depends(get_db)):
+    results = BulkResults([op.folder_id for op in data.operations], data.ordered)
+
+    # Folders being changed and every move target, validated in one query
+    ids = list({op.folder_id for op in data.operations} | {op.parent_id for op in data.operations if op.op == "move" and op.parent_id})
+    found = await db.folders.find(
+        {"_id": {"$in": ids}, "user_id": user["_id"]}, {"ancestors": 1, "parent_id": 1}
+    ).to_list(length=len(ids))
+    ancestors = {doc["_id"]: doc.get("ancestors", []) for doc in found}
+    parents = {doc["_id"]: doc.get("parent_id") for doc in found}
+    owned = set(ancestors)
+    moved = {op.folder_id for op in data.operations if op.op == "move"}
+
+    # A folder can only be deleted if it is empty once the rest of this request is applied:
+    # it holds no files, and every subfolder is itself deleted here
+    to_delete = {op.folder_id for op in data.operations if op.op == "delete" and op.folder_id in owned}
+    deletable = set()
+    if to_delete:
+        with_files = set(await db.files.distinct("folder_id", {"user_id": user["_id"], "folder_id": {"$in": list(to_delete)}}))
+        subfolders = await db.folders.find(
+            {"user_id": user["_id"], "parent_id": {"$in": list(to_delete)}},
+            {"_id": 1, "parent_id": 1}
+        ).to_list(length=None)
+        deletable = to_delete - with_files
+        while True:
+            blocked = {f["parent_id"] for f in subfolders if f["_id"] not in deletable}
+            if not blocked & deletable:
+                break
+            deletable -= blocked
+
+    deleted = set()
+    deferred = []
+    for index, op in enumerate(data.operations):
+        if results.stopped:
+            break
+        if op.folder_id not in owned or op.folder_id in deleted:
+            results.fail(index, "Folder not found")
+            continue
+        selector = {"_id": op.folder_id, "user_id": user["_id"]}
+        if op.op == "move":
+            new_ancestors = []
+            if op.parent_id:
+                if op.parent_id not in owned:
+                    results.fail(index, "Parent folder not found")
+                    continue
+                new_ancestors = ancestors[op.parent_id] + [op.parent_id]
+            if op.parent_id == op.folder_id or op.folder_id in new_ancestors:
+                results.fail(index, "Cannot move a folder into itself or one of its subfolders")
+                continue
+            if moved & set(new_ancestors):
+                # The target's own path changes in this request, so its ancestors above are stale
+                results.fail(index, "Target folder is moved by another operation in this request")
+                continue
+            results.add(index, *folder_tree.move_models(user["_id"], op.folder_id, op.parent_id, new_ancestors))
+        elif op.op == "rename":
+            if not op.name_encrypted or not op.name_iv:
+                results.fail(index, "name_encrypted and name_iv are required")
+                continue
+            results.add(index, UpdateOne(selector, {"$set": {"name_encrypted": op.name_encrypted, "name_iv": op.name_iv}}))
+        else:
+            if op.folder_id not in deletable:
+                results.fail(index, "Folder is not empty")
+                continue
+            deleted.add(op.folder_id)
+            if data.ordered:
+                # Everything before it goes first, then the folder if it is still empty
+                await results.write(db.folders)
+                if results.stopped:
+                    break
+                await delete_if_empty(db, results, user["_id"], [(index, op.folder_id)])
+            else:
+                deferred.append((index, op.folder_id))
+
+    await results.write(db.folders)
+    # Deletes go last and deepest first, one level per round, so a parent is only
+    # deleted once its children are really gone (and after this request's moves)
+    for depth in sorted({len(ancestors[folder_id]) for _, folder_id in deferred}, reverse=True):
+        await delete_if_empty(db, results, user["_id"], [d for d in deferred if len(ancestors[d[1]]) == depth])
+    succeeded = results.finish()
+
+    changes = []
+    # Moved subtrees had their `ancestors` rewritten as well
+    moved_ids = [data.operations[index].folder_id for index in succeeded if data.operations[index].op == "move"]
+    if moved_ids:
+        descendants = set(await folder_tree.descendant_ids(db, user["_id"], moved_ids)) - set(moved_ids)
+        changes.extend((journal.FOLDER, fid, journal.UPSERT) for fid in descendants)
+    change = usage.UsageChange(user["_id"])
+    for index in succeeded:
+        op = data.operations[index]
+        changes.append((journal.FOLDER, op.folder_id, journal.DELETE if op.op == "delete" else journal.UPSERT))
+        if op.op == "move":
+            change.move_folder(parents[op.folder_id], op.parent_id)
+            parents[op.folder_id] = op.parent_id
+        elif op.op == "delete":
+            change.remove_folder(parents[op.folder_id])
+        else:
+            activity_sink.log(user["_id"], "RENAME_FOLDER", folder_id=op.folder_id)
+    await change.apply(db)
+    await journal.record_changes(db, user["_id"], changes)
+
+    return results.response()
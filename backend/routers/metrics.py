@@ -0,0 +1,33 @@
+from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+from core.config import settings
+from services.metrics import registry
+from services.profiler import recent_profiles
+import hmac
+
+router = APIRouter(prefix="/metrics", tags=["Metrics"])
+
+def require_metrics_token(authorization: Optional[str] = Header(None)):
+    if not settings.METRICS_TOKEN:
+        raise HTTPException(status_code=403, detail="Metrics are disabled until METRICS_TOKEN is set")
+    expected = f"Bearer {settings.METRICS_TOKEN}"
+    # Compared as bytes: compare_digest rejects str arguments with non-ASCII characters
+    if not authorization or not hmac.compare_digest(authorization.encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+@router.get("", dependencies=[Depends(require_metrics_token)])
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/profiles", dependencies=[Depends(require_metrics_token)])
+async def list_profiles():
+    return [profile.summary() for profile in reversed(recent_profiles.values())]
+
+@router.get("/profiles/{profile_id}", dependencies=[Depends(require_metrics_token)])
+async def get_profile(profile_id: str):
+    profile = recent_profiles.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    # Folded stacks, one "frame;frame;... count" line per distinct stack
+    return PlainTextResponse(profile.folded())
@@ -0,0 +1,69 @@
+from fastapi import APIRouter, Depends
+from core.db import get_db
+from routers.files import get_current_user
+from services import journal
+from services.repositories import get_repositories
+
+router = APIRouter(prefix="/api/sync", tags=["Sync"])
+
+MAX_CHANGES_PER_SYNC = 1000
+
+def reset_response(version: int):
+    return {
+        "version": version,
+        "reset": True,
+        "has_more": False,
+        "files": [],
+        "folders": [],
+        "deleted_files": [],
+        "deleted_folders": []
+    }
+
+@router.get("")
+async def sync_changes(since: int = 0, user=Depends(get_current_user), db=Depends(get_db),
+                       repos=Depends(get_repositories)):
+    # Returns what changed after version `since`. `reset: true` means the journal can't
+    # bridge the gap (first sync, trimmed history or a key rotation) and the client should
+    # reload the full listings, then continue syncing from `version`.
+    current = await repos.users.get(user["_id"])
+    version = current.get("vault_version", 0) if current else 0
+    if since <= 0 or since > version:
+        return reset_response(version)
+
+    changes = await db.vault_changes.find(
+        {"user_id": user["_id"], "version": {"$gt": since}}
+    ).sort("version", 1).limit(MAX_CHANGES_PER_SYNC).to_list(length=MAX_CHANGES_PER_SYNC)
+
+    if since < version and (not changes or changes[0]["version"] != since + 1):
+        return reset_response(version)
+
+    # Only the last change per entity matters
+    latest = {}
+    for change in changes:
+        if change["kind"] == journal.VAULT and change["op"] == journal.RESET:
+            return reset_response(version)
+        latest[(change["kind"], change["entity_id"])] = change["op"]
+
+    upserted_files = [eid for (kind, eid), op in latest.items() if kind == journal.FILE and op == journal.UPSERT]
+    upserted_folders = [eid for (kind, eid), op in latest.items() if kind == journal.FOLDER and op == journal.UPSERT]
+    deleted_files = {eid for (kind, eid), op in latest.items() if kind == journal.FILE and op == journal.DELETE}
+    deleted_folders = {eid for (kind, eid), op in latest.items() if kind == journal.FOLDER and op == journal.DELETE}
+
+    files = await repos.files.get_many(user["_id"], upserted_files)
+    folders = await repos.folders.get_many(user["_id"], upserted_folders)
+
+    # Anything upserted in this window but gone by now was deleted in a later window
+    deleted_files |= set(upserted_files) - {f["_id"] for f in files}
+    deleted_folders |= set(upserted_folders) - {f["_id"] for f in folders}
+    for doc in files + folders:
+        doc["id"] = doc.pop("_id")
+
+    return {
+        "version": changes[-1]["version"] if changes else version,
+        "reset": False,
+        "has_more": bool(changes) and changes[-1]["version"] < version,
+        "files": files,
+        "folders": folders,
+        "deleted_files": sorted(deleted_files),
+        "deleted_folders": sorted(deleted_folders)
+    }
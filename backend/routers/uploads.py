@@ -0,0 +1,250 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Header
+from pydantic import BaseModel
+from typing import Optional
+from core.db import get_db
+from core.config import settings
+from routers.files import get_current_user, upload_slot, save_file_record, stored_response
+from services.storage import get_storage, get_backend, BlobTooLarge, DigestingStream
+from services.upload_sessions import (
+    part_key, expected_chunk_size, received_chunks, iter_parts, discard_parts,
+    committed_file_id, claimable_query, commit_in_progress, PartMismatch, OPEN, COMMITTING, COMMITTED
+)
+from services.metrics import blob_bytes
+from services import usage
+from services.search import clean_tokens
+from services.repositories import get_repositories
+from services.folder_tree import require_folder
+import uuid
+import math
+import datetime
+
+router = APIRouter(prefix="/api/files/uploads", tags=["Uploads"])
+
+MIN_CHUNK_SIZE = 256 * 1024
+
+class UploadSessionCreate(BaseModel):
+    total_size: int
+    chunk_size: Optional[int] = None
+    encrypted_file_key: str
+    file_iv: str
+    key_wrap_iv: str
+    encrypted_filename: str
+    filename_iv: str
+    requires_file_password: bool
+    password_salt: Optional[str] = None
+    password_iv: Optional[str] = None
+    folder_id: Optional[str] = None
+    original_size: int
+    search_tokens: Optional[list[str]] = None
+    # Hex sha256 of the whole ciphertext, checked once the parts are assembled
+    sha256: Optional[str] = None
+
+def session_status(session: dict):
+    received = received_chunks(session)
+    received_set = set(received)
+    return {
+        "session_id": session["_id"],
+        "total_size": session["total_size"],
+        "chunk_size": session["chunk_size"],
+        "total_chunks": session["total_chunks"],
+        "received": received,
+        "missing": [i for i in range(session["total_chunks"]) if i not in received_set],
+        "status": session["status"],
+        "expires_at": session["expires_at"]
+    }
+
+async def get_open_session(db, session_id: str, user) -> dict:
+    session = await db.upload_sessions.find_one({"_id": session_id, "user_id": user["_id"]})
+    if not session or session["expires_at"] < datetime.datetime.utcnow():
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+@router.post("")
+async def create_upload_session(data: UploadSessionCreate, user=Depends(get_current_user), db=Depends(get_db),
+                                repos=Depends(get_repositories), storage=Depends(get_storage)):
+    if data.total_size <= 0:
+        raise HTTPException(status_code=400, detail="total_size must be positive")
+    if data.total_size > settings.MAX_RESUMABLE_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="File too large for a resumable upload")
+
+    chunk_size = data.chunk_size or settings.UPLOAD_SESSION_CHUNK_SIZE
+    if not MIN_CHUNK_SIZE <= chunk_size <= settings.UPLOAD_SESSION_MAX_CHUNK_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"chunk_size must be between {MIN_CHUNK_SIZE} and {settings.UPLOAD_SESSION_MAX_CHUNK_SIZE} bytes"
+        )
+
+    await require_folder(repos, user["_id"], data.folder_id)
+
+    active = await db.upload_sessions.count_documents({
+        "user_id": user["_id"],
+        "status": {"$ne": COMMITTED},
+        "expires_at": {"$gte": datetime.datetime.utcnow()}
+    })
+    if active >= settings.MAX_UPLOAD_SESSIONS_PER_USER:
+        raise HTTPException(status_code=429, detail="Too many upload sessions in progress")
+
+    # Hold quota for the whole file now rather than discovering at commit that it won't fit
+    try:
+        await usage.reserve(db, user["_id"], data.total_size)
+    except usage.QuotaExceeded:
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
+
+    now = datetime.datetime.utcnow()
+    session = {
+        "_id": str(uuid.uuid4()),
+        "user_id": user["_id"],
+        "metadata": {
+            **data.model_dump(exclude={"total_size", "chunk_size", "search_tokens", "sha256"}),
+            "search_tokens": clean_tokens(data.search_tokens)
+        },
+        "sha256": data.sha256.lower() if data.sha256 else None,
+        "total_size": data.total_size,
+        "chunk_size": chunk_size,
+        "total_chunks": math.ceil(data.total_size / chunk_size),
+        "storage_backend": storage.name,
+        "parts": {},
+        "status": OPEN,
+        "reserved": data.total_size,
+        "created_at": now,
+        "expires_at": now + datetime.timedelta(seconds=settings.UPLOAD_SESSION_TTL_SECONDS)
+    }
+    try:
+        await db.upload_sessions.insert_one(session)
+    except Exception:
+        await usage.release(db, user["_id"], data.total_size)
+        raise
+    return session_status(session)
+
+@router.get("/{session_id}")
+async def get_upload_session(session_id: str, user=Depends(get_current_user), db=Depends(get_db)):
+    return session_status(await get_open_session(db, session_id, user))
+
+@router.put("/{session_id}/chunks/{index}")
+async def upload_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: Optional[str] = Header(None),
+    user=Depends(get_current_user),
+    transfer=Depends(upload_slot),
+    db=Depends(get_db)
+):
+    session = await get_open_session(db, session_id, user)
+    if session["status"] == COMMITTED or commit_in_progress(session):
+        raise HTTPException(status_code=409, detail="Upload session is already being committed")
+    if not 0 <= index < session["total_chunks"]:
+        raise HTTPException(status_code=400, detail="Chunk index out of range")
+
+    expected_size = expected_chunk_size(session, index)
+    stream = DigestingStream(request.stream(), max_size=expected_size)
+    storage = get_backend(session["storage_backend"])
+    key = part_key(session_id, index)
+    try:
+        await storage.put_stream(key, stream)
+    except BlobTooLarge:
+        raise HTTPException(status_code=413, detail=f"Chunk {index} must be exactly {expected_size} bytes")
+    blob_bytes.inc(stream.size, direction="upload")
+
+    if stream.size != expected_size:
+        await storage.delete(key)
+        raise HTTPException(status_code=400, detail=f"Chunk {index} must be exactly {expected_size} bytes")
+    if x_chunk_sha256 and x_chunk_sha256.lower() != stream.sha256:
+        await storage.delete(key)
+        raise HTTPException(status_code=400, detail="Chunk checksum mismatch")
+
+    # Each chunk only touches its own key, so parallel PUTs never conflict
+    await db.upload_sessions.update_one(
+        {"_id": session_id},
+        {"$set": {
+            f"parts.{index}": {"size": stream.size, "sha256": stream.sha256},
+            "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.UPLOAD_SESSION_TTL_SECONDS)
+        }}
+    )
+    return {"index": index, "size": stream.size, "sha256": stream.sha256}
+
+@router.post("/{session_id}/commit")
+async def commit_upload_session(session_id: str, user=Depends(get_current_user), db=Depends(get_db),
+                                repos=Depends(get_repositories)):
+    session = await get_open_session(db, session_id, user)
+    file_id = await committed_file_id(db, session)
+    if file_id:
+        # Retry of a commit that already created the file
+        await finish_commit(db, session, file_id)
+        return stored_response(file_id)
+    missing = session_status(session)["missing"]
+    if missing:
+        raise HTTPException(status_code=409, detail={"message": "Upload is incomplete", "missing": missing})
+
+    # Claim the session so a retried commit can't assemble the file twice. The file id
+    # is fixed here, so whether the commit got as far as the file record can be told later.
+    # The claim expires, so a commit whose worker died doesn't hold the session forever.
+    file_id = session.get("file_id") or str(uuid.uuid4())
+    claim = str(uuid.uuid4())
+    claimed = await db.upload_sessions.find_one_and_update(
+        claimable_query(session_id, user["_id"]),
+        {"$set": {
+            "status": COMMITTING,
+            "file_id": file_id,
+            "commit_claim": claim,
+            "committing_until": datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.UPLOAD_COMMIT_LOCK_SECONDS)
+        }}
+    )
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Upload session is already being committed")
+
+    storage = get_backend(session["storage_backend"])
+    stream = DigestingStream(iter_parts(session))
+    try:
+        try:
+            await storage.put_stream(file_id, stream)
+        except PartMismatch as exc:
+            # Drop the bad part so the client sees it as missing and uploads it again
+            await db.upload_sessions.update_one({"_id": session_id}, {"$unset": {f"parts.{exc.index}": ""}})
+            raise HTTPException(status_code=409, detail={"message": "Chunk changed after upload", "missing": [exc.index]})
+        if stream.size != session["total_size"]:
+            await storage.delete(file_id)
+            raise HTTPException(status_code=409, detail="Uploaded chunks do not add up to total_size")
+        if session.get("sha256") and stream.sha256 != session["sha256"]:
+            await storage.delete(file_id)
+            raise HTTPException(status_code=409, detail="Assembled file does not match sha256")
+        result = await save_file_record(
+            db, repos, storage, user, file_id, stream, reserved=session.get("reserved", 0), **session["metadata"]
+        )
+    except BaseException:
+        # Only reopen the session if no file record was written; otherwise it is committed
+        if await committed_file_id(db, {"file_id": file_id}):
+            await finish_commit(db, session, file_id)
+        else:
+            # Unless another commit has taken the claim over in the meantime
+            await db.upload_sessions.update_one(
+                {"_id": session_id, "status": COMMITTING, "commit_claim": claim},
+                {"$set": {"status": OPEN}, "$unset": {"commit_claim": "", "committing_until": ""}}
+            )
+        raise
+
+    await finish_commit(db, session, file_id)
+    return result
+
+async def finish_commit(db, session: dict, file_id: str):
+    await db.upload_sessions.update_one(
+        {"_id": session["_id"]},
+        {"$set": {"status": COMMITTED, "file_id": file_id, "parts": {}, "reserved": 0},
+         "$unset": {"commit_claim": "", "committing_until": ""}}
+    )
+    await discard_parts(session)
+
+@router.delete("/{session_id}")
+async def abort_upload_session(session_id: str, user=Depends(get_current_user), db=Depends(get_db)):
+    session = await get_open_session(db, session_id, user)
+    if session["status"] == COMMITTED or await committed_file_id(db, session):
+        raise HTTPException(status_code=409, detail="Upload session is already committed")
+    # Removing the session is the claim, so a commit can't start on it meanwhile; an
+    # expired commit claim is taken over like a retried commit would
+    aborted = await db.upload_sessions.find_one_and_delete(claimable_query(session_id, user["_id"]))
+    if not aborted:
+        raise HTTPException(status_code=409, detail="Upload session is already being committed")
+    await discard_parts(aborted)
+    if not await committed_file_id(db, aborted):
+        await usage.release(db, user["_id"], aborted.get("reserved", 0))
+    return {"message": "Upload session aborted"}
@@ -0,0 +1,40 @@
+from fastapi import APIRouter, Depends, HTTPException
+from core.db import get_db
+from services.repositories import get_repositories
+from core.config import settings
+from routers.files import get_current_user
+from services import folder_tree
+from services.usage import public_usage
+
+router = APIRouter(prefix="/api/usage", tags=["Usage"])
+
+@router.get("")
+async def get_usage(user=Depends(get_current_user), repos=Depends(get_repositories)):
+    # Read fresh rather than from the cached user document, counters change on every upload
+    doc = await repos.users.get(user["_id"]) or {}
+    usage = doc.get("usage") or {}
+    quota = settings.USER_QUOTA_BYTES or None
+    return {
+        **public_usage(usage),
+        "reserved_bytes": usage.get("reserved_bytes", 0),
+        "plaintext_bytes": usage.get("plaintext_bytes", 0),
+        "last_upload_at": usage.get("last_upload_at"),
+        "quota_bytes": quota,
+        "remaining_bytes": max(quota - usage.get("bytes", 0) - usage.get("reserved_bytes", 0), 0) if quota else None
+    }
+
+@router.get("/folders/{folder_id}")
+async def get_folder_usage(folder_id: str, user=Depends(get_current_user), db=Depends(get_db)):
+    # `usage` counts the folder's direct contents; `subtree` adds up every folder below it
+    # from their own counters, so only `folders` is read
+    folders = await db.folders.find(
+        folder_tree.subtree_query(user["_id"], folder_id), {"usage": 1}
+    ).to_list(length=None)
+    folder = next((f for f in folders if f["_id"] == folder_id), None)
+    if not folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    subtree = public_usage(None)
+    for f in folders:
+        for field, value in public_usage(f.get("usage")).items():
+            subtree[field] += value
+    return {"id": folder_id, "usage": public_usage(folder.get("usage")), "subtree": subtree}
@@ -1,12 +1,25 @@
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from fastapi import HTTPException
+import asyncio
 import hashlib
 from passlib.context import CryptContext
 from core.config import settings
+from services import metrics
+from security.user_cache import user_cache
+import time
 
-# Explicit cost configuration for bcrypt to guarantee safe defaults
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=12)
+# Explicit cost configuration for bcrypt to guarantee safe defaults.
+# Hashes made with a lower cost than BCRYPT_ROUNDS are flagged by `needs_update`,
+# so raising the setting rehashes users transparently on their next login.
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS
+)
 
 def verify_password(plain_password, hashed_password):
     pre_hashed = hashlib.sha256(plain_password.encode("utf-8")).hexdigest()
@@ -16,6 +29,77 @@ def get_password_hash(password):
     pre_hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
     return pwd_context.hash(pre_hashed)
 
+def verify_and_update_password(plain_password, hashed_password):
+    # Returns (matches, new_hash); new_hash is set when the stored hash uses an outdated cost
+    pre_hashed = hashlib.sha256(plain_password.encode("utf-8")).hexdigest()
+    return pwd_context.verify_and_update(pre_hashed, hashed_password)
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded worker pool so it never blocks the event loop.
+
+    At most `max_pending` hash/verify calls may be running or queued; beyond that
+    callers get an immediate 503 with Retry-After instead of waiting in a queue
+    that only makes every login slower.
+    """
+
+    def __init__(self, workers: int, max_pending: int, use_processes: bool = False):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.use_processes = use_processes
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            pool = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            self._executor = pool(max_workers=self.workers)
+        return self._executor
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            result, duration = await asyncio.get_running_loop().run_in_executor(
+                self.executor, metrics.timed_call, func, *args
+            )
+        finally:
+            self.pending -= 1
+        metrics.password_hash_duration.observe(duration, operation=func.__name__)
+        metrics.password_hash_wait.observe(max(time.perf_counter() - start - duration, 0), operation=func.__name__)
+        return result
+
+    async def hash(self, password):
+        return await self.run(get_password_hash, password)
+
+    async def verify(self, plain_password, hashed_password):
+        return await self.run(verify_password, plain_password, hashed_password)
+
+    async def verify_and_update(self, plain_password, hashed_password):
+        return await self.run(verify_and_update_password, plain_password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher(
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_pending=settings.PASSWORD_HASH_MAX_PENDING,
+    use_processes=settings.PASSWORD_HASH_EXECUTOR == "process"
+)
+metrics.registry.gauge(
+    "secsky_password_hash_pending", "bcrypt calls running or queued", lambda: password_hasher.pending
+)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -26,3 +110,18 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
     return encoded_jwt
+
+def token_user_id(token: str) -> str:
+    # User id of a "Bearer <jwt>" cookie value; decoded tokens are cached until they expire
+    scheme, _, token_value = token.partition(" ")
+    user_id = user_cache.get_token(token_value)
+    if user_id is None:
+        try:
+            payload = jwt.decode(token_value, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+            user_id = payload.get("id")
+            if not user_id:
+                raise HTTPException(status_code=401, detail="Invalid token")
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        user_cache.put_token(token_value, user_id, payload.get("exp"))
+    return user_id
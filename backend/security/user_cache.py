@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Optional
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+from core.cache import TTLCache
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_COLLECTION = "cache_invalidations"
+
+
+class UserCache:
+    """Caches decoded access tokens (token -> user id) and user documents (user id -> doc)
+    so `get_current_user` can skip `jwt.decode` and `db.users.find_one` on hot paths.
+
+    Anything that modifies a user document must call `invalidate_user`. With
+    USER_CACHE_PUBSUB enabled the invalidation is also broadcast to the other
+    workers through a capped collection.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.tokens = TTLCache(max_entries, ttl)
+        self.users = TTLCache(max_entries, ttl)
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._publisher = None
+
+    def get_token(self, token: str) -> Optional[str]:
+        return self.tokens.get(token)
+
+    def put_token(self, token: str, user_id: str, expires_at: Optional[float] = None):
+        # Never keep a token around past its own `exp`
+        ttl = None if expires_at is None else expires_at - time.time()
+        self.tokens.set(token, user_id, ttl)
+
+    def get_user(self, user_id: str) -> Optional[dict]:
+        user = self.users.get(user_id)
+        return dict(user) if user is not None else None
+
+    def put_user(self, user: dict):
+        self.users.set(user["_id"], dict(user))
+
+    def drop_user(self, user_id: str):
+        self.users.pop(user_id)
+
+    async def invalidate_user(self, user_id: str):
+        self.drop_user(user_id)
+        if self._publisher is not None:
+            try:
+                await self._publisher(user_id)
+            except Exception:
+                logger.exception("Failed to publish user cache invalidation")
+
+    def set_publisher(self, publisher):
+        self._publisher = publisher
+
+    def stats(self) -> dict:
+        return {"tokens": self.tokens.stats(), "users": self.users.stats()}
+
+
+user_cache = UserCache(settings.USER_CACHE_MAX_ENTRIES, settings.USER_CACHE_TTL_SECONDS)
+
+
+async def _ensure_invalidation_collection(db):
+    try:
+        await db.create_collection(INVALIDATION_COLLECTION, capped=True, size=1024 * 1024, max=10000)
+    except CollectionInvalid:
+        pass
+
+
+async def invalidation_listener(db, cache: UserCache = user_cache):
+    """Tails the capped invalidation collection and drops entries published by other workers."""
+    await _ensure_invalidation_collection(db)
+    collection = db[INVALIDATION_COLLECTION]
+
+    async def publish(user_id: str):
+        await collection.insert_one({"user_id": user_id, "origin": cache.worker_id})
+
+    cache.set_publisher(publish)
+
+    latest = await collection.find({}, {"_id": 1}).sort("$natural", -1).limit(1).to_list(length=1)
+    last_id = latest[0]["_id"] if latest else None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+        try:
+            while cursor.alive:
+                async for message in cursor:
+                    last_id = message["_id"]
+                    if message.get("origin") != cache.worker_id:
+                        cache.drop_user(message["user_id"])
+                await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("User cache invalidation listener failed, retrying")
+        await asyncio.sleep(1)
@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+import logging
+import uuid
+
+from core import db as database
+from core.config import settings
+from services.repositories import open_repositories
+
+logger = logging.getLogger(__name__)
+
+TTL_INDEX_NAME = "timestamp_ttl"
+
+_STOP = object()
+
+
+class ActivitySink:
+    """Queues activity log entries and writes them with `insert_many` in the background.
+
+    Routes call `log()` which never awaits the database; a flusher task writes a
+    batch once `max_batch` entries are queued or `flush_interval` seconds have
+    passed, and `stop()` drains whatever is left on shutdown.
+    """
+
+    def __init__(self, max_batch: int, flush_interval: float, max_queue: int):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.written = 0
+        self.failed = 0
+        self._db = None
+        self._queue = None
+        self._task = None
+        # Direct writes made while the queue is full; held so they aren't collected and stop() can wait for them
+        self._overflow: set[asyncio.Task] = set()
+
+    def start(self, db):
+        self._db = db
+        if self._task is None or self._task.done():
+            self._queue = self._queue or asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+    def log(self, user_id: str, type: str, **fields):
+        doc = {
+            "_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "type": type,
+            **fields,
+            "timestamp": datetime.datetime.utcnow()
+        }
+        if self._task is None or self._task.done():
+            self.start(self._db or database.db)
+        try:
+            self._queue.put_nowait(doc)
+        except asyncio.QueueFull:
+            # Writer is falling behind; write this one directly rather than lose it
+            task = asyncio.create_task(self._write([doc]))
+            self._overflow.add(task)
+            task.add_done_callback(self._overflow.discard)
+        return doc
+
+    async def stop(self):
+        if self._task is None:
+            return
+        if not self._task.done():
+            # The sentinel wakes the flusher, which writes what it holds and exits
+            await self._queue.put(_STOP)
+            await self._task
+        self._task = None
+        await self.flush()
+        # The queue belongs to this event loop; a later start() gets a new one
+        self._queue = None
+        if self._overflow:
+            await asyncio.gather(*self._overflow)
+
+    async def flush(self):
+        while self._queue is not None and not self._queue.empty():
+            await self._write(self._drain(self.max_batch))
+
+    def _drain(self, limit: int) -> list:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            doc = self._queue.get_nowait()
+            if doc is not _STOP:
+                batch.append(doc)
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            doc = await self._queue.get()
+            if doc is _STOP:
+                return
+            batch = [doc]
+            deadline = loop.time() + self.flush_interval
+            stopping = False
+            while len(batch) < self.max_batch and not stopping:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                # Not asyncio.wait_for: it can swallow a cancellation that lands just as
+                # an item arrives, leaving this task blocked on the queue forever
+                getter = asyncio.ensure_future(self._queue.get())
+                try:
+                    done, _ = await asyncio.wait({getter}, timeout=timeout)
+                finally:
+                    if not getter.done():
+                        getter.cancel()
+                if not done:
+                    break
+                doc = getter.result()
+                if doc is _STOP:
+                    stopping = True
+                else:
+                    batch.append(doc)
+            await self._write(batch)
+            if stopping:
+                return
+
+    async def _write(self, batch: list):
+        if not batch:
+            return
+        try:
+            await open_repositories(self._db).activity.insert_many(batch)
+            self.written += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception("Failed to write %d activity log entries", len(batch))
+
+    def stats(self) -> dict:
+        return {
+            "queued": (self._queue.qsize() if self._queue is not None else 0) + len(self._overflow),
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+
+activity_sink = ActivitySink(
+    max_batch=settings.ACTIVITY_FLUSH_BATCH_SIZE,
+    flush_interval=settings.ACTIVITY_FLUSH_INTERVAL_SECONDS,
+    max_queue=settings.ACTIVITY_QUEUE_SIZE
+)
+
+
+async def ensure_activity_indexes(db):
+    await database.ensure_index(db.activity_logs, [("user_id", 1), ("timestamp", -1)])
+
+    retention = settings.ACTIVITY_RETENTION_DAYS * 24 * 60 * 60
+    if retention <= 0:
+        if TTL_INDEX_NAME in await db.activity_logs.index_information():
+            await db.activity_logs.drop_index(TTL_INDEX_NAME)
+        return
+    await database.ensure_index(db.activity_logs, "timestamp", name=TTL_INDEX_NAME, expireAfterSeconds=retention)
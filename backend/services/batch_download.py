@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import json
+import struct
+from typing import AsyncIterator, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+from services.blob_cache import blob_cache
+from services.storage import BlobNotFound, get_backend
+
+# Response layout: a sequence of frames, each
+#   uint32 big-endian header length, UTF-8 JSON header,
+#   uint64 big-endian body length, body (the file's ciphertext),
+# closed by a frame whose header is {"end": true, "count", "missing", "not_found"}
+# and whose body is empty. A file header carries the file's metadata plus "id",
+# "size" and "status": "ok", or "missing" when the metadata exists but the blob doesn't.
+FORMAT = "secsky-frames-v1"
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Storage and internal bookkeeping fields that never go out in a frame header
+_PRIVATE_FIELDS = ("user_id", "storage_backend", "storage_key", "encrypted_blob", "search_tokens", "pending_key")
+
+
+def frame(header: dict, body_length: int) -> bytes:
+    encoded = json.dumps(jsonable_encoder(header), separators=(",", ":")).encode()
+    return struct.pack(">I", len(encoded)) + encoded + struct.pack(">Q", body_length)
+
+
+def _header(doc: dict, status: str, size: int) -> dict:
+    header = {k: v for k, v in doc.items() if k not in _PRIVATE_FIELDS and k != "_id"}
+    header.update(id=doc["_id"], status=status, size=size)
+    return header
+
+
+async def _read_small(repos, user_id: str, doc: dict) -> Optional[bytes]:
+    if not doc.get("storage_key"):
+        # Legacy document whose blob still lives inline; fetched separately so the
+        # listing query never drags every inline blob into memory at once (lookups
+        # from the prefetch window are batched by the repository's loader)
+        legacy = await repos.files.get_with_blob(user_id, doc["_id"])
+        return bytes(legacy["encrypted_blob"]) if legacy and "encrypted_blob" in legacy else None
+    if doc.get("sha256"):
+        cached = blob_cache.get(doc["_id"], doc["sha256"])
+        if isinstance(cached, bytes):
+            return cached
+    try:
+        return await get_backend(doc.get("storage_backend")).read(doc["storage_key"])
+    except BlobNotFound:
+        return None
+
+
+async def stream_files(repos, user_id: str, docs: list[dict], window: int, prefetch_max_size: int,
+                       not_found: list[str] = ()) -> AsyncIterator[bytes]:
+    """Yields the framed ciphertext of `docs`, in order.
+
+    Blobs up to `prefetch_max_size` bytes are read concurrently, at most
+    `window` files ahead of the one being sent, so memory stays around
+    window * prefetch_max_size however many files are in the batch. Larger
+    blobs are not prefetched; they are streamed chunk by chunk when their
+    turn comes.
+    """
+    pending = collections.deque()
+    remaining = iter(docs)
+    missing = 0
+
+    def schedule():
+        while len(pending) < max(window, 1):
+            doc = next(remaining, None)
+            if doc is None:
+                return
+            size = doc.get("blob_size")
+            prefetch = not doc.get("storage_key") or (size is not None and size <= prefetch_max_size)
+            pending.append((doc, asyncio.ensure_future(_read_small(repos, user_id, doc)) if prefetch else None))
+
+    try:
+        schedule()
+        while pending:
+            doc, task = pending.popleft()
+            schedule()
+            if task is not None:
+                data = await task
+                if data is None:
+                    missing += 1
+                    yield frame(_header(doc, "missing", 0), 0)
+                    continue
+                yield frame(_header(doc, "ok", len(data)), len(data))
+                for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+                    yield data[offset:offset + STREAM_CHUNK_SIZE]
+                continue
+
+            storage = get_backend(doc.get("storage_backend"))
+            try:
+                size = doc.get("blob_size")
+                if size is None:
+                    size = await storage.size(doc["storage_key"])
+                chunks = storage.open(doc["storage_key"])
+                first = await chunks.__anext__() if size else b""
+            except (BlobNotFound, StopAsyncIteration):
+                missing += 1
+                yield frame(_header(doc, "missing", 0), 0)
+                continue
+            yield frame(_header(doc, "ok", size), size)
+            if first:
+                yield first
+                async for chunk in chunks:
+                    yield chunk
+        yield frame({"end": True, "count": len(docs), "missing": missing, "not_found": list(not_found)}, 0)
+    finally:
+        # Client went away mid-batch: drop the reads still in flight
+        for _, task in pending:
+            if task is not None:
+                task.cancel()
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Optional, Union
+
+from core.config import settings
+from services import metrics
+from services.storage import LocalStorageBackend
+
+logger = logging.getLogger(__name__)
+
+cache_requests = metrics.registry.counter(
+    "secsky_blob_cache_requests_total", "Blob cache lookups by tier and outcome", labels=("result",)
+)
+cache_evictions = metrics.registry.counter(
+    "secsky_blob_cache_evictions_total", "Blob cache evictions", labels=("tier",)
+)
+
+
+class BlobCache:
+    """Read cache for ciphertext that is otherwise fetched from a remote backend.
+
+    Entries are keyed by (file id, sha256) so a blob can never be served for
+    different content under the same id. The memory tier is an LRU bounded by
+    `memory_budget` bytes; the optional disk tier keeps files under `disk_dir`,
+    bounded by `disk_budget`; a hit there is read back in chunks through `open`
+    and streamed to the client by `BlobResponse`, not handed to sendfile.
+    Concurrent misses for the same blob share a single backend read.
+    """
+
+    def __init__(self, memory_budget: int, max_entry_size: int,
+                 disk_dir: Optional[str] = None, disk_budget: int = 0):
+        self.memory_budget = memory_budget
+        self.max_entry_size = max_entry_size
+        self.disk_dir = Path(disk_dir) if disk_dir and disk_budget > 0 else None
+        self.disk_budget = disk_budget
+        self._memory: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[tuple[str, str], int] = OrderedDict()
+        self._disk_bytes = 0
+        # file id -> cached (file id, sha256) keys in either tier, for invalidation
+        self._versions: dict[str, set] = {}
+        self._loading: dict[tuple[str, str], asyncio.Future] = {}
+        self._disk_writes = set()
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.evictions = {"memory": 0, "disk": 0}
+        if self.disk_dir:
+            self._disk_files = LocalStorageBackend(self.disk_dir)
+            self._load_disk_index()
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory_budget > 0 or self.disk_dir is not None
+
+    def cacheable(self, size: int) -> bool:
+        return self.enabled and 0 < size <= self.max_entry_size
+
+    def _disk_path(self, key: tuple[str, str]) -> Path:
+        return self.disk_dir / f"{key[0]}-{key[1]}"
+
+    def _load_disk_index(self):
+        # Files left by a previous run, oldest access first so they are evicted first
+        entries = []
+        for path in self.disk_dir.iterdir():
+            if path.name.startswith("."):
+                path.unlink(missing_ok=True)
+                continue
+            file_id, _, sha256 = path.name.rpartition("-")
+            if not file_id:
+                continue
+            stat = path.stat()
+            entries.append((stat.st_atime, (file_id, sha256), stat.st_size))
+        for _, key, size in sorted(entries):
+            self._add_disk(key, size)
+        self._trim_disk()
+
+    def get(self, file_id: str, sha256: str) -> Union[bytes, Path, None]:
+        """Cached bytes (memory tier), a file path (disk tier) or None."""
+        key = (file_id, sha256)
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.hits["memory"] += 1
+            cache_requests.inc(result="memory_hit")
+            return data
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            self.hits["disk"] += 1
+            cache_requests.inc(result="disk_hit")
+            return self._disk_path(key)
+        self.misses += 1
+        cache_requests.inc(result="miss")
+        return None
+
+    def open(self, path: Path, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Streams a disk-tier entry returned by `get`."""
+        return self._disk_files.open(path.name, start, end)
+
+    async def load(self, file_id: str, sha256: str, read: Awaitable[bytes]) -> bytes:
+        """Awaits `read` to fill the cache, unless another request is already loading the blob."""
+        key = (file_id, sha256)
+        pending = self._loading.get(key)
+        if pending is not None:
+            read.close()
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            data = await read
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Consumed here so a failed load nobody else waited on isn't reported as unretrieved
+            future.exception()
+            raise
+        finally:
+            self._loading.pop(key, None)
+        future.set_result(data)
+        self.put(file_id, sha256, data)
+        return data
+
+    def put(self, file_id: str, sha256: str, data: bytes):
+        if not self.cacheable(len(data)):
+            return
+        key = (file_id, sha256)
+        if self.memory_budget > 0 and len(data) <= self.memory_budget and key not in self._memory:
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            self._versions.setdefault(file_id, set()).add(key)
+            while self._memory_bytes > self.memory_budget:
+                evicted = next(iter(self._memory))
+                self._drop_memory(evicted)
+                self.evictions["memory"] += 1
+                cache_evictions.inc(tier="memory")
+        if self.disk_dir and key not in self._disk:
+            task = asyncio.create_task(self._write_disk(key, data))
+            self._disk_writes.add(task)
+            task.add_done_callback(self._disk_writes.discard)
+
+    async def _write_disk(self, key: tuple[str, str], data: bytes):
+        path = self._disk_path(key)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+
+        def write():
+            with open(tmp_path, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp_path, path)
+
+        try:
+            await asyncio.to_thread(write)
+        except OSError:
+            logger.exception("Failed to write blob cache entry %s", path.name)
+            tmp_path.unlink(missing_ok=True)
+            return
+        if key not in self._disk:
+            self._add_disk(key, len(data))
+            self._trim_disk()
+
+    def _add_disk(self, key: tuple[str, str], size: int):
+        self._disk[key] = size
+        self._disk_bytes += size
+        self._versions.setdefault(key[0], set()).add(key)
+
+    def _forget(self, key: tuple[str, str]):
+        if key not in self._memory and key not in self._disk:
+            versions = self._versions.get(key[0])
+            if versions is not None:
+                versions.discard(key)
+                if not versions:
+                    del self._versions[key[0]]
+
+    def _drop_memory(self, key: tuple[str, str]):
+        self._memory_bytes -= len(self._memory.pop(key))
+        self._forget(key)
+
+    def _drop_disk(self, key: tuple[str, str]):
+        self._disk_bytes -= self._disk.pop(key)
+        self._disk_path(key).unlink(missing_ok=True)
+        self._forget(key)
+
+    def _trim_disk(self):
+        while self._disk_bytes > self.disk_budget and self._disk:
+            self._drop_disk(next(iter(self._disk)))
+            self.evictions["disk"] += 1
+            cache_evictions.inc(tier="disk")
+
+    def invalidate(self, file_id: str):
+        """Drops every cached version of a file; call whenever it is deleted or overwritten."""
+        for key in list(self._versions.get(file_id, ())):
+            if key in self._memory:
+                self._drop_memory(key)
+            if key in self._disk:
+                self._drop_disk(key)
+
+    def stats(self) -> dict:
+        lookups = self.hits["memory"] + self.hits["disk"] + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_ratio": round((lookups - self.misses) / lookups, 4) if lookups else None,
+            "evictions": dict(self.evictions),
+        }
+
+
+blob_cache = BlobCache(
+    memory_budget=settings.BLOB_CACHE_MEMORY_BYTES,
+    max_entry_size=settings.BLOB_CACHE_MAX_ENTRY_BYTES,
+    disk_dir=settings.BLOB_CACHE_DIR,
+    disk_budget=settings.BLOB_CACHE_DISK_BYTES,
+)
+metrics.registry.gauge(
+    "secsky_blob_cache_memory_bytes", "Bytes held by the in-memory blob cache", lambda: blob_cache.stats()["memory_bytes"]
+)
+metrics.registry.gauge(
+    "secsky_blob_cache_disk_bytes", "Bytes held by the on-disk blob cache", lambda: blob_cache.stats()["disk_bytes"]
+)
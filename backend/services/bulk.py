@@ -0,0 +1,73 @@
+from pymongo.errors import BulkWriteError
+
+MAX_BULK_OPERATIONS = 1000
+
+
+class BulkResults:
+    """Per-item bookkeeping for the bulk endpoints.
+
+    Operations that fail validation are marked up front; the rest are queued as
+    pymongo write models and sent in a single `bulk_write`, whose write errors
+    are mapped back to the request index they came from. Endpoints whose writes
+    have to go out in several rounds call `write` per round and `finish` once.
+    """
+
+    def __init__(self, ids: list[str], ordered: bool):
+        self.ordered = ordered
+        self.items = [{"index": i, "id": item_id, "ok": False, "error": None} for i, item_id in enumerate(ids)]
+        self.stopped = False
+        self._models = []
+        self._model_index = []
+
+    def fail(self, index: int, error: str):
+        self.items[index]["error"] = error
+        if self.ordered:
+            # Ordered semantics: nothing after the first failure runs
+            self.stopped = True
+
+    def add(self, index: int, *models):
+        self._models.extend(models)
+        self._model_index.extend([index] * len(models))
+        self.items[index]["ok"] = True
+
+    async def execute(self, collection) -> list[int]:
+        """Runs the queued writes; returns the indexes of operations that succeeded."""
+        await self.write(collection)
+        return self.finish()
+
+    async def write(self, collection):
+        """Sends the writes queued since the last call."""
+        models, model_index = self._models, self._model_index
+        self._models, self._model_index = [], []
+        if not models:
+            return
+        try:
+            await collection.bulk_write(models, ordered=self.ordered)
+        except BulkWriteError as exc:
+            failed_models = [err["index"] for err in exc.details.get("writeErrors", [])]
+            for model_position in failed_models:
+                index = model_index[model_position]
+                self.items[index]["ok"] = False
+                self.items[index]["error"] = "Write failed"
+            if self.ordered and failed_models:
+                self.stopped = True
+                for model_position in range(min(failed_models) + 1, len(models)):
+                    index = model_index[model_position]
+                    if self.items[index]["error"] is None:
+                        self.items[index]["ok"] = False
+                        self.items[index]["error"] = "Not attempted"
+
+    def finish(self) -> list[int]:
+        """Marks what never ran; returns the indexes of operations that succeeded."""
+        for item in self.items:
+            if not item["ok"] and item["error"] is None:
+                item["error"] = "Not attempted"
+        return [item["index"] for item in self.items if item["ok"]]
+
+    def response(self) -> dict:
+        succeeded = sum(1 for item in self.items if item["ok"])
+        return {
+            "succeeded": succeeded,
+            "failed": len(self.items) - succeeded,
+            "results": self.items
+        }
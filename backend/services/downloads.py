@@ -0,0 +1,168 @@
+import re
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException, Request, Response
+from starlette.responses import StreamingResponse
+
+from services.storage import get_backend, BlobNotFound
+from services.metrics import blob_bytes
+from services.blob_cache import blob_cache
+from services.scheduler import Transfer
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class BlobResponse(StreamingResponse):
+    """Streams the bytes of a stored blob, counting them and pacing them to the
+    transfer slot, which is held until the body has been sent."""
+
+    def __init__(self, content: AsyncIterator[bytes], transfer: Optional[Transfer] = None, **kwargs):
+        if transfer is not None:
+            transfer.hand_off()
+            content = transfer.paced(content)
+        super().__init__(self._counted(content), media_type="application/octet-stream", **kwargs)
+        self.transfer = transfer
+
+    @staticmethod
+    async def _counted(content: AsyncIterator[bytes]):
+        async for chunk in content:
+            blob_bytes.inc(len(chunk), direction="download")
+            yield chunk
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.transfer is not None:
+                self.transfer.release()
+
+
+async def prefetched(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Reads the first chunk before the response starts, so a missing blob is a
+    clean 404 (and any other read error a 500) instead of a truncated 200."""
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        return _iter_chunks(None, chunks)
+    return _iter_chunks(first, chunks)
+
+
+async def _iter_chunks(first: Optional[bytes], rest: AsyncIterator[bytes]):
+    if first is not None:
+        yield first
+        async for chunk in rest:
+            yield chunk
+
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """Returns an inclusive (start, end) for a single `bytes=` range, or None to
+    serve the whole blob. Multi-range requests fall back to a full response."""
+    match = _RANGE_PATTERN.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+async def _iter_bytes(data: bytes, start: int, end: int, chunk_size: int = 1024 * 1024):
+    # Chunked so a paced transfer can spread the body out instead of waiting before one big write
+    for offset in range(start, end, chunk_size):
+        yield data[offset:min(offset + chunk_size, end)]
+
+
+async def blob_response(request: Request, doc: dict, transfer: Optional[Transfer] = None) -> Response:
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f"attachment; filename=\"{doc.get('filename', 'encrypted_file.bin')}\""
+    }
+    etag = f"\"{doc['sha256']}\"" if doc.get("sha256") else None
+    if etag:
+        headers["ETag"] = etag
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+
+    storage = None
+    if "encrypted_blob" in doc:
+        # Legacy document that has not been moved out by `manage.py migrate-blobs` yet
+        legacy_blob = bytes(doc["encrypted_blob"])
+        size = len(legacy_blob)
+    else:
+        if not doc.get("storage_key"):
+            raise HTTPException(status_code=404, detail="File content not found in storage")
+        storage = get_backend(doc.get("storage_backend"))
+        size = doc.get("blob_size")
+        if size is None:
+            try:
+                size = await storage.size(doc["storage_key"])
+            except BlobNotFound:
+                raise HTTPException(status_code=404, detail="File content not found in storage")
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and size and (not if_range or (etag and if_range.strip() == etag)):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    status_code = 200
+    start, end = 0, size
+    if byte_range:
+        status_code = 206
+        start, end = byte_range[0], byte_range[1] + 1
+        headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+    headers["Content-Length"] = str(end - start)
+
+    if storage is None:
+        return BlobResponse(_iter_bytes(legacy_blob, start, end), transfer=transfer, status_code=status_code, headers=headers)
+
+    # Blobs already on local disk are served from the page cache; only remote
+    # backends (GridFS) are worth keeping a copy of
+    if storage.local_path(doc["storage_key"]) is None and doc.get("sha256") and blob_cache.cacheable(size):
+        cached = blob_cache.get(doc["_id"], doc["sha256"])
+        if cached is None and not byte_range:
+            try:
+                cached = await blob_cache.load(doc["_id"], doc["sha256"], storage.read(doc["storage_key"]))
+            except BlobNotFound:
+                raise HTTPException(status_code=404, detail="File content not found in storage")
+        if isinstance(cached, bytes):
+            return BlobResponse(_iter_bytes(cached, start, end), transfer=transfer, status_code=status_code, headers=headers)
+        if cached is not None:
+            try:
+                content = await prefetched(blob_cache.open(cached, start, end))
+            except BlobNotFound:
+                # Evicted from the disk tier since the lookup; read it from storage instead
+                content = None
+            if content is not None:
+                return BlobResponse(content, transfer=transfer, status_code=status_code, headers=headers)
+
+    try:
+        content = await prefetched(storage.open(doc["storage_key"], start, end))
+    except BlobNotFound:
+        raise HTTPException(status_code=404, detail="File content not found in storage")
+    return BlobResponse(content, transfer=transfer, status_code=status_code, headers=headers)
@@ -0,0 +1,114 @@
+import logging
+from typing import Optional
+
+from fastapi import HTTPException
+from pymongo import UpdateOne, UpdateMany
+
+logger = logging.getLogger(__name__)
+
+# Folder documents carry `ancestors`: the ids from the top-level folder down to
+# their direct parent. Subtree queries become a single `{"ancestors": id}` match
+# on the (user_id, ancestors) multikey index, whatever the depth.
+
+
+def subtree_query(user_id: str, folder_id: str) -> dict:
+    return {"user_id": user_id, "$or": [{"_id": folder_id}, {"ancestors": folder_id}]}
+
+
+async def require_folder(repos, user_id: str, folder_id: Optional[str]):
+    # Files may only be filed under one of the user's own folders (or none)
+    if folder_id and not await repos.folders.get(user_id, folder_id):
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+
+async def ancestors_for_parent(repos, user_id: str, parent_id: Optional[str]) -> list[str]:
+    if parent_id is None:
+        return []
+    parent = await repos.folders.get(user_id, parent_id)
+    if not parent:
+        raise HTTPException(status_code=404, detail="Parent folder not found")
+    return parent.get("ancestors", []) + [parent_id]
+
+
+async def descendant_ids(db, user_id: str, folder_ids: list[str]) -> list[str]:
+    """Ids of every folder below any of `folder_ids`, from one id-only query."""
+    docs = await db.folders.find(
+        {"user_id": user_id, "ancestors": {"$in": folder_ids}}, {"_id": 1}
+    ).to_list(length=None)
+    return [doc["_id"] for doc in docs]
+
+
+def move_models(user_id: str, folder_id: str, new_parent_id: Optional[str], new_ancestors: list[str]) -> list:
+    """Write models that re-home `folder_id` and rewrite the prefix of every descendant."""
+    new_prefix = new_ancestors + [folder_id]
+    return [
+        UpdateOne(
+            {"_id": folder_id, "user_id": user_id},
+            {"$set": {"parent_id": new_parent_id, "ancestors": new_ancestors}}
+        ),
+        # Keep the part of each descendant's path below `folder_id`, swap what is above it
+        UpdateMany(
+            {"user_id": user_id, "ancestors": folder_id},
+            [{"$set": {"ancestors": {"$concatArrays": [
+                new_prefix,
+                {"$slice": [
+                    "$ancestors",
+                    {"$add": [{"$indexOfArray": ["$ancestors", folder_id]}, 1]},
+                    {"$max": [{"$size": "$ancestors"}, 1]}
+                ]}
+            ]}}}]
+        )
+    ]
+
+
+def check_move(folder_id: str, new_parent_id: Optional[str], parent_ancestors: list[str]):
+    if new_parent_id == folder_id or folder_id in parent_ancestors:
+        raise HTTPException(status_code=400, detail="Cannot move a folder into itself or one of its subfolders")
+
+
+async def backfill_ancestors(db, batch_size: int = 500) -> int:
+    """Recomputes `ancestors` for every folder from `parent_id`.
+
+    Folders whose parent chain is broken or loops back on itself are moved to
+    the top level. Returns the number of folders updated.
+    """
+    updated = 0
+    for user_id in await db.folders.distinct("user_id"):
+        folders = await db.folders.find(
+            {"user_id": user_id}, {"parent_id": 1, "ancestors": 1}
+        ).to_list(length=None)
+        parents = {f["_id"]: f.get("parent_id") for f in folders}
+
+        # First break dangling parent links and cycles by detaching to the top level
+        detached = set()
+        for folder in folders:
+            current, seen = folder["_id"], {folder["_id"]}
+            while parents[current] is not None:
+                parent_id = parents[current]
+                if parent_id not in parents or parent_id in seen:
+                    parents[current] = None
+                    detached.add(current)
+                    break
+                seen.add(parent_id)
+                current = parent_id
+
+        ops = []
+        for folder in folders:
+            ancestors = []
+            parent_id = parents[folder["_id"]]
+            while parent_id is not None:
+                ancestors.insert(0, parent_id)
+                parent_id = parents[parent_id]
+            update = {"ancestors": ancestors}
+            if folder["_id"] in detached:
+                update["parent_id"] = None
+            elif folder.get("ancestors") == ancestors:
+                continue
+            ops.append(UpdateOne({"_id": folder["_id"]}, {"$set": update}))
+
+        for start in range(0, len(ops), batch_size):
+            await db.folders.bulk_write(ops[start:start + batch_size], ordered=False)
+        updated += len(ops)
+        if ops:
+            logger.info("Backfilled ancestors for %d folders of user %s", len(ops), user_id)
+    return updated
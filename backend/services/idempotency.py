@@ -0,0 +1,119 @@
+import asyncio
+import datetime
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pymongo.errors import DuplicateKeyError
+
+from core.config import settings
+
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.1
+
+# Requests of this worker currently running under a key, so same-worker duplicates
+# wait on the result directly instead of polling the collection
+_inflight: dict[str, asyncio.Future] = {}
+
+
+def fingerprint(*parts) -> str:
+    """Hash of what identifies the request, so a key reused for a different one is refused."""
+    return hashlib.sha256(json.dumps(jsonable_encoder(parts), sort_keys=True).encode()).hexdigest()
+
+
+def replay(record: dict) -> JSONResponse:
+    return JSONResponse(record["body"], status_code=record["status_code"], headers={"Idempotent-Replayed": "true"})
+
+
+async def _claim(db, record_id: str, doc: dict) -> Optional[dict]:
+    """Inserts the in-progress marker; returns the existing record if someone else owns the key."""
+    try:
+        await db.idempotency_keys.insert_one(doc)
+        return None
+    except DuplicateKeyError:
+        pass
+    now = datetime.datetime.utcnow()
+    # Take over keys whose owner died mid-request (lock expired) or whose record has
+    # expired but not been removed by the TTL monitor yet
+    taken = await db.idempotency_keys.find_one_and_update(
+        {"_id": record_id, "$or": [
+            {"status": "processing", "locked_until": {"$lt": now}},
+            {"expires_at": {"$lt": now}}
+        ]},
+        {"$set": {k: v for k, v in doc.items() if k != "_id"}}
+    )
+    if taken:
+        return None
+    return await db.idempotency_keys.find_one({"_id": record_id}) or {}
+
+
+async def run(db, user_id: str, key: Optional[str], request_hash: str,
+              operation: Callable[[], Awaitable[Any]]):
+    """Runs `operation` once per (user, Idempotency-Key).
+
+    The first request stores its successful response for IDEMPOTENCY_TTL_SECONDS
+    and later ones with the same key get it replayed. Duplicates arriving while
+    the first is still running wait for it. Failures are not stored, so the
+    client can retry them with the same key.
+    """
+    if key is None:
+        return await operation()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+
+    record_id = f"{user_id}:{key}"
+    deadline = asyncio.get_running_loop().time() + settings.IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        now = datetime.datetime.utcnow()
+        existing = await _claim(db, record_id, {
+            "_id": record_id,
+            "user_id": user_id,
+            "request_hash": request_hash,
+            "status": "processing",
+            "locked_until": now + datetime.timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS),
+            "expires_at": now + datetime.timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS)
+        })
+        if existing is None:
+            break
+        if existing and existing["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if existing.get("status") == "completed":
+            return replay(existing)
+
+        # Still running elsewhere (or the record vanished because it failed): wait, then look again
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            raise HTTPException(
+                status_code=409,
+                detail="A request with this Idempotency-Key is still in progress",
+                headers={"Retry-After": "1"}
+            )
+        local = _inflight.get(record_id)
+        if local is not None:
+            await asyncio.wait([local], timeout=remaining)
+        else:
+            await asyncio.sleep(min(POLL_INTERVAL, remaining))
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[record_id] = future
+    try:
+        result = await operation()
+        if isinstance(result, JSONResponse):
+            status_code, body = result.status_code, json.loads(result.body)
+        else:
+            status_code, body = 200, jsonable_encoder(result)
+        await db.idempotency_keys.update_one(
+            {"_id": record_id},
+            {"$set": {"status": "completed", "status_code": status_code, "body": body},
+             "$unset": {"locked_until": ""}}
+        )
+        return result
+    except BaseException:
+        await asyncio.shield(db.idempotency_keys.delete_one({"_id": record_id, "status": "processing"}))
+        raise
+    finally:
+        _inflight.pop(record_id, None)
+        future.set_result(None)
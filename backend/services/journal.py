@@ -0,0 +1,44 @@
+import datetime
+
+from services.repositories import open_repositories
+
+FILE = "file"
+FOLDER = "folder"
+VAULT = "vault"
+
+UPSERT = "upsert"
+DELETE = "delete"
+# Everything changed (e.g. all keys were re-wrapped); clients must reload from scratch
+RESET = "reset"
+
+
+async def record_changes(db, user_id: str, changes: list[tuple[str, str, str]]):
+    """Appends (kind, entity_id, op) entries to the user's change journal.
+
+    Each entry gets the next value of the user's monotonically increasing
+    `vault_version`, which `/api/sync?since=N` uses to return only newer changes.
+    """
+    if not changes:
+        return None
+    vault_version = await open_repositories(db).users.increment(user_id, "vault_version", len(changes))
+    if vault_version is None:
+        return None
+
+    first_version = vault_version - len(changes) + 1
+    now = datetime.datetime.utcnow()
+    await db.vault_changes.insert_many([
+        {
+            "user_id": user_id,
+            "version": first_version + offset,
+            "kind": kind,
+            "entity_id": entity_id,
+            "op": op,
+            "created_at": now
+        }
+        for offset, (kind, entity_id, op) in enumerate(changes)
+    ], ordered=False)
+    return vault_version
+
+
+async def record_change(db, user_id: str, kind: str, entity_id: str, op: str):
+    return await record_changes(db, user_id, [(kind, entity_id, op)])
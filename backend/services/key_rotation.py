@@ -0,0 +1,61 @@
+import datetime
+
+from pymongo import ReturnDocument
+
+from security.user_cache import user_cache
+from services import journal
+
+# A rotation commits when the user document takes the new salt and vault metadata
+# together with `key_rotation_id`. Until that marker is cleared the staged keys
+# under `pending_key` are the real ones, so whoever sees it finishes the promotion.
+
+
+async def commit_user_keys(repos, user_id: str, job: dict):
+    # The commit point: one single-document update
+    await repos.users.update(user_id, {
+        "salt": job["salt"],
+        "vault_metadata": job["vault_metadata"],
+        "key_rotation_id": job["_id"]
+    })
+    await user_cache.invalidate_user(user_id)
+
+
+async def finish_key_rotation(db, repos, user_id: str, job_id: str) -> dict:
+    """Promotes the staged keys of a committed rotation and clears the marker.
+
+    Safe to run more than once, from the commit request or any later request
+    that finds the marker left behind by an interrupted commit.
+    """
+    await db.files.update_many(
+        {"user_id": user_id, "pending_key.job_id": job_id},
+        [
+            {"$set": {
+                "encrypted_file_key": "$pending_key.encrypted_file_key",
+                "key_wrap_iv": "$pending_key.key_wrap_iv",
+                "filename": "$pending_key.filename",
+                "filename_iv": "$pending_key.filename_iv",
+                "search_tokens": {"$ifNull": ["$pending_key.search_tokens", "$search_tokens"]}
+            }},
+            {"$unset": "pending_key"}
+        ]
+    )
+    # Every wrapped key changed, so synced clients have to reload the whole vault
+    await journal.record_change(db, user_id, journal.VAULT, user_id, journal.RESET)
+    job = await db.key_rotations.find_one_and_update(
+        {"_id": job_id},
+        {"$set": {"status": "committed", "updated_at": datetime.datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    await repos.users.update(user_id, {"key_rotation_id": None})
+    await user_cache.invalidate_user(user_id)
+    return job
+
+
+async def discard_key_rotation(db, user_id: str, job_id: str):
+    await db.key_rotations.update_one(
+        {"_id": job_id}, {"$set": {"status": "aborted", "updated_at": datetime.datetime.utcnow()}}
+    )
+    await db.files.update_many(
+        {"user_id": user_id, "pending_key.job_id": job_id},
+        {"$unset": {"pending_key": ""}}
+    )
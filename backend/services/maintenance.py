@@ -0,0 +1,324 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from core.config import settings
+from services import journal
+from services import metrics
+from services import usage
+from services.blob_cache import blob_cache
+from services.storage import get_backend
+from services.upload_sessions import PART_PREFIX, part_session_id
+
+logger = logging.getLogger(__name__)
+
+reclaimed_items = metrics.registry.counter(
+    "secsky_gc_reclaimed_total", "Orphaned documents and blobs removed by maintenance sweeps", labels=("sweep",)
+)
+reclaimed_bytes = metrics.registry.counter(
+    "secsky_gc_reclaimed_bytes_total", "Ciphertext bytes freed by maintenance sweeps", labels=("sweep",)
+)
+
+LEASE_ID = "lease"
+
+
+class SweepStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.scanned = 0
+        self.reclaimed = 0
+        self.bytes = 0
+        self.rehomed = 0
+        self.completed = False
+        self._saved = (0, 0)
+
+    def unsaved(self) -> tuple[int, int]:
+        """Reclaimed count and bytes since the previous call, for the running totals in the checkpoint."""
+        reclaimed, size = self.reclaimed - self._saved[0], self.bytes - self._saved[1]
+        self._saved = (self.reclaimed, self.bytes)
+        return reclaimed, size
+
+    def reclaim(self, count: int = 1, size: int = 0):
+        self.reclaimed += count
+        self.bytes += size
+        reclaimed_items.inc(count, sweep=self.name)
+        if size:
+            reclaimed_bytes.inc(size, sweep=self.name)
+
+    def as_dict(self) -> dict:
+        return {
+            "scanned": self.scanned, "reclaimed": self.reclaimed, "bytes": self.bytes,
+            "rehomed": self.rehomed, "completed": self.completed
+        }
+
+
+class Maintenance:
+    """Incremental sweeps for data nothing else cleans up.
+
+    Each sweep walks its collection (or the blob store) in key order, GC_BATCH_SIZE
+    items at a time, pausing GC_BATCH_PAUSE_SECONDS between batches so it never
+    competes with requests for long. The position after every batch is saved in
+    `maintenance_state`, so an interrupted run resumes where it stopped and a
+    finished pass starts over from the beginning next time. Nothing created less
+    than GC_GRACE_SECONDS ago is considered orphaned, which covers uploads whose
+    blob is written before their metadata. With `dry_run` nothing is deleted and
+    no position is saved.
+    """
+
+    def __init__(self, db, batch_size: int = None, pause: float = None, dry_run: bool = False,
+                 backend: Optional[str] = None):
+        self.db = db
+        self.batch_size = batch_size or settings.GC_BATCH_SIZE
+        self.pause = settings.GC_BATCH_PAUSE_SECONDS if pause is None else pause
+        self.dry_run = dry_run
+        self.storage = get_backend(backend)
+        self.cutoff = None
+
+    @property
+    def sweeps(self) -> dict:
+        # Folders go first so files left in a removed subtree are found in the same run
+        return {
+            "orphan_folders": self.sweep_orphan_folders,
+            "orphan_files": self.sweep_orphan_files,
+            "orphan_activity": self.sweep_orphan_activity,
+            "orphan_blobs": self.sweep_orphan_blobs,
+        }
+
+    async def run(self, names: Optional[list[str]] = None, max_batches: Optional[int] = None) -> dict:
+        """Runs the given sweeps (all by default), each for at most `max_batches` batches."""
+        results = {}
+        for name in names or list(self.sweeps):
+            stats = SweepStats(name)
+            self.cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.GC_GRACE_SECONDS)
+            await self.sweeps[name](stats, max_batches)
+            results[name] = stats.as_dict()
+            logger.info("Maintenance sweep %s: %s", name, results[name])
+        return results
+
+    async def _cursor(self, name: str):
+        if self.dry_run:
+            return None
+        state = await self.db.maintenance_state.find_one({"_id": name})
+        return (state or {}).get("cursor")
+
+    async def _checkpoint(self, name: str, cursor, stats: SweepStats):
+        if self.dry_run:
+            return
+        update = {"cursor": cursor, "updated_at": datetime.datetime.utcnow()}
+        if cursor is None:
+            update["last_completed_at"] = update["updated_at"]
+        reclaimed, size = stats.unsaved()
+        await self.db.maintenance_state.update_one(
+            {"_id": name},
+            {"$set": update, "$inc": {"reclaimed": reclaimed, "bytes": size}},
+            upsert=True
+        )
+
+    async def _batches(self, name: str, collection, query: dict, projection: dict, stats: SweepStats,
+                       max_batches: Optional[int]):
+        """Yields batches of `collection` in _id order from the saved position."""
+        cursor = await self._cursor(name)
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            page_query = dict(query)
+            if cursor is not None:
+                page_query["_id"] = {"$gt": cursor}
+            docs = await collection.find(page_query, projection).sort("_id", 1).limit(self.batch_size).to_list(length=self.batch_size)
+            if not docs:
+                stats.completed = True
+                await self._checkpoint(name, None, stats)
+                return
+            stats.scanned += len(docs)
+            yield docs
+            cursor = docs[-1]["_id"]
+            await self._checkpoint(name, cursor, stats)
+            batches += 1
+            await asyncio.sleep(self.pause)
+
+    async def _existing(self, collection, ids) -> set:
+        ids = list({i for i in ids if i})
+        if not ids:
+            return set()
+        return {doc["_id"] for doc in await collection.find({"_id": {"$in": ids}}, {"_id": 1}).to_list(length=None)}
+
+    async def sweep_orphan_folders(self, stats: SweepStats, max_batches: Optional[int] = None):
+        # Folders whose parent or owner no longer exists; their own children are
+        # picked up on a later batch or pass once they become orphans in turn
+        async for docs in self._batches(
+            "orphan_folders", self.db.folders, {"created_at": {"$lt": self.cutoff}},
+            {"user_id": 1, "parent_id": 1}, stats, max_batches
+        ):
+            parents = await self._existing(self.db.folders, [doc.get("parent_id") for doc in docs])
+            users = await self._existing(self.db.users, [doc["user_id"] for doc in docs])
+            orphans = [
+                doc for doc in docs
+                if doc["user_id"] not in users or (doc.get("parent_id") and doc["parent_id"] not in parents)
+            ]
+            for doc in orphans:
+                if self.dry_run:
+                    stats.reclaim()
+                    continue
+                deleted = await self.db.folders.find_one_and_delete(
+                    {"_id": doc["_id"], "parent_id": doc.get("parent_id")}, {"user_id": 1}
+                )
+                if not deleted:
+                    continue
+                stats.reclaim()
+                if doc["user_id"] in users:
+                    change = usage.UsageChange(doc["user_id"])
+                    change.remove_folder(None)
+                    await change.apply(self.db)
+                    await journal.record_change(self.db, doc["user_id"], journal.FOLDER, doc["_id"], journal.DELETE)
+
+    async def sweep_orphan_files(self, stats: SweepStats, max_batches: Optional[int] = None):
+        # Files of deleted users are removed. Files whose folder is gone are moved to the
+        # top level instead: the folder may have been deleted under a file just moved into it
+        async for docs in self._batches(
+            "orphan_files", self.db.files,
+            {"created_at": {"$lt": self.cutoff}, "moved_at": {"$not": {"$gte": self.cutoff}}},
+            {"user_id": 1, "folder_id": 1, "storage_backend": 1, "storage_key": 1, "blob_size": 1, "file_size": 1},
+            stats, max_batches
+        ):
+            folders = await self._existing(self.db.folders, [doc.get("folder_id") for doc in docs])
+            users = await self._existing(self.db.users, [doc["user_id"] for doc in docs])
+            for doc in docs:
+                if doc["user_id"] in users:
+                    if doc.get("folder_id") and doc["folder_id"] not in folders:
+                        await self._rehome_file(doc, stats)
+                    continue
+                size = usage.stored_size(doc)
+                if self.dry_run:
+                    stats.reclaim(size=size)
+                    continue
+                deleted = await self.db.files.find_one_and_delete({"_id": doc["_id"]}, {"_id": 1})
+                if not deleted:
+                    continue
+                if doc.get("storage_key"):
+                    await get_backend(doc.get("storage_backend")).delete(doc["storage_key"])
+                blob_cache.invalidate(doc["_id"])
+                stats.reclaim(size=size)
+
+    async def _rehome_file(self, doc: dict, stats: SweepStats):
+        if self.dry_run:
+            stats.rehomed += 1
+            return
+        # Matching the stale folder_id skips files moved somewhere valid since the scan
+        moved = await self.db.files.find_one_and_update(
+            {"_id": doc["_id"], "folder_id": doc["folder_id"]},
+            {"$set": {"folder_id": None, "moved_at": datetime.datetime.utcnow()}},
+            {"_id": 1}
+        )
+        if not moved:
+            return
+        stats.rehomed += 1
+        # No counters change: the top level has none of its own and the old folder's went with it
+        await journal.record_change(self.db, doc["user_id"], journal.FILE, doc["_id"], journal.UPSERT)
+
+    async def sweep_orphan_activity(self, stats: SweepStats, max_batches: Optional[int] = None):
+        # Walks the distinct user ids of the log through the (user_id, timestamp) index,
+        # one seek per user, rather than every entry
+        cursor = await self._cursor("orphan_activity")
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            user_ids = []
+            while len(user_ids) < self.batch_size:
+                query = {"user_id": {"$gt": user_ids[-1] if user_ids else cursor}} if user_ids or cursor else {}
+                doc = await self.db.activity_logs.find_one(query, {"user_id": 1}, sort=[("user_id", 1)])
+                if doc is None or doc.get("user_id") is None:
+                    break
+                user_ids.append(doc["user_id"])
+            if not user_ids:
+                stats.completed = True
+                await self._checkpoint("orphan_activity", None, stats)
+                return
+            stats.scanned += len(user_ids)
+            missing = list(set(user_ids) - await self._existing(self.db.users, user_ids))
+            if missing:
+                if self.dry_run:
+                    stats.reclaim(await self.db.activity_logs.count_documents({"user_id": {"$in": missing}}))
+                else:
+                    result = await self.db.activity_logs.delete_many({"user_id": {"$in": missing}})
+                    stats.reclaim(result.deleted_count)
+            cursor = user_ids[-1]
+            await self._checkpoint("orphan_activity", cursor, stats)
+            batches += 1
+            await asyncio.sleep(self.pause)
+
+    async def sweep_orphan_blobs(self, stats: SweepStats, max_batches: Optional[int] = None):
+        # Blobs in the configured backend that no file document references, and parts
+        # of upload sessions that are gone (the session GC only removes parts it knows of)
+        name = f"orphan_blobs:{self.storage.name}"
+        cursor = await self._cursor(name)
+        keys = self.storage.iter_keys(after=cursor)
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            batch = []
+            async for blob in keys:
+                batch.append(blob)
+                if len(batch) >= self.batch_size:
+                    break
+            if not batch:
+                stats.completed = True
+                await self._checkpoint(name, None, stats)
+                return
+            stats.scanned += len(batch)
+            candidates = [blob for blob in batch if blob.modified < self.cutoff]
+            parts = [blob for blob in candidates if blob.key.startswith(PART_PREFIX)]
+            blobs = [blob for blob in candidates if not blob.key.startswith(PART_PREFIX)]
+
+            live = set()
+            if blobs:
+                keys_in_batch = [blob.key for blob in blobs]
+                async for doc in self.db.files.find(
+                    {"$or": [{"_id": {"$in": keys_in_batch}}, {"storage_key": {"$in": keys_in_batch}}]},
+                    {"storage_key": 1}
+                ):
+                    live.add(doc.get("storage_key") or doc["_id"])
+            sessions = await self._existing(self.db.upload_sessions, [part_session_id(blob.key) for blob in parts])
+            live.update(blob.key for blob in parts if part_session_id(blob.key) in sessions)
+
+            for blob in candidates:
+                if blob.key in live:
+                    continue
+                if not self.dry_run:
+                    await self.storage.delete(blob.key)
+                stats.reclaim(size=blob.size)
+
+            await self._checkpoint(name, batch[-1].key, stats)
+            batches += 1
+            await asyncio.sleep(self.pause)
+
+
+async def acquire_lease(db, owner: str, seconds: float) -> bool:
+    """Makes sure only one worker runs the background sweeps at a time."""
+    now = datetime.datetime.utcnow()
+    try:
+        await db.maintenance_state.find_one_and_update(
+            {"_id": LEASE_ID, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + datetime.timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def maintenance_loop(db):
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    maintenance = Maintenance(db)
+    while True:
+        await asyncio.sleep(settings.GC_INTERVAL_SECONDS)
+        try:
+            # Held for a whole interval so another worker can't start while this one runs
+            if not await acquire_lease(db, owner, settings.GC_INTERVAL_SECONDS * 2):
+                continue
+            for name in maintenance.sweeps:
+                await maintenance.run([name])
+                await acquire_lease(db, owner, settings.GC_INTERVAL_SECONDS * 2)
+        except Exception:
+            logger.exception("Maintenance sweep failed")
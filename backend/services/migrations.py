@@ -0,0 +1,41 @@
+import hashlib
+import logging
+
+from services.storage import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+
+async def migrate_blobs(db, storage: StorageBackend, batch_size: int = 50) -> int:
+    """Move legacy `encrypted_blob` fields out of `files` into `storage`.
+
+    Safe to re-run: a document is only unset after its blob has been written,
+    so an interrupted run simply picks up the remaining documents next time.
+    """
+    migrated = 0
+    while True:
+        docs = await db.files.find(
+            {"encrypted_blob": {"$exists": True}},
+            {"_id": 1, "encrypted_blob": 1}
+        ).limit(batch_size).to_list(length=batch_size)
+        if not docs:
+            break
+
+        for doc in docs:
+            blob = bytes(doc["encrypted_blob"])
+            await storage.put(doc["_id"], blob)
+            await db.files.update_one(
+                {"_id": doc["_id"]},
+                {
+                    "$set": {
+                        "storage_backend": storage.name,
+                        "storage_key": doc["_id"],
+                        "blob_size": len(blob),
+                        "sha256": hashlib.sha256(blob).hexdigest()
+                    },
+                    "$unset": {"encrypted_blob": ""}
+                }
+            )
+            migrated += 1
+        logger.info("Migrated %d blobs so far", migrated)
+    return migrated
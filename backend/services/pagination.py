@@ -0,0 +1,72 @@
+import base64
+import binascii
+import datetime
+import json
+from typing import Optional
+
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Query value meaning "items at the top level" (folder_id / parent_id of None)
+ROOT = "root"
+
+
+def encode_cursor(doc: dict) -> str:
+    raw = json.dumps({"c": doc["created_at"].isoformat(), "i": doc["_id"]}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.datetime.fromisoformat(data["c"]), str(data["i"])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def parse_fields(fields: Optional[str], allowed: set[str]) -> Optional[dict]:
+    # Comma separated field list -> Mongo projection; `_id` and `created_at` are always
+    # returned because the cursor is built from them
+    if not fields:
+        return None
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = requested - allowed
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    projection = {name: 1 for name in requested}
+    projection["created_at"] = 1
+    return projection
+
+
+async def keyset_page(collection, query: dict, projection: Optional[dict], limit: int, cursor: Optional[str]):
+    """Returns one page ordered by (created_at, _id) plus the cursor for the next one.
+
+    Paging on the sort key instead of skip() keeps every page an index range scan
+    on (user_id, <parent>, created_at, _id), however deep into the listing it is.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if cursor:
+        created_at, last_id = decode_cursor(cursor)
+        query = {
+            **query,
+            "$or": [
+                {"created_at": {"$gt": created_at}},
+                {"created_at": created_at, "_id": {"$gt": last_id}}
+            ]
+        }
+
+    docs = await collection.find(query, projection).sort(
+        [("created_at", 1), ("_id", 1)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1])
+
+    for doc in docs:
+        doc["id"] = doc.pop("_id")
+    return {"items": docs, "next_cursor": next_cursor}
@@ -0,0 +1,122 @@
+import asyncio
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+import uuid
+
+from core.config import settings
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+def _thread_stack(frame) -> list[str]:
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _await_chain(task) -> list[str]:
+    # Follows the chain of awaited coroutines from the task down to where it is suspended
+    stack = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(_frame_label(frame))
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return stack
+
+
+class RequestProfile:
+    """Wall-clock sampling profile of one request.
+
+    A helper thread wakes every `interval` seconds and looks at the event loop:
+    if the request's task is the one running, the loop thread's stack is
+    recorded under `running`; otherwise the coroutine chain the task is
+    suspended in is recorded under `waiting` (I/O, worker pools) or
+    `waiting_loop_busy` when another task is holding the loop. Samples are
+    kept as folded stacks, ready for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, method: str, path: str, interval: float):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.loop_thread_id = threading.get_ident()
+        self.started_at = datetime.datetime.utcnow()
+        self.duration = None
+        self.samples = collections.Counter()
+        self.states = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample_loop, name=f"profiler-{self.id[:8]}", daemon=True)
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self._start
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample_loop(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self._sample()
+            except RuntimeError:
+                # The task or frames changed under us mid-walk; skip this tick
+                continue
+
+    def _sample(self):
+        running = asyncio.current_task(self.loop)
+        if running is self.task:
+            frame = sys._current_frames().get(self.loop_thread_id)
+            state, stack = "running", _thread_stack(frame)
+        else:
+            state = "waiting" if running is None else "waiting_loop_busy"
+            stack = _await_chain(self.task)
+        self.states[state] += 1
+        self.samples[";".join([state, *stack])] += 1
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at,
+            "duration_seconds": self.duration,
+            "samples": sum(self.states.values()),
+            "states": dict(self.states),
+        }
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+recent_profiles: "collections.OrderedDict[str, RequestProfile]" = collections.OrderedDict()
+
+
+def start_profile(method: str, path: str) -> RequestProfile:
+    profile = RequestProfile(method, path, settings.PROFILER_INTERVAL_SECONDS)
+    profile.start()
+    return profile
+
+
+def finish_profile(profile: RequestProfile):
+    profile.stop()
+    recent_profiles[profile.id] = profile
+    while len(recent_profiles) > settings.PROFILER_HISTORY:
+        recent_profiles.popitem(last=False)
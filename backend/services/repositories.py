@@ -0,0 +1,426 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, Optional
+
+from fastapi import Depends
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from core.config import settings
+from core.db import get_db, get_read_db
+
+# Point lookups and single-document writes for users, files, folders and activity.
+# A backend holds one store per collection (MongoBackend, or MemoryBackend with
+# REPOSITORY_BACKEND=memory); `Repositories` wraps a backend for the length of one
+# request, batching and memoizing the lookups made through it. Scans, bulk writes
+# and aggregations still go to the collections directly.
+
+# Blobs of unmigrated documents only come back when asked for; staged rotation keys never do
+BLOB_EXCLUDE = {"encrypted_blob": 0, "pending_key": 0}
+
+
+class Loader:
+    """Coalesces the lookups made in one event-loop turn into a single `fetch`
+    call and memoizes the results for the rest of the request.
+
+    `fetch` takes a list of keys and returns a dict of the keys it found.
+    """
+
+    def __init__(self, fetch: Callable[[list], Awaitable[dict]]):
+        self._fetch = fetch
+        self._results: dict[Hashable, asyncio.Future] = {}
+        self._queue: dict[Hashable, asyncio.Future] = {}
+        # The event loop only keeps weak references to tasks
+        self._dispatches: set[asyncio.Task] = set()
+
+    async def load(self, key: Hashable) -> Optional[dict]:
+        future = self._results.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._results[key] = loop.create_future()
+            if not self._queue:
+                # Everything queued before this callback runs goes out in the same batch
+                loop.call_soon(self._schedule_dispatch)
+            self._queue[key] = future
+        doc = await future
+        # Callers reshape what they get (`_id` -> `id`), so the memoized copy stays untouched
+        return dict(doc) if doc is not None else None
+
+    async def load_many(self, keys: list) -> list[Optional[dict]]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def _schedule_dispatch(self):
+        task = asyncio.ensure_future(self._dispatch())
+        self._dispatches.add(task)
+        task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self):
+        batch, self._queue = self._queue, {}
+        try:
+            found = await self._fetch(list(batch))
+        except Exception as exc:
+            for key, future in batch.items():
+                self._results.pop(key, None)
+                future.set_exception(exc)
+            return
+        for key, future in batch.items():
+            future.set_result(found.get(key))
+
+    def prime(self, key: Hashable, doc: Optional[dict]):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(dict(doc) if doc is not None else None)
+        self._results[key] = future
+
+    def clear(self, key: Hashable):
+        if key not in self._queue:
+            self._results.pop(key, None)
+
+
+class MongoUsers:
+    def __init__(self, db):
+        self.collection = db.users
+
+    async def fetch(self, ids: list[str]) -> list[dict]:
+        return await self.collection.find({"_id": {"$in": ids}}).to_list(length=len(ids))
+
+    async def by_email(self, email: str) -> Optional[dict]:
+        return await self.collection.find_one({"email": email})
+
+    async def insert(self, doc: dict):
+        await self.collection.insert_one(doc)
+
+    async def update(self, user_id: str, fields: dict) -> Optional[dict]:
+        return await self.collection.find_one_and_update(
+            {"_id": user_id}, {"$set": fields}, return_document=ReturnDocument.BEFORE
+        )
+
+    async def increment(self, user_id: str, field: str, amount: int) -> Optional[int]:
+        doc = await self.collection.find_one_and_update(
+            {"_id": user_id}, {"$inc": {field: amount}},
+            projection={field: 1}, return_document=ReturnDocument.AFTER
+        )
+        return doc[field] if doc is not None else None
+
+    async def add_usage(self, user_id: str, counts: dict, latest: Optional[dict] = None,
+                        quota: int = 0, extra_bytes: int = 0) -> bool:
+        query = {"_id": user_id}
+        if quota and extra_bytes > 0:
+            query["$expr"] = {"$lte": [
+                {"$add": [
+                    {"$ifNull": ["$usage.bytes", 0]},
+                    {"$ifNull": ["$usage.reserved_bytes", 0]},
+                    extra_bytes
+                ]},
+                quota
+            ]}
+        update = {"$inc": {f"usage.{field}": value for field, value in counts.items()}}
+        if latest:
+            update["$max"] = {f"usage.{field}": value for field, value in latest.items()}
+        result = await self.collection.update_one(query, update)
+        return result.matched_count > 0
+
+
+class MongoOwned:
+    """Documents scoped by `user_id`. `update` and `delete` return the document as
+    it was, so the caller never has to read it first."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def fetch(self, user_id: str, ids: list[str], projection: Optional[dict] = None) -> list[dict]:
+        return await self.collection.find(
+            {"_id": {"$in": ids}, "user_id": user_id}, projection
+        ).to_list(length=len(ids))
+
+    async def insert(self, doc: dict):
+        await self.collection.insert_one(doc)
+
+    async def update(self, user_id: str, doc_id: str, fields: dict) -> Optional[dict]:
+        return await self.collection.find_one_and_update(
+            {"_id": doc_id, "user_id": user_id}, {"$set": fields},
+            projection={"encrypted_blob": 0, "pending_key": 0}, return_document=ReturnDocument.BEFORE
+        )
+
+    async def delete(self, user_id: str, doc_id: str) -> Optional[dict]:
+        return await self.collection.find_one_and_delete(
+            {"_id": doc_id, "user_id": user_id}, projection={"encrypted_blob": 0, "pending_key": 0}
+        )
+
+
+class MongoActivity:
+    def __init__(self, db):
+        self.collection = db.activity_logs
+
+    async def recent(self, user_id: str, limit: int) -> list[dict]:
+        return await self.collection.find({"user_id": user_id}).sort("timestamp", -1).limit(limit).to_list(length=limit)
+
+    async def insert_many(self, docs: list[dict]):
+        await self.collection.insert_many(docs, ordered=False)
+
+
+class MongoBackend:
+    def __init__(self, db):
+        self.users = MongoUsers(db)
+        self.files = MongoOwned(db.files)
+        self.folders = MongoOwned(db.folders)
+        self.activity = MongoActivity(db)
+
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    # Stores are only ever given exclusion projections
+    return {k: v for k, v in doc.items() if not projection or projection.get(k, 1)}
+
+
+class MemoryUsers:
+    def __init__(self):
+        self.docs: dict[str, dict] = {}
+
+    async def fetch(self, ids: list[str]) -> list[dict]:
+        return [dict(self.docs[user_id]) for user_id in ids if user_id in self.docs]
+
+    async def by_email(self, email: str) -> Optional[dict]:
+        doc = next((doc for doc in self.docs.values() if doc.get("email") == email), None)
+        return dict(doc) if doc is not None else None
+
+    async def insert(self, doc: dict):
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"Duplicate user id {doc['_id']}")
+        self.docs[doc["_id"]] = dict(doc)
+
+    async def update(self, user_id: str, fields: dict) -> Optional[dict]:
+        doc = self.docs.get(user_id)
+        if doc is None:
+            return None
+        self.docs[user_id] = {**doc, **fields}
+        return dict(doc)
+
+    async def increment(self, user_id: str, field: str, amount: int) -> Optional[int]:
+        doc = self.docs.get(user_id)
+        if doc is None:
+            return None
+        doc[field] = doc.get(field, 0) + amount
+        return doc[field]
+
+    async def add_usage(self, user_id: str, counts: dict, latest: Optional[dict] = None,
+                        quota: int = 0, extra_bytes: int = 0) -> bool:
+        doc = self.docs.get(user_id)
+        if doc is None:
+            return False
+        usage = dict(doc.get("usage") or {})
+        if quota and extra_bytes > 0 and usage.get("bytes", 0) + usage.get("reserved_bytes", 0) + extra_bytes > quota:
+            return False
+        for field, value in counts.items():
+            usage[field] = usage.get(field, 0) + value
+        for field, value in (latest or {}).items():
+            if usage.get(field) is None or value > usage[field]:
+                usage[field] = value
+        doc["usage"] = usage
+        return True
+
+
+class MemoryOwned:
+    def __init__(self):
+        self.docs: dict[str, dict] = {}
+
+    def _owned(self, user_id: str, doc_id: str) -> Optional[dict]:
+        doc = self.docs.get(doc_id)
+        return doc if doc is not None and doc.get("user_id") == user_id else None
+
+    async def fetch(self, user_id: str, ids: list[str], projection: Optional[dict] = None) -> list[dict]:
+        found = (self._owned(user_id, doc_id) for doc_id in dict.fromkeys(ids))
+        return [_project(doc, projection) for doc in found if doc is not None]
+
+    async def insert(self, doc: dict):
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"Duplicate id {doc['_id']}")
+        self.docs[doc["_id"]] = dict(doc)
+
+    async def update(self, user_id: str, doc_id: str, fields: dict) -> Optional[dict]:
+        doc = self._owned(user_id, doc_id)
+        if doc is None:
+            return None
+        self.docs[doc_id] = {**doc, **fields}
+        return _project(doc, BLOB_EXCLUDE)
+
+    async def delete(self, user_id: str, doc_id: str) -> Optional[dict]:
+        doc = self._owned(user_id, doc_id)
+        if doc is None:
+            return None
+        del self.docs[doc_id]
+        return _project(doc, BLOB_EXCLUDE)
+
+
+class MemoryActivity:
+    def __init__(self):
+        self.docs: list[dict] = []
+
+    async def recent(self, user_id: str, limit: int) -> list[dict]:
+        logs = [dict(doc) for doc in self.docs if doc.get("user_id") == user_id]
+        logs.sort(key=lambda doc: doc["timestamp"], reverse=True)
+        return logs[:limit]
+
+    async def insert_many(self, docs: list[dict]):
+        self.docs.extend(dict(doc) for doc in docs)
+
+
+class MemoryBackend:
+    """Keeps everything in process memory; state lives as long as the instance."""
+
+    def __init__(self):
+        self.users = MemoryUsers()
+        self.files = MemoryOwned()
+        self.folders = MemoryOwned()
+        self.activity = MemoryActivity()
+
+
+class UserRepository:
+    def __init__(self, store):
+        self.store = store
+        self._loader = Loader(self._fetch)
+
+    async def _fetch(self, ids: list[str]) -> dict:
+        return {doc["_id"]: doc for doc in await self.store.fetch(ids)}
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        return await self._loader.load(user_id)
+
+    async def by_email(self, email: str) -> Optional[dict]:
+        doc = await self.store.by_email(email)
+        if doc is not None:
+            self._loader.prime(doc["_id"], doc)
+        return doc
+
+    async def insert(self, doc: dict):
+        await self.store.insert(doc)
+        self._loader.prime(doc["_id"], doc)
+
+    async def update(self, user_id: str, fields: dict) -> bool:
+        before = await self.store.update(user_id, fields)
+        self._loader.prime(user_id, {**before, **fields} if before is not None else None)
+        return before is not None
+
+    async def increment(self, user_id: str, field: str, amount: int = 1) -> Optional[int]:
+        """Adds `amount` to a counter field and returns its new value, or None if there is no such user."""
+        value = await self.store.increment(user_id, field, amount)
+        self._loader.clear(user_id)
+        return value
+
+    async def add_usage(self, user_id: str, counts: dict, latest: Optional[dict] = None,
+                        quota: int = 0, extra_bytes: int = 0) -> bool:
+        """Adds `counts` to the `usage` counters and raises the timestamps in `latest`.
+
+        With a `quota`, nothing changes unless `extra_bytes` more still fit in it.
+        Returns False if the update was refused or there is no such user.
+        """
+        applied = await self.store.add_usage(user_id, counts, latest, quota, extra_bytes)
+        self._loader.clear(user_id)
+        return applied
+
+
+class OwnedRepository:
+    """Files or folders of one user, looked up by id through a request-scoped Loader."""
+
+    def __init__(self, store):
+        self.store = store
+        self._loader = Loader(self._fetch)
+
+    async def _fetch(self, keys: list[tuple[str, str]], projection: Optional[dict] = BLOB_EXCLUDE) -> dict:
+        # Keys are (user_id, id); one query per user, and a request only ever has one
+        by_user = {}
+        for user_id, doc_id in keys:
+            by_user.setdefault(user_id, []).append(doc_id)
+        found = {}
+        for user_id, ids in by_user.items():
+            for doc in await self.store.fetch(user_id, ids, projection):
+                found[(user_id, doc["_id"])] = doc
+        return found
+
+    async def get(self, user_id: str, doc_id: str) -> Optional[dict]:
+        return await self._loader.load((user_id, doc_id))
+
+    async def get_many(self, user_id: str, ids: list[str]) -> list[dict]:
+        """The documents that exist, in the order of `ids`."""
+        docs = await self._loader.load_many([(user_id, doc_id) for doc_id in dict.fromkeys(ids)])
+        return [doc for doc in docs if doc is not None]
+
+    async def insert(self, doc: dict):
+        await self.store.insert(doc)
+        self._loader.prime((doc["user_id"], doc["_id"]), {k: v for k, v in doc.items() if k != "encrypted_blob"})
+
+    async def update(self, user_id: str, doc_id: str, fields: dict) -> Optional[dict]:
+        """Sets `fields` and returns the document as it was before, or None if the user has no such document."""
+        before = await self.store.update(user_id, doc_id, fields)
+        self._loader.prime((user_id, doc_id), {**before, **fields} if before is not None else None)
+        return before
+
+    async def delete(self, user_id: str, doc_id: str) -> Optional[dict]:
+        deleted = await self.store.delete(user_id, doc_id)
+        self._loader.prime((user_id, doc_id), None)
+        return deleted
+
+
+class FileRepository(OwnedRepository):
+    def __init__(self, store):
+        super().__init__(store)
+        self._blob_loader = Loader(self._fetch_blobs)
+
+    async def _fetch_blobs(self, keys: list[tuple[str, str]]) -> dict:
+        return await self._fetch(keys, None)
+
+    async def get_with_blob(self, user_id: str, file_id: str) -> Optional[dict]:
+        # The whole document, inline `encrypted_blob` of unmigrated files included. Batched
+        # like get(), but not kept for the rest of the request since inline blobs can be large
+        try:
+            return await self._blob_loader.load((user_id, file_id))
+        finally:
+            self._blob_loader.clear((user_id, file_id))
+
+
+class ActivityRepository:
+    def __init__(self, store):
+        self.store = store
+
+    async def recent(self, user_id: str, limit: int = 10) -> list[dict]:
+        return await self.store.recent(user_id, limit)
+
+    async def insert_many(self, docs: list[dict]):
+        await self.store.insert_many(docs)
+
+
+class Repositories:
+    """Per-request view of a backend; lookups repeated within the request are served from memory."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.users = UserRepository(backend.users)
+        self.files = FileRepository(backend.files)
+        self.folders = OwnedRepository(backend.folders)
+        self.activity = ActivityRepository(backend.activity)
+
+
+_memory_backend: Optional[MemoryBackend] = None
+
+
+def backend_for(db):
+    """A MongoBackend over `db`, or the process-wide MemoryBackend when REPOSITORY_BACKEND is "memory"."""
+    global _memory_backend
+    if settings.REPOSITORY_BACKEND == "memory":
+        if _memory_backend is None:
+            _memory_backend = MemoryBackend()
+        return _memory_backend
+    if settings.REPOSITORY_BACKEND != "mongo":
+        raise ValueError(f"Unknown REPOSITORY_BACKEND: {settings.REPOSITORY_BACKEND!r}")
+    return MongoBackend(db)
+
+
+def open_repositories(db) -> Repositories:
+    # For code outside a request (services, background tasks); nothing is shared with the request's memo
+    return Repositories(backend_for(db))
+
+
+# FastAPI resolves a dependency once per request, which is what scopes the memoization
+async def get_repositories(db=Depends(get_db)) -> Repositories:
+    return open_repositories(db)
+
+
+async def get_read_repositories(db=Depends(get_read_db)) -> Repositories:
+    return open_repositories(db)
@@ -0,0 +1,187 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import AsyncIterator
+
+from fastapi import HTTPException
+
+from core.config import settings
+from services import metrics
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+# Idle users beyond this many are forgotten (their buckets are full again by then anyway)
+MAX_TRACKED_USERS = 10000
+
+rejections = metrics.registry.counter(
+    "secsky_scheduler_rejections_total", "Requests refused with 429 by the per-user scheduler", labels=("reason",)
+)
+pacing_delay = metrics.registry.histogram(
+    "secsky_scheduler_pacing_seconds", "Time transfers slept to stay within a per-user byte rate",
+    labels=("direction",)
+)
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `capacity`.
+
+    `charge` may take the balance below zero; the debt is paid back by
+    waiting, which is how byte rates are paced rather than refused.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def take(self, amount: float = 1) -> float:
+        """Takes `amount` if available; otherwise returns the seconds until it will be."""
+        self._refill()
+        missing = amount - self.tokens
+        if missing <= 0:
+            self.tokens -= amount
+            return 0
+        return missing / self.rate
+
+    def charge(self, amount: float) -> float:
+        """Takes `amount` unconditionally and returns how long until the balance is back at zero."""
+        self._refill()
+        self.tokens -= amount
+        return max(-self.tokens / self.rate, 0)
+
+    def debt(self) -> float:
+        return max(-self.available() / self.rate, 0)
+
+
+class UserState:
+    def __init__(self):
+        self.requests = None
+        if settings.RATE_LIMIT_REQUESTS_PER_SECOND > 0:
+            self.requests = TokenBucket(settings.RATE_LIMIT_REQUESTS_PER_SECOND, settings.RATE_LIMIT_BURST)
+        self.bytes = {}
+        for direction, rate in ((UPLOAD, settings.UPLOAD_BYTES_PER_SECOND), (DOWNLOAD, settings.DOWNLOAD_BYTES_PER_SECOND)):
+            if rate > 0:
+                self.bytes[direction] = TokenBucket(rate, max(settings.TRANSFER_BURST_BYTES, 1))
+        self.transfers = 0
+
+
+def too_many(reason: str, retry_after: float, detail: str) -> HTTPException:
+    rejections.inc(reason=reason)
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(math.ceil(retry_after), 1))})
+
+
+class Transfer:
+    """A per-user transfer slot; byte streams pass through `paced` to respect the user's rate."""
+
+    def __init__(self, scheduler: "Scheduler", user_id: str, state: UserState, direction: str):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.direction = direction
+        self.bucket = state.bytes.get(direction)
+        self.handed_off = False
+        self._released = False
+
+    async def pace(self, size: int):
+        if self.bucket is None or not size:
+            return
+        wait = self.bucket.charge(size)
+        if wait > 0:
+            pacing_delay.observe(wait, direction=self.direction)
+            await asyncio.sleep(wait)
+
+    async def paced(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        async for chunk in chunks:
+            await self.pace(len(chunk))
+            yield chunk
+
+    def hand_off(self) -> "Transfer":
+        """Passes the slot on to a streaming response, which releases it once the body is sent."""
+        self.handed_off = True
+        return self
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.scheduler._finish(self.user_id)
+
+
+class Scheduler:
+    """Per-user admission control, keyed by the user id from get_current_user
+    (or from UploadAdmissionMiddleware for uploads, before their body is read).
+
+    Every authenticated request takes a token from the user's request bucket.
+    Uploads and downloads additionally need a transfer slot: they are refused
+    while fewer than RATE_LIMIT_TRANSFER_RESERVE request tokens are left (so
+    metadata calls keep working when a user is near the limit), beyond
+    MAX_TRANSFERS_PER_USER / MAX_TRANSFERS concurrent transfers, or while the
+    user's byte debt is above MAX_TRANSFER_WAIT_SECONDS. Admitted transfers are
+    paced to UPLOAD/DOWNLOAD_BYTES_PER_SECOND.
+    """
+
+    def __init__(self):
+        self._users: "OrderedDict[str, UserState]" = OrderedDict()
+        self.active_transfers = 0
+
+    def _state(self, user_id: str) -> UserState:
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = UserState()
+            self._prune()
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    def _prune(self):
+        for user_id in list(self._users):
+            if len(self._users) <= MAX_TRACKED_USERS:
+                break
+            if not self._users[user_id].transfers:
+                del self._users[user_id]
+
+    def admit(self, user_id: str):
+        state = self._state(user_id)
+        if state.requests is not None:
+            wait = state.requests.take()
+            if wait:
+                raise too_many("requests", wait, "Too many requests")
+
+    def open_transfer(self, user_id: str, direction: str) -> Transfer:
+        state = self._state(user_id)
+        if state.requests is not None and state.requests.available() < settings.RATE_LIMIT_TRANSFER_RESERVE:
+            wait = (settings.RATE_LIMIT_TRANSFER_RESERVE - state.requests.available()) / state.requests.rate
+            raise too_many("transfer_reserve", wait, "Too many requests")
+        if settings.MAX_TRANSFERS_PER_USER and state.transfers >= settings.MAX_TRANSFERS_PER_USER:
+            raise too_many("user_transfers", 1, "Too many transfers in progress")
+        if settings.MAX_TRANSFERS and self.active_transfers >= settings.MAX_TRANSFERS:
+            raise too_many("server_transfers", 1, "Server is busy with other transfers")
+        bucket = state.bytes.get(direction)
+        if bucket is not None and bucket.debt() > settings.MAX_TRANSFER_WAIT_SECONDS:
+            raise too_many("bandwidth", bucket.debt(), "Transfer rate limit exceeded")
+        state.transfers += 1
+        self.active_transfers += 1
+        return Transfer(self, user_id, state, direction)
+
+    def _finish(self, user_id: str):
+        self.active_transfers -= 1
+        state = self._users.get(user_id)
+        if state is not None:
+            state.transfers -= 1
+
+
+scheduler = Scheduler()
+metrics.registry.gauge(
+    "secsky_scheduler_active_transfers", "Uploads and downloads holding a transfer slot", lambda: scheduler.active_transfers
+)
+
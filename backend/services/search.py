@@ -0,0 +1,29 @@
+import re
+from typing import Optional
+
+from fastapi import HTTPException
+
+# Blind-index tokens are keyed hashes of normalized filename words/trigrams computed
+# in the browser. The server only stores and matches them; it cannot reverse them.
+MAX_TOKENS_PER_FILE = 256
+MAX_QUERY_TOKENS = 32
+_TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+def clean_tokens(tokens: Optional[list[str]], limit: int = MAX_TOKENS_PER_FILE) -> Optional[list[str]]:
+    """Validates client tokens (base64url/hex, 8-64 chars) and drops duplicates.
+
+    None means "not supplied" and leaves stored tokens untouched.
+    """
+    if tokens is None:
+        return None
+    unique = list(dict.fromkeys(token.strip() for token in tokens if token.strip()))
+    if len(unique) > limit:
+        raise HTTPException(status_code=400, detail=f"At most {limit} search tokens are allowed")
+    if any(not _TOKEN_PATTERN.match(token) for token in unique):
+        raise HTTPException(status_code=400, detail="Search tokens must be 8-64 base64url or hex characters")
+    return unique
+
+
+def token_query(tokens: list[str], match: str) -> dict:
+    return {"search_tokens": {"$all" if match == "all" else "$in": tokens}}
@@ -0,0 +1,309 @@
+import asyncio
+import datetime
+import hashlib
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, NamedTuple, Optional
+
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from core.config import settings
+
+# Blob keys are generated server-side (uuid strings), but refuse anything that
+# could escape the storage root just in case.
+_KEY_PATTERN = re.compile(r"^[A-Za-z0-9._-]+$")
+
+READ_CHUNK_SIZE = 256 * 1024
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class BlobInfo(NamedTuple):
+    key: str
+    size: int
+    modified: datetime.datetime  # naive UTC, like the rest of the stored timestamps
+
+
+class DigestingStream:
+    """Wraps a chunk iterator, hashing and counting bytes as they pass through.
+
+    Raises `BlobTooLarge` as soon as more than `max_size` bytes have been seen,
+    so callers can abort without buffering the rest of the payload.
+    """
+
+    def __init__(self, chunks: AsyncIterable[bytes], max_size: Optional[int] = None):
+        self._chunks = chunks
+        self._hash = hashlib.sha256()
+        self.max_size = max_size
+        self.size = 0
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    async def __aiter__(self):
+        async for chunk in self._chunks:
+            if not chunk:
+                continue
+            self.size += len(chunk)
+            if self.max_size is not None and self.size > self.max_size:
+                raise BlobTooLarge(self.size)
+            self._hash.update(chunk)
+            yield chunk
+
+
+class StorageBackend:
+    """Stores encrypted file blobs outside the `files` collection.
+
+    Documents in `files` only keep a reference (`storage_backend` + `storage_key`),
+    the ciphertext itself lives in whichever backend wrote it.
+    """
+
+    name: str = ""
+
+    async def put(self, key: str, data: bytes) -> int:
+        raise NotImplementedError
+
+    async def put_stream(self, key: str, chunks: AsyncIterable[bytes]) -> int:
+        raise NotImplementedError
+
+    async def read(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    async def open(self, key: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Yields the blob bytes in `[start, end)`; `end=None` reads to the end."""
+        raise NotImplementedError
+
+    async def size(self, key: str) -> int:
+        raise NotImplementedError
+
+    def local_path(self, key: str) -> Optional[Path]:
+        """Filesystem path of the blob when it is stored on local disk, else None."""
+        return None
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def iter_keys(self, after: Optional[str] = None) -> AsyncIterator[BlobInfo]:
+        """Yields every stored blob in key order, starting after `after` so scans can resume."""
+        raise NotImplementedError
+
+
+class LocalStorageBackend(StorageBackend):
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        if not _KEY_PATTERN.match(key) or key.startswith("."):
+            raise ValueError(f"Invalid storage key: {key!r}")
+        return self.root / key
+
+    @staticmethod
+    def _tmp_path(path: Path) -> Path:
+        # Unique per write, so concurrent or retried writes of one key never share a temp file
+        return path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+
+    def _write(self, path: Path, data: bytes):
+        # Write to a temp file first so a crash never leaves a truncated blob behind
+        tmp_path = self._tmp_path(path)
+        with open(tmp_path, "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
+
+    async def put(self, key: str, data: bytes) -> int:
+        await asyncio.to_thread(self._write, self._path(key), data)
+        return len(data)
+
+    async def put_stream(self, key: str, chunks: AsyncIterable[bytes]) -> int:
+        path = self._path(key)
+        tmp_path = self._tmp_path(path)
+        fh = await asyncio.to_thread(open, tmp_path, "wb")
+        size = 0
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(fh.write, chunk)
+                size += len(chunk)
+            await asyncio.to_thread(fh.flush)
+            await asyncio.to_thread(os.fsync, fh.fileno())
+        except BaseException:
+            fh.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        fh.close()
+        await asyncio.to_thread(os.replace, tmp_path, path)
+        return size
+
+    async def read(self, key: str) -> bytes:
+        path = self._path(key)
+        try:
+            return await asyncio.to_thread(path.read_bytes)
+        except FileNotFoundError:
+            raise BlobNotFound(key)
+
+    async def open(self, key: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        path = self._path(key)
+        try:
+            fh = await asyncio.to_thread(open, path, "rb")
+        except FileNotFoundError:
+            raise BlobNotFound(key)
+        try:
+            if start:
+                fh.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                size = READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining)
+                chunk = await asyncio.to_thread(fh.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            fh.close()
+
+    async def size(self, key: str) -> int:
+        try:
+            return (await asyncio.to_thread(os.stat, self._path(key))).st_size
+        except FileNotFoundError:
+            raise BlobNotFound(key)
+
+    def local_path(self, key: str) -> Optional[Path]:
+        return self._path(key)
+
+    async def delete(self, key: str) -> None:
+        try:
+            await asyncio.to_thread(os.remove, self._path(key))
+        except FileNotFoundError:
+            pass
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(self._path(key).exists)
+
+    async def iter_keys(self, after: Optional[str] = None) -> AsyncIterator[BlobInfo]:
+        # Dot files are in-flight temp files, not blobs
+        names = await asyncio.to_thread(
+            lambda: sorted(name for name in os.listdir(self.root) if not name.startswith("."))
+        )
+        for name in names:
+            if after is not None and name <= after:
+                continue
+            try:
+                stat = await asyncio.to_thread(os.stat, self.root / name)
+            except FileNotFoundError:
+                continue
+            yield BlobInfo(name, stat.st_size, datetime.datetime.utcfromtimestamp(stat.st_mtime))
+
+
+class GridFSStorageBackend(StorageBackend):
+    name = "gridfs"
+
+    def __init__(self, database, bucket_name: str = "blobs"):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name)
+
+    async def put(self, key: str, data: bytes) -> int:
+        # GridFS ids are unique, so overwriting means dropping the previous revision first
+        await self.delete(key)
+        await self.bucket.upload_from_stream_with_id(key, key, data)
+        return len(data)
+
+    async def put_stream(self, key: str, chunks: AsyncIterable[bytes]) -> int:
+        await self.delete(key)
+        grid_in = self.bucket.open_upload_stream_with_id(key, key)
+        size = 0
+        try:
+            async for chunk in chunks:
+                await grid_in.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            await grid_in.abort()
+            raise
+        await grid_in.close()
+        return size
+
+    async def read(self, key: str) -> bytes:
+        try:
+            grid_out = await self.bucket.open_download_stream(key)
+        except NoFile:
+            raise BlobNotFound(key)
+        return await grid_out.read()
+
+    async def open(self, key: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        try:
+            grid_out = await self.bucket.open_download_stream(key)
+        except NoFile:
+            raise BlobNotFound(key)
+        if start:
+            grid_out.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            yield chunk
+
+    async def size(self, key: str) -> int:
+        try:
+            grid_out = await self.bucket.open_download_stream(key)
+        except NoFile:
+            raise BlobNotFound(key)
+        return grid_out.length
+
+    async def delete(self, key: str) -> None:
+        try:
+            await self.bucket.delete(key)
+        except NoFile:
+            pass
+
+    async def exists(self, key: str) -> bool:
+        grid_file = await self.bucket.find({"_id": key}).to_list(length=1)
+        return bool(grid_file)
+
+    async def iter_keys(self, after: Optional[str] = None) -> AsyncIterator[BlobInfo]:
+        query = {"_id": {"$type": "string", "$gt": after}} if after is not None else {"_id": {"$type": "string"}}
+        async for grid_out in self.bucket.find(query, sort=[("_id", 1)]):
+            yield BlobInfo(grid_out._id, grid_out.length, grid_out.upload_date)
+
+
+_backends: dict[str, StorageBackend] = {}
+
+
+def get_backend(name: Optional[str] = None) -> StorageBackend:
+    name = name or settings.STORAGE_BACKEND
+    if name not in _backends:
+        if name == "local":
+            _backends[name] = LocalStorageBackend(Path(settings.UPLOAD_DIR))
+        elif name == "gridfs":
+            from core.db import db
+            _backends[name] = GridFSStorageBackend(db, bucket_name=settings.GRIDFS_BUCKET)
+        else:
+            raise ValueError(f"Unknown storage backend: {name!r}")
+    return _backends[name]
+
+
+def reset_backends():
+    """Drops the cached backends, so the GridFS one is rebuilt on the database bound next."""
+    _backends.clear()
+
+
+async def get_storage():
+    return get_backend()
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+from typing import Optional
+
+from core.config import settings
+from services.storage import get_backend
+from services import usage
+
+logger = logging.getLogger(__name__)
+
+
+PART_PREFIX = "upload-"
+
+OPEN = "open"
+# Claimed by a commit until `committing_until`; a commit whose worker died is taken over after that
+COMMITTING = "committing"
+# Status of a session whose file record exists; the session is kept until it
+# expires so a retried commit gets the same file back
+COMMITTED = "committed"
+
+
+class PartMismatch(Exception):
+    """A stored part no longer matches the size and sha256 recorded when it was uploaded."""
+
+    def __init__(self, index: int):
+        super().__init__(index)
+        self.index = index
+
+
+def part_key(session_id: str, index: int) -> str:
+    return f"{PART_PREFIX}{session_id}-{index:06d}"
+
+
+def part_session_id(key: str) -> str:
+    return key[len(PART_PREFIX):].rpartition("-")[0]
+
+
+def expected_chunk_size(session: dict, index: int) -> int:
+    if index == session["total_chunks"] - 1:
+        return session["total_size"] - session["chunk_size"] * index
+    return session["chunk_size"]
+
+
+def received_chunks(session: dict) -> list[int]:
+    return sorted(int(index) for index in session.get("parts", {}))
+
+
+async def iter_parts(session: dict):
+    # Each part is checked against what upload_chunk recorded, so a part rewritten
+    # by a racing PUT of the same index can't slip into the assembled file
+    storage = get_backend(session["storage_backend"])
+    for index in range(session["total_chunks"]):
+        recorded = session["parts"][str(index)]
+        digest = hashlib.sha256()
+        size = 0
+        async for chunk in storage.open(part_key(session["_id"], index)):
+            digest.update(chunk)
+            size += len(chunk)
+            yield chunk
+        if size != recorded["size"] or digest.hexdigest() != recorded["sha256"]:
+            raise PartMismatch(index)
+
+
+def claimable_query(session_id: str, user_id: str) -> dict:
+    """Matches the session if it is open, or if a commit claimed it and held the claim past its deadline."""
+    return {"_id": session_id, "user_id": user_id, "$or": [
+        {"status": OPEN},
+        {"status": COMMITTING, "committing_until": {"$not": {"$gte": datetime.datetime.utcnow()}}}
+    ]}
+
+
+def commit_in_progress(session: dict) -> bool:
+    deadline = session.get("committing_until")
+    return session["status"] == COMMITTING and deadline is not None and deadline >= datetime.datetime.utcnow()
+
+
+async def committed_file_id(db, session: dict) -> Optional[str]:
+    """The id of the file a commit of this session created, if it got that far.
+
+    The file record is the commit point: once it exists, the session's reservation
+    has been turned into usage by save_file_record.
+    """
+    file_id = session.get("file_id")
+    if file_id and await db.files.find_one({"_id": file_id}, {"_id": 1}):
+        return file_id
+    return None
+
+
+async def discard_parts(session: dict):
+    storage = get_backend(session["storage_backend"])
+    for index in received_chunks(session):
+        await storage.delete(part_key(session["_id"], index))
+
+
+async def discard_session(db, session: dict):
+    await discard_parts(session)
+    await db.upload_sessions.delete_one({"_id": session["_id"]})
+
+
+async def purge_expired_sessions(db, batch_size: int = 100) -> int:
+    purged = 0
+    now = datetime.datetime.utcnow()
+    while True:
+        sessions = await db.upload_sessions.find(
+            {"expires_at": {"$lt": now}},
+            {"user_id": 1, "storage_backend": 1, "parts": 1, "reserved": 1, "status": 1, "file_id": 1}
+        ).limit(batch_size).to_list(length=batch_size)
+        if not sessions:
+            return purged
+        for session in sessions:
+            # A committed reservation is already charged to its file
+            committed = session.get("status") == COMMITTED or await committed_file_id(db, session)
+            await discard_session(db, session)
+            if not committed:
+                await usage.release(db, session["user_id"], session.get("reserved", 0))
+            purged += 1
+
+
+async def session_gc_loop(db):
+    while True:
+        await asyncio.sleep(settings.UPLOAD_SESSION_GC_INTERVAL_SECONDS)
+        try:
+            purged = await purge_expired_sessions(db)
+            if purged:
+                logger.info("Purged %d abandoned upload sessions", purged)
+        except Exception:
+            logger.exception("Upload session garbage collection failed")
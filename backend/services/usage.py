@@ -0,0 +1,191 @@
+import collections
+import datetime
+import logging
+from typing import Optional
+
+from pymongo import UpdateOne
+
+from core.config import settings
+from services.repositories import open_repositories
+
+logger = logging.getLogger(__name__)
+
+# `users.usage` holds the vault totals (bytes, files, folders) plus `reserved_bytes`
+# held by open upload sessions, `plaintext_bytes` and `last_upload_at` for display;
+# `folders.usage` holds the direct contents of each folder. Both are kept current
+# with $inc so reads never have to scan `files`.
+EMPTY_USAGE = {"bytes": 0, "files": 0, "folders": 0}
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def stored_size(doc: dict) -> int:
+    # Ciphertext size counts towards the quota; documents predating blob_size fall back to file_size
+    return doc.get("blob_size") or doc.get("file_size") or 0
+
+
+def plaintext_size(doc: dict) -> int:
+    # Size the client reported before encryption
+    return doc.get("file_size") or 0
+
+
+def _inc(counts: dict) -> dict:
+    return {f"usage.{field}": value for field, value in counts.items() if value}
+
+
+async def remaining_quota(db, user_id: str) -> Optional[int]:
+    if not settings.USER_QUOTA_BYTES:
+        return None
+    user = await open_repositories(db).users.get(user_id)
+    usage = (user or {}).get("usage") or {}
+    return settings.USER_QUOTA_BYTES - usage.get("bytes", 0) - usage.get("reserved_bytes", 0)
+
+
+async def reserve(db, user_id: str, size: int):
+    added = await open_repositories(db).users.add_usage(
+        user_id, {"reserved_bytes": size}, quota=settings.USER_QUOTA_BYTES, extra_bytes=size
+    )
+    if not added:
+        raise QuotaExceeded()
+
+
+async def release(db, user_id: str, size: int):
+    if size:
+        await open_repositories(db).users.add_usage(user_id, {"reserved_bytes": -size})
+
+
+async def charge_file(db, user_id: str, size: int, reserved: int = 0, plaintext: int = 0,
+                      uploaded_at: Optional[datetime.datetime] = None):
+    """Counts a new file against the user's quota in one conditional update.
+
+    `reserved` bytes already held by an upload session are converted rather than
+    checked again. `uploaded_at` should be the file's `created_at`, which is what
+    reconcile_usage rebuilds `last_upload_at` from.
+    """
+    counts = {"bytes": size, "files": 1, "plaintext_bytes": plaintext}
+    if reserved:
+        counts["reserved_bytes"] = -reserved
+    added = await open_repositories(db).users.add_usage(
+        user_id, counts, latest={"last_upload_at": uploaded_at or datetime.datetime.utcnow()},
+        quota=settings.USER_QUOTA_BYTES, extra_bytes=size - reserved
+    )
+    if not added:
+        raise QuotaExceeded()
+
+
+class UsageChange:
+    """Collects the counter changes of one request and applies them with a single
+    $inc per user/folder document."""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.user = collections.Counter()
+        self.folders = collections.defaultdict(collections.Counter)
+
+    def add_file(self, folder_id: Optional[str], size: int, count: int = 1, *, user: bool = True, plaintext: int = 0):
+        if user:
+            self.user["bytes"] += size * count
+            self.user["files"] += count
+            self.user["plaintext_bytes"] += plaintext * count
+        if folder_id:
+            self.folders[folder_id]["bytes"] += size * count
+            self.folders[folder_id]["files"] += count
+
+    def remove_file(self, folder_id: Optional[str], size: int, plaintext: int = 0):
+        self.add_file(folder_id, size, -1, plaintext=plaintext)
+
+    def move_file(self, old_folder_id: Optional[str], new_folder_id: Optional[str], size: int):
+        if old_folder_id != new_folder_id:
+            self.add_file(old_folder_id, size, -1, user=False)
+            self.add_file(new_folder_id, size, 1, user=False)
+
+    def add_folder(self, parent_id: Optional[str], count: int = 1, *, user: bool = True):
+        if user:
+            self.user["folders"] += count
+        if parent_id:
+            self.folders[parent_id]["folders"] += count
+
+    def remove_folder(self, parent_id: Optional[str]):
+        self.add_folder(parent_id, -1)
+
+    def move_folder(self, old_parent_id: Optional[str], new_parent_id: Optional[str]):
+        if old_parent_id != new_parent_id:
+            self.add_folder(old_parent_id, -1, user=False)
+            self.add_folder(new_parent_id, 1, user=False)
+
+    async def apply(self, db):
+        counts = {field: value for field, value in self.user.items() if value}
+        if counts:
+            await open_repositories(db).users.add_usage(self.user_id, counts)
+        models = [
+            UpdateOne({"_id": folder_id, "user_id": self.user_id}, {"$inc": _inc(counts)})
+            for folder_id, counts in self.folders.items() if _inc(counts)
+        ]
+        if models:
+            await db.folders.bulk_write(models, ordered=False)
+
+
+def public_usage(usage: Optional[dict]) -> dict:
+    return {**EMPTY_USAGE, **{k: v for k, v in (usage or {}).items() if k in EMPTY_USAGE}}
+
+
+async def reconcile_usage(db, batch_size: int = 500) -> int:
+    """Rebuilds every user and folder counter from `files`, `folders` and open
+    upload sessions. Returns the number of users processed."""
+    processed = 0
+    async for user in db.users.find({}, {"_id": 1}):
+        user_id = user["_id"]
+        folder_usage = collections.defaultdict(lambda: dict(EMPTY_USAGE))
+        totals = dict(EMPTY_USAGE)
+
+        pipeline = [
+            {"$match": {"user_id": user_id}},
+            {"$group": {
+                "_id": "$folder_id",
+                "bytes": {"$sum": {"$ifNull": ["$blob_size", {"$ifNull": ["$file_size", 0]}]}},
+                "files": {"$sum": 1},
+                "plaintext_bytes": {"$sum": {"$ifNull": ["$file_size", 0]}},
+                "last_upload_at": {"$max": "$created_at"}
+            }}
+        ]
+        plaintext_bytes = 0
+        last_upload_at = None
+        async for group in db.files.aggregate(pipeline):
+            totals["bytes"] += group["bytes"]
+            totals["files"] += group["files"]
+            plaintext_bytes += group["plaintext_bytes"]
+            if group["last_upload_at"] and (last_upload_at is None or group["last_upload_at"] > last_upload_at):
+                last_upload_at = group["last_upload_at"]
+            if group["_id"]:
+                folder_usage[group["_id"]]["bytes"] = group["bytes"]
+                folder_usage[group["_id"]]["files"] = group["files"]
+
+        folder_ids = []
+        async for folder in db.folders.find({"user_id": user_id}, {"parent_id": 1}):
+            folder_ids.append(folder["_id"])
+            totals["folders"] += 1
+            if folder.get("parent_id"):
+                folder_usage[folder["parent_id"]]["folders"] += 1
+
+        # Sessions keep their reservation until committed or garbage collected
+        reserved = 0
+        async for session in db.upload_sessions.find({"user_id": user_id}, {"reserved": 1}):
+            reserved += session.get("reserved", 0)
+
+        models = [
+            UpdateOne({"_id": folder_id}, {"$set": {"usage": folder_usage.get(folder_id, dict(EMPTY_USAGE))}})
+            for folder_id in folder_ids
+        ]
+        for start in range(0, len(models), batch_size):
+            await db.folders.bulk_write(models[start:start + batch_size], ordered=False)
+        await db.users.update_one({"_id": user_id}, {"$set": {"usage": {
+            **totals,
+            "reserved_bytes": reserved,
+            "plaintext_bytes": plaintext_bytes,
+            "last_upload_at": last_upload_at
+        }}})
+        processed += 1
+    logger.info("Reconciled usage counters for %d users", processed)
+    return processed
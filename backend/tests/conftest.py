@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+# Settings are read when core.config is first imported
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret")
+os.environ.setdefault("UPLOAD_DIR", tempfile.mkdtemp(prefix="secsky-test-blobs-"))
+os.environ.setdefault("STORAGE_BACKEND", "local")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+
+import core.db
+from benchmarks.stand_in import patch_mongomock
+
+
+patch_mongomock()
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db():
+    # A fresh in-memory database per test; the app reads core.db.db on every request
+    core.db.connect(AsyncMongoMockClient())
+    return core.db.db
+
+
+@pytest.fixture
+async def client(db):
+    import main
+    from services.activity import activity_sink
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="https://testserver") as c:
+        yield c
+    # What the lifespan does on shutdown; every test runs on its own event loop
+    await activity_sink.stop()
+
+
+@pytest.fixture
+async def user(client):
+    response = await client.post("/api/auth/register", json={
+        "email": f"{uuid.uuid4().hex}@example.com", "password": "password", "salt": "salt", "vault_metadata": "metadata"
+    })
+    assert response.status_code == 200, response.text
+    client.cookies.set("access_token", response.cookies["access_token"])
+    return response.json()
+
+
+@pytest.fixture
+def upload(client, user):
+    async def upload(content: bytes = b"ciphertext", **fields) -> dict:
+        form = {
+            "encrypted_file_key": "key", "file_iv": "iv", "key_wrap_iv": "wrap-iv",
+            "encrypted_filename": "name", "filename_iv": "name-iv",
+            "requires_file_password": "false", "original_size": str(len(content)),
+            **fields
+        }
+        response = await client.post("/api/files/upload", data=form, files={"file": ("blob", content)})
+        assert response.status_code == 200, response.text
+        return response.json()
+    return upload
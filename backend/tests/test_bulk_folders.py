@@ -0,0 +1,87 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def folder(client, user):
+    async def folder(parent_id: str = None) -> str:
+        response = await client.post("/api/folders/", json={"name_encrypted": "name", "name_iv": "iv", "parent_id": parent_id})
+        assert response.status_code == 200, response.text
+        return response.json()["id"]
+    return folder
+
+
+async def bulk(client, *operations, ordered: bool = False) -> dict:
+    response = await client.post("/api/folders/bulk", json={"operations": list(operations), "ordered": ordered})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+async def test_parent_listed_before_its_children_is_deleted(client, db, folder, ordered):
+    root = await folder()
+    child = await folder(root)
+    grandchild = await folder(child)
+
+    if ordered:
+        # In order, a parent listed first still has its children when its turn comes
+        result = await bulk(client, *({"op": "delete", "folder_id": f} for f in (grandchild, child, root)), ordered=True)
+    else:
+        result = await bulk(client, *({"op": "delete", "folder_id": f} for f in (root, child, grandchild)))
+
+    assert result["failed"] == 0
+    assert await db.folders.count_documents({}) == 0
+    assert (await client.get("/api/usage")).json()["folders"] == 0
+
+
+async def test_parent_kept_when_a_child_is_not_deleted(client, db, upload, folder):
+    root = await folder()
+    child = await folder(root)
+    await upload(folder_id=child)
+
+    result = await bulk(client, {"op": "delete", "folder_id": root}, {"op": "delete", "folder_id": child})
+
+    assert [item["ok"] for item in result["results"]] == [False, False]
+    assert await db.folders.count_documents({}) == 2
+
+
+async def test_ordered_stops_at_first_failure(client, db, folder):
+    root = await folder()
+    child = await folder(root)
+    other = await folder()
+
+    result = await bulk(
+        client, {"op": "delete", "folder_id": root}, {"op": "delete", "folder_id": other}, ordered=True
+    )
+
+    assert [item["error"] for item in result["results"]] == ["Folder is not empty", "Not attempted"]
+    assert await db.folders.count_documents({"_id": {"$in": [root, child, other]}}) == 3
+
+
+async def test_child_moved_out_in_the_same_request_still_blocks_the_delete(client, db, folder):
+    root = await folder()
+    child = await folder(root)
+
+    result = await bulk(client, {"op": "delete", "folder_id": root}, {"op": "move", "folder_id": child, "parent_id": None})
+
+    # Emptiness is planned against the tree as it was; only deletes in the request count
+    assert [item["error"] for item in result["results"]] == ["Folder is not empty", None]
+    assert await db.folders.find_one({"_id": root}) is not None
+    assert (await db.folders.find_one({"_id": child}))["parent_id"] is None
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+async def test_bulk_file_moves_need_an_existing_folder(client, folder, upload, ordered):
+    target = await folder()
+    first, second = (await upload())["id"], (await upload())["id"]
+
+    response = await client.post("/api/files/bulk", json={"operations": [
+        {"op": "move", "file_id": first, "folder_id": "missing"},
+        {"op": "move", "file_id": second, "folder_id": target},
+    ], "ordered": ordered})
+    assert response.status_code == 200, response.text
+    errors = [item["error"] for item in response.json()["results"]]
+    assert errors == ["Folder not found", "Not attempted" if ordered else None]
+    assert (await client.get(f"/api/files/{first}")).json()["folder_id"] is None
+    assert (await client.get(f"/api/files/{second}")).json()["folder_id"] == (None if ordered else target)
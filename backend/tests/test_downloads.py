@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from core.config import settings
+from services.downloads import parse_range, etag_matches, RangeNotSatisfiable
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-10", (990, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=900-5000", (900, 999)),
+    (" bytes=5-5 ", (5, 5)),
+    ("bytes=0-1,5-6", None),
+    ("items=0-1", None),
+    ("bytes=-", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=50-10", "bytes=-0"])
+def test_parse_range_not_satisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, 1000)
+
+
+def test_etag_matches_weak_and_lists():
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"x", "abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"abd"', '"abc"')
+
+
+@pytest.mark.anyio
+async def test_range_requests(client, upload):
+    data = os.urandom(5000)
+    file_id = (await upload(data))["id"]
+    url = f"/api/files/{file_id}/download"
+
+    full = await client.get(url)
+    assert full.status_code == 200 and full.content == data
+
+    partial = await client.get(url, headers={"Range": "bytes=100-199"})
+    assert partial.status_code == 206
+    assert partial.content == data[100:200]
+    assert partial.headers["content-range"] == "bytes 100-199/5000"
+
+    unsatisfiable = await client.get(url, headers={"Range": "bytes=6000-"})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["content-range"] == "bytes */5000"
+
+    # A stale If-Range gets the whole blob rather than a slice of different content
+    stale = await client.get(url, headers={"Range": "bytes=0-1", "If-Range": '"other"'})
+    assert stale.status_code == 200 and stale.content == data
+
+    assert (await client.get(url, headers={"If-None-Match": full.headers["etag"]})).status_code == 304
+
+
+@pytest.mark.anyio
+async def test_missing_blob_is_a_404(client, upload):
+    file_id = (await upload(b"gone"))["id"]
+    os.remove(os.path.join(settings.UPLOAD_DIR, file_id))
+
+    response = await client.get(f"/api/files/{file_id}/download")
+
+    assert response.status_code == 404
+
+
+def test_gridfs_backend_follows_the_bound_database(monkeypatch):
+    from mongomock_motor import AsyncMongoMockClient
+    import core.db
+    from services import storage
+
+    # mongomock databases aren't accepted by GridFS, so only record which one was used
+    monkeypatch.setattr(storage, "GridFSStorageBackend", lambda database, bucket_name: database)
+    core.db.connect(AsyncMongoMockClient())
+    first = storage.get_backend("gridfs")
+    assert first is core.db.db
+    core.db.close()
+    core.db.connect(AsyncMongoMockClient())
+    assert storage.get_backend("gridfs") is core.db.db is not first
+    core.db.close()
@@ -0,0 +1,83 @@
+import pytest
+
+from services import idempotency
+
+pytestmark = pytest.mark.anyio
+
+
+FORM = {
+    "encrypted_file_key": "key", "file_iv": "iv", "key_wrap_iv": "wrap-iv", "encrypted_filename": "name",
+    "filename_iv": "name-iv", "requires_file_password": "false", "original_size": "10"
+}
+
+
+async def test_upload_replay_stores_one_file(client, db, user):
+    headers = {"Idempotency-Key": "upload-1"}
+    first = await client.post("/api/files/upload", data=FORM, files={"file": ("blob", b"ciphertext")}, headers=headers)
+    again = await client.post("/api/files/upload", data=FORM, files={"file": ("blob", b"ciphertext")}, headers=headers)
+
+    assert first.status_code == again.status_code == 200
+    assert again.json() == first.json()
+    assert await db.files.count_documents({}) == 1
+    assert (await client.get("/api/usage")).json()["files"] == 1
+
+
+async def test_replayed_response_is_marked(client, user):
+    headers = {"Idempotency-Key": "folder-1"}
+    body = {"name_encrypted": "enc-name", "name_iv": "iv"}
+    first = await client.post("/api/folders/", json=body, headers=headers)
+    again = await client.post("/api/folders/", json=body, headers=headers)
+
+    assert first.status_code == again.status_code == 200
+    assert "idempotent-replayed" not in first.headers
+    assert again.headers["idempotent-replayed"] == "true"
+    assert again.json() == first.json()
+
+
+async def test_delete_replay_does_not_fail(client, db, user, upload):
+    file_id = (await upload())["id"]
+    headers = {"Idempotency-Key": "delete-1"}
+
+    first = await client.delete(f"/api/files/{file_id}", headers=headers)
+    again = await client.delete(f"/api/files/{file_id}", headers=headers)
+
+    # Without the key the second delete would be a 404
+    assert first.status_code == again.status_code == 200
+    assert again.headers["idempotent-replayed"] == "true"
+
+
+async def test_key_reused_for_another_request_is_refused(client, user, upload):
+    file_id = (await upload())["id"]
+    other_id = (await upload())["id"]
+    headers = {"Idempotency-Key": "delete-2"}
+
+    assert (await client.delete(f"/api/files/{file_id}", headers=headers)).status_code == 200
+    response = await client.delete(f"/api/files/{other_id}", headers=headers)
+    assert response.status_code == 422
+
+
+async def test_failures_are_not_stored(db):
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        raise RuntimeError("boom")
+
+    async def succeeding():
+        calls.append(2)
+        return {"ok": True}
+
+    with pytest.raises(RuntimeError):
+        await idempotency.run(db, "u", "key", "hash", failing)
+    assert await db.idempotency_keys.count_documents({}) == 0
+
+    assert await idempotency.run(db, "u", "key", "hash", succeeding) == {"ok": True}
+    replayed = await idempotency.run(db, "u", "key", "hash", succeeding)
+    assert replayed.headers["idempotent-replayed"] == "true"
+    assert calls == [1, 2]
+
+
+@pytest.mark.parametrize("key", ["", "k" * (idempotency.MAX_KEY_LENGTH + 1)])
+async def test_invalid_keys(client, user, key):
+    response = await client.post("/api/folders/", json={"name_encrypted": "n", "name_iv": "iv"}, headers={"Idempotency-Key": key})
+    assert response.status_code == 400
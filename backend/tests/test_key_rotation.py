@@ -0,0 +1,138 @@
+import pytest
+
+import services.key_rotation
+
+pytestmark = pytest.mark.anyio
+
+ROTATIONS = "/api/auth/master-password/rotations"
+
+
+def rewrapped(file_id: str) -> dict:
+    return {"file_id": file_id, "encrypted_file_key": "new-key", "key_wrap_iv": "new-wrap-iv",
+            "encrypted_filename": "new-name", "filename_iv": "new-name-iv"}
+
+
+async def staged_rotation(client, upload, count: int = 3) -> tuple[str, list[str]]:
+    ids = [(await upload())["id"] for _ in range(count)]
+    job = (await client.post(ROTATIONS, json={"salt": "new-salt", "vault_metadata": "new-metadata"})).json()
+    response = await client.put(f"{ROTATIONS}/{job['job_id']}/batches/0", json={"file_updates": [rewrapped(i) for i in ids]})
+    assert response.status_code == 200, response.text
+    return job["job_id"], ids
+
+
+async def test_commit_requires_every_file(client, user, upload):
+    ids = [(await upload())["id"] for _ in range(2)]
+    job_id = (await client.post(ROTATIONS, json={"salt": "new-salt", "vault_metadata": "new-metadata"})).json()["job_id"]
+    await client.put(f"{ROTATIONS}/{job_id}/batches/0", json={"file_updates": [rewrapped(ids[0])]})
+
+    response = await client.post(f"{ROTATIONS}/{job_id}/commit")
+
+    assert response.status_code == 409
+    assert response.json()["detail"]["pending_files"] == 1
+    assert (await client.get("/api/auth/me")).json()["salt"] == "salt"
+
+
+async def test_staged_keys_stay_hidden_until_commit(client, user, upload):
+    job_id, ids = await staged_rotation(client, upload)
+
+    listing = (await client.get("/api/files/")).json()
+    metadata = (await client.get(f"/api/files/{ids[0]}")).json()
+    assert all("pending_key" not in f for f in listing)
+    assert "pending_key" not in metadata
+    assert metadata["encrypted_file_key"] == "key"
+
+    response = await client.post(f"{ROTATIONS}/{job_id}/commit")
+    assert response.status_code == 200 and response.json()["status"] == "committed"
+
+    me = (await client.get("/api/auth/me")).json()
+    metadata = (await client.get(f"/api/files/{ids[0]}")).json()
+    assert me["salt"] == "new-salt" and me["vault_metadata"] == "new-metadata"
+    assert (metadata["encrypted_file_key"], metadata["filename"]) == ("new-key", "new-name")
+    # A retried commit changes nothing
+    assert (await client.post(f"{ROTATIONS}/{job_id}/commit")).json()["status"] == "committed"
+
+
+async def test_interrupted_commit_is_finished_by_the_next_request(client, db, user, upload, monkeypatch):
+    job_id, ids = await staged_rotation(client, upload)
+
+    async def interrupted(*args, **kwargs):
+        raise RuntimeError("worker died")
+
+    finish = services.key_rotation.finish_key_rotation
+    monkeypatch.setattr(services.key_rotation, "finish_key_rotation", interrupted)
+    with pytest.raises(RuntimeError):
+        await client.post(f"{ROTATIONS}/{job_id}/commit")
+    stored = await db.users.find_one({"_id": user["id"]})
+    assert stored["salt"] == "new-salt" and stored["key_rotation_id"] == job_id
+
+    monkeypatch.setattr(services.key_rotation, "finish_key_rotation", finish)
+    metadata = (await client.get(f"/api/files/{ids[1]}")).json()
+
+    assert metadata["encrypted_file_key"] == "new-key"
+    assert (await db.users.find_one({"_id": user["id"]}))["key_rotation_id"] is None
+    assert await db.files.count_documents({"pending_key": {"$exists": True}}) == 0
+    assert (await client.get(f"{ROTATIONS}/{job_id}")).json()["status"] == "committed"
+
+
+async def test_abort_drops_staged_keys(client, db, user, upload):
+    job_id, _ = await staged_rotation(client, upload)
+
+    assert (await client.delete(f"{ROTATIONS}/{job_id}")).status_code == 200
+
+    assert await db.files.count_documents({"pending_key": {"$exists": True}}) == 0
+    assert (await client.post(f"{ROTATIONS}/{job_id}/commit")).status_code == 409
+
+
+async def test_resubmitted_files_count_once(client, user, upload):
+    job_id, ids = await staged_rotation(client, upload)
+
+    response = await client.put(f"{ROTATIONS}/{job_id}/batches/1", json={"file_updates": [rewrapped(ids[0])]})
+
+    assert (response.json()["applied_files"], response.json()["pending_files"]) == (3, 0)
+    committed = (await client.post(f"{ROTATIONS}/{job_id}/commit")).json()
+    assert (committed["status"], committed["applied_files"]) == ("committed", 3)
+
+
+async def test_single_request_rotation_is_refused_during_a_job(client, user, upload):
+    job_id, ids = await staged_rotation(client, upload)
+
+    response = await client.put("/api/auth/master-password", json={
+        "salt": "other-salt", "vault_metadata": "other-metadata", "file_updates": [rewrapped(i) for i in ids]
+    })
+
+    assert response.status_code == 409
+    assert response.json()["detail"]["job_id"] == job_id
+    assert (await client.get("/api/auth/me")).json()["salt"] == "salt"
+
+
+async def test_single_request_rotation(client, db, user, upload):
+    ids = [(await upload())["id"] for _ in range(2)]
+
+    response = await client.put("/api/auth/master-password", json={
+        "salt": "new-salt", "vault_metadata": "new-metadata", "file_updates": [rewrapped(i) for i in ids]
+    })
+
+    assert response.status_code == 200, response.text
+    assert (await client.get("/api/auth/me")).json()["salt"] == "new-salt"
+    assert (await client.get(f"/api/files/{ids[0]}")).json()["encrypted_file_key"] == "new-key"
+    assert await db.files.count_documents({"pending_key": {"$exists": True}}) == 0
+    # The job it ran as is finished, so another rotation can start
+    assert (await client.post(ROTATIONS, json={"salt": "s", "vault_metadata": "m"})).status_code == 200
+
+
+async def test_failed_single_request_rotation_changes_nothing(client, db, user, upload, monkeypatch):
+    import routers.auth
+
+    ids = [(await upload())["id"] for _ in range(2)]
+
+    async def failing(*args, **kwargs):
+        raise RuntimeError("write failed")
+
+    monkeypatch.setattr(routers.auth, "stage_rotated_keys", failing)
+    with pytest.raises(RuntimeError):
+        await client.put("/api/auth/master-password", json={
+            "salt": "new-salt", "vault_metadata": "new-metadata", "file_updates": [rewrapped(i) for i in ids]
+        })
+
+    assert (await db.users.find_one({"_id": user["id"]}))["salt"] == "salt"
+    assert await db.key_rotations.count_documents({"status": {"$in": ["open", "committing"]}}) == 0
@@ -0,0 +1,54 @@
+import datetime
+
+import pytest
+
+from services.maintenance import Maintenance
+
+pytestmark = pytest.mark.anyio
+
+LONG_AGO = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+
+
+async def test_files_need_an_existing_folder(client, user, upload):
+    form = {"encrypted_file_key": "key", "file_iv": "iv", "key_wrap_iv": "wrap-iv", "encrypted_filename": "name",
+            "filename_iv": "name-iv", "requires_file_password": "false", "original_size": "1", "folder_id": "missing"}
+    response = await client.post("/api/files/upload", data=form, files={"file": ("blob", b"x")})
+    assert (response.status_code, response.json()["detail"]) == (404, "Folder not found")
+
+    file_id = (await upload())["id"]
+    response = await client.put(f"/api/files/{file_id}/move", json={"folder_id": "missing"})
+    assert response.status_code == 404
+    assert (await client.get(f"/api/files/{file_id}")).json()["folder_id"] is None
+
+
+async def test_orphaned_files_are_moved_to_the_top_level(client, db, user, upload):
+    file_id = (await upload())["id"]
+    await db.files.update_one({"_id": file_id}, {"$set": {"folder_id": "gone", "created_at": LONG_AGO}})
+
+    stats = await Maintenance(db, pause=0).run(["orphan_files"])
+
+    assert (stats["orphan_files"]["rehomed"], stats["orphan_files"]["reclaimed"]) == (1, 0)
+    assert (await client.get(f"/api/files/{file_id}")).json()["folder_id"] is None
+
+
+async def test_recently_moved_files_are_left_alone(client, db, user, upload):
+    file_id = (await upload())["id"]
+    await db.files.update_one({"_id": file_id}, {"$set": {
+        "folder_id": "gone", "created_at": LONG_AGO, "moved_at": datetime.datetime.utcnow()
+    }})
+
+    stats = await Maintenance(db, pause=0).run(["orphan_files"])
+
+    assert stats["orphan_files"]["scanned"] == 0
+    assert (await db.files.find_one({"_id": file_id}))["folder_id"] == "gone"
+
+
+async def test_files_of_deleted_users_are_removed(client, db, user, upload):
+    file_id = (await upload())["id"]
+    await db.files.update_one({"_id": file_id}, {"$set": {"created_at": LONG_AGO}})
+    await db.users.delete_one({"_id": user["id"]})
+
+    stats = await Maintenance(db, pause=0).run(["orphan_files"])
+
+    assert stats["orphan_files"]["reclaimed"] == 1
+    assert await db.files.count_documents({}) == 0
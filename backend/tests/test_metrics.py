@@ -0,0 +1,22 @@
+import pytest
+
+from core.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_disabled_without_a_token(client, monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_TOKEN", "")
+    assert (await client.get("/metrics")).status_code == 403
+
+
+@pytest.mark.parametrize("authorization, status", [
+    (None, 401),
+    ("Bearer wrong", 401),
+    ("Bearer sécret".encode("latin-1"), 401),
+    ("Bearer secret", 200),
+])
+async def test_token_is_required(client, monkeypatch, authorization, status):
+    monkeypatch.setattr(settings, "METRICS_TOKEN", "secret")
+    headers = {"Authorization": authorization} if authorization else {}
+    assert (await client.get("/metrics", headers=headers)).status_code == status
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from core.config import settings
+from services import repositories
+from services.activity import activity_sink
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    monkeypatch.setattr(settings, "REPOSITORY_BACKEND", "memory")
+    monkeypatch.setattr(repositories, "_memory_backend", None)
+    return lambda: repositories._memory_backend
+
+
+async def test_lookups_in_one_turn_share_a_query():
+    calls = []
+
+    async def fetch(keys):
+        calls.append(keys)
+        return {key: {"_id": key} for key in keys if key != "missing"}
+
+    loader = repositories.Loader(fetch)
+    found = await asyncio.gather(loader.load("a"), loader.load("b"), loader.load("a"), loader.load("missing"))
+
+    assert [doc and doc["_id"] for doc in found] == ["a", "b", "a", None]
+    assert calls == [["a", "b", "missing"]]
+    await loader.load("b")
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("backend", [repositories.MemoryBackend, None])
+async def test_backends_agree(db, backend):
+    repos = repositories.Repositories(backend() if backend else repositories.MongoBackend(db))
+    await repos.users.insert({"_id": "u", "email": "a@example.com"})
+    await repos.files.insert({"_id": "f", "user_id": "u", "encrypted_blob": b"x", "pending_key": {}})
+
+    assert await repos.users.increment("u", "vault_version", 2) == 2
+    assert await repos.users.add_usage("u", {"bytes": 600}, quota=1000, extra_bytes=600)
+    assert not await repos.users.add_usage("u", {"bytes": 500}, quota=1000, extra_bytes=500)
+
+    fresh = repositories.Repositories(repos.backend)
+    user = await fresh.users.by_email("a@example.com")
+    assert (user["vault_version"], user["usage"]["bytes"]) == (2, 600)
+    assert set(await fresh.files.get("u", "f")) == {"_id", "user_id"}
+    assert await fresh.files.get("other", "f") is None
+    assert set(await fresh.files.update("u", "f", {"folder_id": None})) == {"_id", "user_id"}
+    assert (await fresh.files.delete("u", "f"))["_id"] == "f"
+
+
+async def test_api_runs_on_the_memory_backend(client, db, memory, upload):
+    stored = await upload(b"ciphertext")
+
+    download = await client.get(f"/api/files/{stored['id']}/download")
+    assert download.content == b"ciphertext"
+    assert (await client.get("/api/usage")).json()["files"] == 1
+    await activity_sink.stop()
+    assert [log["type"] for log in (await client.get("/api/activity/recent")).json()] == ["UPLOAD"]
+
+    # Nothing went to the collections the repositories cover
+    assert await db.users.count_documents({}) == await db.files.count_documents({}) == 0
+    assert memory().files.docs[stored["id"]]["user_id"] == memory().users.docs.popitem()[0]
@@ -0,0 +1,114 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def sync(client, since: int) -> dict:
+    response = await client.get("/api/sync", params={"since": since})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def test_first_sync_is_a_reset(client, user, upload):
+    await upload()
+    result = await sync(client, 0)
+    assert result["reset"] is True
+    assert result["version"] == 1
+
+
+async def test_changes_since_a_version(client, user, upload):
+    kept = (await upload())["id"]
+    removed = (await upload())["id"]
+    version = (await sync(client, 0))["version"]
+
+    added = (await upload())["id"]
+    assert (await client.delete(f"/api/files/{removed}")).status_code == 200
+    result = await sync(client, version)
+
+    assert result["reset"] is False
+    assert [f["id"] for f in result["files"]] == [added]
+    assert result["deleted_files"] == [removed]
+    assert result["version"] == version + 2
+    assert kept not in result["deleted_files"]
+    # Nothing new since the latest version
+    assert (await sync(client, result["version"]))["files"] == []
+
+
+async def test_file_added_and_deleted_in_the_window_is_only_deleted(client, user, upload):
+    await upload()
+    version = (await sync(client, 0))["version"]
+    file_id = (await upload())["id"]
+    await client.delete(f"/api/files/{file_id}")
+
+    result = await sync(client, version)
+
+    assert result["files"] == []
+    assert result["deleted_files"] == [file_id]
+
+
+async def test_trimmed_journal_forces_a_reset(client, db, user, upload):
+    await upload()
+    version = (await sync(client, 0))["version"]
+    await upload()
+    await upload()
+    # Retention removed the entry right after the client's version
+    await db.vault_changes.delete_one({"user_id": user["id"], "version": version + 1})
+
+    result = await sync(client, version)
+
+    assert result["reset"] is True
+    assert result["version"] == version + 2
+
+
+async def test_version_from_the_future_forces_a_reset(client, user, upload):
+    await upload()
+    assert (await sync(client, 99))["reset"] is True
+
+
+async def test_master_password_change_resets_synced_clients(client, user, upload):
+    await upload()
+    version = (await sync(client, 0))["version"]
+    response = await client.put("/api/auth/master-password", json={
+        "salt": "new-salt", "vault_metadata": "new-metadata", "file_updates": []
+    })
+    assert response.status_code == 200, response.text
+
+    assert (await sync(client, version))["reset"] is True
+
+
+async def create_folder(client, parent_id: str = None) -> str:
+    response = await client.post("/api/folders/", json={"name_encrypted": "name", "name_iv": "iv", "parent_id": parent_id})
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+async def test_moving_a_folder_syncs_its_subtree(client, user, bulk):
+    target = await create_folder(client)
+    moved = await create_folder(client)
+    child = await create_folder(client, moved)
+    grandchild = await create_folder(client, child)
+    version = (await sync(client, 0))["version"]
+
+    if bulk:
+        response = await client.post("/api/folders/bulk", json={"operations": [{"op": "move", "folder_id": moved, "parent_id": target}]})
+    else:
+        response = await client.put(f"/api/folders/{moved}/move", json={"parent_id": target})
+    assert response.status_code == 200, response.text
+    result = await sync(client, version)
+
+    ancestors = {f["id"]: f["ancestors"] for f in result["folders"]}
+    assert ancestors == {moved: [target], child: [target, moved], grandchild: [target, moved, child]}
+
+
+async def test_tree_delete_removes_files_by_id(client, db, user, upload):
+    root = await create_folder(client)
+    kept = (await upload())["id"]
+    inside = (await upload(folder_id=root))["id"]
+
+    response = await client.delete(f"/api/folders/{root}", params={"recursive": "true"})
+
+    assert response.json()["deleted_files"] == 1
+    assert [doc["_id"] for doc in await db.files.find({}).to_list(length=None)] == [kept]
+    assert (await client.get("/api/usage")).json()["files"] == 1
+    assert inside in (await sync(client, 1))["deleted_files"]
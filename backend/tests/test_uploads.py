@@ -0,0 +1,136 @@
+import datetime
+import hashlib
+
+import pytest
+
+from services import upload_sessions
+from services.storage import get_backend
+
+pytestmark = pytest.mark.anyio
+
+CHUNK = 1024 * 1024
+DATA = bytes(range(256)) * (CHUNK // 128) + b"tail"
+
+
+async def open_session(client, data: bytes = DATA, **fields) -> str:
+    response = await client.post("/api/files/uploads", json={
+        "total_size": len(data), "chunk_size": CHUNK, "encrypted_file_key": "key", "file_iv": "iv",
+        "key_wrap_iv": "wrap-iv", "encrypted_filename": "name", "filename_iv": "name-iv",
+        "requires_file_password": False, "original_size": len(data), **fields
+    })
+    assert response.status_code == 200, response.text
+    session_id = response.json()["session_id"]
+    for index in range(0, len(data), CHUNK):
+        response = await client.put(f"/api/files/uploads/{session_id}/chunks/{index // CHUNK}", content=data[index:index + CHUNK])
+        assert response.status_code == 200, response.text
+    return session_id
+
+
+async def test_retried_commit_returns_the_same_file(client, db, user):
+    session_id = await open_session(client, sha256=hashlib.sha256(DATA).hexdigest())
+
+    first = await client.post(f"/api/files/uploads/{session_id}/commit")
+    retry = await client.post(f"/api/files/uploads/{session_id}/commit")
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.json()["id"] == first.json()["id"]
+    assert await db.files.count_documents({}) == 1
+    assert (await client.get(f"/api/files/{first.json()['id']}/download")).content == DATA
+    assert (await client.delete(f"/api/files/uploads/{session_id}")).status_code == 409
+
+
+async def test_commit_interrupted_after_the_file_record_is_not_reopened(client, db, user, monkeypatch):
+    import routers.uploads
+
+    session_id = await open_session(client)
+
+    async def interrupted(*args, **kwargs):
+        raise RuntimeError("worker died")
+
+    finish_commit = routers.uploads.finish_commit
+    monkeypatch.setattr(routers.uploads, "finish_commit", interrupted)
+    with pytest.raises(RuntimeError):
+        await client.post(f"/api/files/uploads/{session_id}/commit")
+    session = await db.upload_sessions.find_one({"_id": session_id})
+    assert session["status"] != "open"
+
+    monkeypatch.setattr(routers.uploads, "finish_commit", finish_commit)
+    retry = await client.post(f"/api/files/uploads/{session_id}/commit")
+    assert retry.status_code == 200
+    assert retry.json()["id"] == session["file_id"]
+    assert await db.files.count_documents({}) == 1
+
+
+async def test_expired_committed_session_keeps_its_charge(client, db, user):
+    session_id = await open_session(client)
+    assert (await client.post(f"/api/files/uploads/{session_id}/commit")).status_code == 200
+    charged = (await db.users.find_one({"_id": user["id"]}))["usage"]
+
+    await db.upload_sessions.update_one(
+        {"_id": session_id}, {"$set": {"expires_at": datetime.datetime.utcnow() - datetime.timedelta(hours=1)}}
+    )
+    await upload_sessions.purge_expired_sessions(db)
+
+    assert await db.upload_sessions.count_documents({}) == 0
+    assert (await db.users.find_one({"_id": user["id"]}))["usage"] == charged
+
+
+async def test_part_changed_after_upload_is_asked_for_again(client, db, user):
+    session_id = await open_session(client)
+    session = await db.upload_sessions.find_one({"_id": session_id})
+    await get_backend(session["storage_backend"]).put(upload_sessions.part_key(session_id, 0), b"x" * CHUNK)
+
+    response = await client.post(f"/api/files/uploads/{session_id}/commit")
+
+    assert response.status_code == 409
+    assert response.json()["detail"]["missing"] == [0]
+    assert (await client.get(f"/api/files/uploads/{session_id}")).json()["missing"] == [0]
+    assert await db.files.count_documents({}) == 0
+
+
+async def test_assembled_file_must_match_declared_sha256(client, db, user):
+    session_id = await open_session(client, sha256="0" * 64)
+
+    response = await client.post(f"/api/files/uploads/{session_id}/commit")
+
+    assert response.status_code == 409
+    assert (await db.upload_sessions.find_one({"_id": session_id}))["status"] == "open"
+
+
+async def stall_commit(db, session_id: str, seconds: float):
+    # What a commit whose worker died after claiming the session leaves behind
+    await db.upload_sessions.update_one({"_id": session_id}, {"$set": {
+        "status": upload_sessions.COMMITTING,
+        "commit_claim": "dead-worker",
+        "committing_until": datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+    }})
+
+
+async def test_live_commit_claim_is_respected(client, db, user):
+    session_id = await open_session(client)
+    await stall_commit(db, session_id, 60)
+
+    assert (await client.post(f"/api/files/uploads/{session_id}/commit")).status_code == 409
+    assert (await client.delete(f"/api/files/uploads/{session_id}")).status_code == 409
+
+
+async def test_expired_commit_claim_is_taken_over(client, db, user):
+    session_id = await open_session(client)
+    await stall_commit(db, session_id, -1)
+
+    response = await client.post(f"/api/files/uploads/{session_id}/commit")
+
+    assert response.status_code == 200, response.text
+    session = await db.upload_sessions.find_one({"_id": session_id})
+    assert session["status"] == upload_sessions.COMMITTED
+    assert "commit_claim" not in session
+    assert (await client.get("/api/usage")).json()["reserved_bytes"] == 0
+
+
+async def test_expired_commit_claim_can_be_aborted(client, db, user):
+    session_id = await open_session(client)
+    await stall_commit(db, session_id, -1)
+
+    assert (await client.delete(f"/api/files/uploads/{session_id}")).status_code == 200
+    assert await db.upload_sessions.count_documents({}) == 0
+    assert (await client.get("/api/usage")).json()["reserved_bytes"] == 0
@@ -0,0 +1,94 @@
+import pytest
+
+from core.config import settings
+from services import usage
+
+pytestmark = pytest.mark.anyio
+
+QUOTA = 1000
+
+
+@pytest.fixture
+def quota(monkeypatch):
+    monkeypatch.setattr(settings, "USER_QUOTA_BYTES", QUOTA)
+
+
+def session_body(total_size: int) -> dict:
+    return {
+        "total_size": total_size, "encrypted_file_key": "key", "file_iv": "iv", "key_wrap_iv": "wrap-iv",
+        "encrypted_filename": "name", "filename_iv": "name-iv", "requires_file_password": False,
+        "original_size": total_size
+    }
+
+
+async def test_reserve_and_release(db, quota):
+    await db.users.insert_one({"_id": "u"})
+
+    await usage.reserve(db, "u", 600)
+    with pytest.raises(usage.QuotaExceeded):
+        await usage.reserve(db, "u", 500)
+    assert await usage.remaining_quota(db, "u") == 400
+
+    await usage.release(db, "u", 600)
+    await usage.reserve(db, "u", 1000)
+    assert await usage.remaining_quota(db, "u") == 0
+
+
+async def test_charge_converts_a_reservation(db, quota):
+    await db.users.insert_one({"_id": "u"})
+    await usage.reserve(db, "u", 800)
+
+    # Already held, so it fits even though only 200 bytes are free
+    await usage.charge_file(db, "u", 800, reserved=800, plaintext=700)
+    with pytest.raises(usage.QuotaExceeded):
+        await usage.charge_file(db, "u", 300)
+
+    counters = (await db.users.find_one({"_id": "u"}))["usage"]
+    assert (counters["bytes"], counters["reserved_bytes"], counters["files"]) == (800, 0, 1)
+    assert counters["plaintext_bytes"] == 700
+
+
+async def test_upload_over_quota_is_refused(client, db, user, upload, quota):
+    await upload(b"x" * 600)
+
+    response = await client.post(
+        "/api/files/upload",
+        data={"encrypted_file_key": "key", "file_iv": "iv", "key_wrap_iv": "wrap-iv", "encrypted_filename": "name",
+              "filename_iv": "name-iv", "requires_file_password": "false", "original_size": "500"},
+        files={"file": ("blob", b"y" * 500)}
+    )
+
+    assert response.status_code == 413
+    assert await db.files.count_documents({}) == 1
+    assert (await client.get("/api/usage")).json()["bytes"] == 600
+
+
+async def test_upload_session_holds_quota_until_aborted(client, user, quota):
+    response = await client.post("/api/files/uploads", json=session_body(700))
+    assert response.status_code == 200, response.text
+    session_id = response.json()["session_id"]
+
+    current = (await client.get("/api/usage")).json()
+    assert (current["reserved_bytes"], current["remaining_bytes"]) == (700, 300)
+    assert (await client.post("/api/files/uploads", json=session_body(400))).status_code == 413
+
+    assert (await client.delete(f"/api/files/uploads/{session_id}")).status_code == 200
+    current = (await client.get("/api/usage")).json()
+    assert (current["reserved_bytes"], current["remaining_bytes"]) == (0, QUOTA)
+
+
+async def test_counters_follow_uploads_and_deletes(client, db, user, upload):
+    first = (await upload(b"a" * 10, original_size="4"))["id"]
+    await upload(b"b" * 20, original_size="8")
+    await client.delete(f"/api/files/{first}")
+
+    current = (await client.get("/api/usage")).json()
+    assert (current["files"], current["bytes"], current["plaintext_bytes"]) == (1, 20, 8)
+    assert current["last_upload_at"] is not None
+
+    # Rebuilding from scratch gives the same numbers
+    before = (await db.users.find_one({"_id": user["id"]}))["usage"]
+    await db.users.update_one({"_id": user["id"]}, {"$unset": {"usage": ""}})
+    await usage.reconcile_usage(db)
+    after = (await db.users.find_one({"_id": user["id"]}))["usage"]
+    assert {k: after[k] for k in before} == before
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { useAuth } from '../auth/AuthContext';
-import { getFiles, getRecentActivity } from '../../utils/api';
+import { getUsage, getRecentActivity } from '../../utils/api';
 import { Shield, FileText, HardDrive, Clock, Lock, Activity, CheckCircle2, ChevronRight, Zap } from 'lucide-react';
 import { motion } from 'framer-motion';
 
@@ -13,21 +13,15 @@ export default function Dashboard() {
     useEffect(() => {
         async function fetchDashboardData() {
             try {
-                const [files, recentLogs] = await Promise.all([
-                    getFiles(),
+                const [usage, recentLogs] = await Promise.all([
+                    getUsage(),
                     getRecentActivity()
                 ]);
 
-                const totalSize = files.reduce((acc, f) => acc + (f.file_size || 0), 0);
-
-                // Find latest upload time from files
-                const uploads = files.filter(f => f.created_at).map(f => new Date(f.created_at));
-                let lastUpload = uploads.length > 0 ? new Date(Math.max(...uploads)) : null;
-
                 setStats({
-                    totalFiles: files.length,
-                    totalSize,
-                    lastUpload
+                    totalFiles: usage.files,
+                    totalSize: usage.plaintext_bytes,
+                    lastUpload: usage.last_upload_at ? new Date(usage.last_upload_at) : null
                 });
 
                 setActivity(recentLogs || []);
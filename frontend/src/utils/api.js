@@ -42,18 +42,44 @@ export const logoutUser = () => fetchApi('/auth/logout', { method: 'POST' });
 export const getCurrentUser = () => fetchApi('/auth/me', { method: 'GET' });
 export const changeLoginPassword = (data) => fetchApi('/auth/login-password', { method: 'PUT', body: JSON.stringify(data) });
 export const changeMasterPassword = (data) => fetchApi('/auth/master-password', { method: 'PUT', body: JSON.stringify(data) });
+export const startKeyRotation = (data) => fetchApi('/auth/master-password/rotations', { method: 'POST', body: JSON.stringify(data) });
+export const getKeyRotation = (jobId) => fetchApi(`/auth/master-password/rotations/${jobId}`, { method: 'GET' });
+export const getKeyRotationPending = (jobId, limit = 500) => fetchApi(`/auth/master-password/rotations/${jobId}/pending?limit=${limit}`, { method: 'GET' });
+export const submitKeyRotationBatch = (jobId, seq, file_updates) => fetchApi(`/auth/master-password/rotations/${jobId}/batches/${seq}`, { method: 'PUT', body: JSON.stringify({ file_updates }) });
+export const commitKeyRotation = (jobId) => fetchApi(`/auth/master-password/rotations/${jobId}/commit`, { method: 'POST' });
+export const abortKeyRotation = (jobId) => fetchApi(`/auth/master-password/rotations/${jobId}`, { method: 'DELETE' });
 
 // File, Folder and Activity methods
 export const getFiles = () => fetchApi('/files/', { method: 'GET' });
+export const getFilesPage = (params = {}) => fetchApi(`/files/page?${new URLSearchParams(params)}`, { method: 'GET' });
+// Blind-index search: `tokens` are keyed hashes computed in the browser, results are candidates to decrypt and filter
+export const searchFiles = (tokens, params = {}) => {
+    const query = new URLSearchParams(params);
+    tokens.forEach(token => query.append('tokens', token));
+    return fetchApi(`/files/search?${query}`, { method: 'GET' });
+};
+export const renameFile = (fileId, encryptedFilename, filenameIv, searchTokens = null) => fetchApi(`/files/${fileId}/rename`, {
+    method: 'PUT',
+    body: JSON.stringify({ encrypted_filename: encryptedFilename, filename_iv: filenameIv, search_tokens: searchTokens })
+});
 export const getFileMetadata = (id) => fetchApi(`/files/${id}`, { method: 'GET' });
 export const deleteFile = (id) => fetchApi(`/files/${id}`, { method: 'DELETE' });
 export const moveFile = (id, folder_id) => fetchApi(`/files/${id}/move`, { method: 'PUT', body: JSON.stringify({ folder_id }) });
+export const bulkFiles = (operations, ordered = false) => fetchApi('/files/bulk', { method: 'POST', body: JSON.stringify({ operations, ordered }) });
 
 export const getFolders = () => fetchApi('/folders/', { method: 'GET' });
+export const getFoldersPage = (params = {}) => fetchApi(`/folders/page?${new URLSearchParams(params)}`, { method: 'GET' });
 export const createFolder = (data) => fetchApi('/folders/', { method: 'POST', body: JSON.stringify(data) });
-export const deleteFolder = (id) => fetchApi(`/folders/${id}`, { method: 'DELETE' });
+export const deleteFolder = (id, recursive = false) => fetchApi(`/folders/${id}${recursive ? '?recursive=true' : ''}`, { method: 'DELETE' });
+export const getFolderTree = (id) => fetchApi(`/folders/${id}/tree`, { method: 'GET' });
 export const renameFolder = (id, data) => fetchApi(`/folders/${id}/rename`, { method: 'PUT', body: JSON.stringify(data) });
 export const moveFolder = (id, data) => fetchApi(`/folders/${id}/move`, { method: 'PUT', body: JSON.stringify(data) });
+export const bulkFolders = (operations, ordered = false) => fetchApi('/folders/bulk', { method: 'POST', body: JSON.stringify({ operations, ordered }) });
+
+export const getVaultChanges = (since) => fetchApi(`/sync?since=${since}`, { method: 'GET' });
+
+export const getUsage = () => fetchApi('/usage', { method: 'GET' });
+export const getFolderUsage = (folderId) => fetchApi(`/usage/folders/${folderId}`, { method: 'GET' });
 
 export const getRecentActivity = () => fetchApi('/activity/recent', { method: 'GET' });
 
@@ -84,3 +110,42 @@ export async function fetchFileBlob(fileId) {
     }
     return response.blob(); // Get as ArrayBuffer via blob
 }
+
+// Many files in one response: { file_ids: [...] } or { folder_id, recursive }.
+// Calls onFile(header, Uint8Array) per file as frames arrive and resolves with the
+// trailing summary ({ count, missing, not_found }). Frame layout: uint32 header
+// length, JSON header, uint64 body length, body (all big-endian).
+export async function fetchFilesBatch(selection, onFile) {
+    const response = await fetch(`${API_BASE}/files/batch-download`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(selection),
+        credentials: 'include'
+    });
+    if (!response.ok) {
+        throw new Error('Batch download failed');
+    }
+    const reader = response.body.getReader();
+    let buffer = new Uint8Array(0);
+    const need = async (length) => {
+        while (buffer.length < length) {
+            const { done, value } = await reader.read();
+            if (done) throw new Error('Batch download ended early');
+            const merged = new Uint8Array(buffer.length + value.length);
+            merged.set(buffer);
+            merged.set(value, buffer.length);
+            buffer = merged;
+        }
+        const bytes = buffer.slice(0, length);
+        buffer = buffer.slice(length);
+        return bytes;
+    };
+    for (;;) {
+        const headerLength = new DataView((await need(4)).buffer).getUint32(0);
+        const header = JSON.parse(new TextDecoder().decode(await need(headerLength)));
+        const bodyLength = Number(new DataView((await need(8)).buffer).getBigUint64(0));
+        const body = await need(bodyLength);
+        if (header.end) return header;
+        await onFile(header, body);
+    }
+}